@@ -0,0 +1,278 @@
+"""
+Async DNS Server
+asyncio UDP/TCP listener that feeds queries to DNSFilterResolver
+"""
+
+import asyncio
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dnslib import DNSRecord, RCODE
+import dns_wire
+
+# Queries a single TCP connection may have outstanding at once
+TCP_PIPELINE_DEPTH = 64
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol that hands each packet to the server"""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.handle_datagram(self.transport, data, addr)
+
+    def error_received(self, exc):
+        print(f"UDP listener error: {exc}")
+
+class AsyncDNSServer:
+    """Serves DNS over UDP and TCP from a single event loop
+
+    Blocklist and cache hits are answered inline on the loop, straight
+    from the wire bytes. Only cache misses are parsed into dnslib objects
+    and handed to a bounded worker pool for the upstream round trip.
+
+    inflight counts cache misses from the moment their task is created
+    until it is done, including ones still waiting for a worker. Once it
+    reaches max_concurrent_queries, UDP misses are dropped and TCP misses
+    get SERVFAIL, so a flood of misses cannot queue unbounded work.
+    """
+
+    def __init__(self, resolver, host, port, max_concurrent_queries=1024,
+                 upstream_workers=64, tcp_enabled=True, tcp_idle_timeout=10.0):
+        self.resolver = resolver
+        self.host = host
+        self.port = port
+        self.max_concurrent_queries = max(1, max_concurrent_queries)
+        self.upstream_workers = max(1, upstream_workers)
+        self.tcp_enabled = tcp_enabled
+        self.tcp_idle_timeout = tcp_idle_timeout
+
+        self.loop = None
+        self.executor = None
+        self.udp_transport = None
+        self.tcp_server = None
+        self.inflight = 0
+        self.stats = {
+            'udp_queries': 0,
+            'tcp_queries': 0,
+            'truncated': 0,
+            'dropped': 0,
+            'errors': 0
+        }
+
+    def start(self):
+        """Run the event loop until stop() is called (blocking)"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(max_workers=self.upstream_workers,
+                                           thread_name_prefix='dns-upstream')
+        try:
+            self.loop.run_until_complete(self._listen())
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self._close())
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+    def stop(self):
+        """Stop the event loop from any thread"""
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def get_stats(self):
+        """Get listener statistics"""
+        stats = dict(self.stats)
+        stats['inflight'] = self.inflight
+        return stats
+
+    async def _listen(self):
+        """Bind the UDP endpoint and, if enabled, the TCP listener"""
+        self.udp_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _UDPProtocol(self), local_addr=(self.host, self.port))
+        # Pick up the real port when binding to port 0
+        self.port = self.udp_transport.get_extra_info('sockname')[1]
+
+        if self.tcp_enabled:
+            self.tcp_server = await asyncio.start_server(
+                self._handle_tcp_connection, self.host, self.port)
+
+    async def _close(self):
+        """Close listeners and cancel open TCP connections"""
+        if self.udp_transport:
+            self.udp_transport.close()
+        if self.tcp_server:
+            self.tcp_server.close()
+
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.tcp_server:
+            await self.tcp_server.wait_closed()
+
+    def handle_datagram(self, transport, data, addr):
+        """Answer a UDP query, dropping it when the server is saturated"""
+        self.stats['udp_queries'] += 1
+        question = self._parse_question(data)
+        if question is None:
+            return
+
+        start_time = time.time()
+        rdata = self._resolve_local(data, question, addr[0], start_time)
+        if rdata is not None:
+            transport.sendto(self._fit_udp(data, rdata), addr)
+            return
+
+        # Shed load rather than queue unbounded work; the client will retry
+        if self.inflight >= self.max_concurrent_queries:
+            self.stats['dropped'] += 1
+            return
+
+        request = self._parse_request(data)
+        if request is None:
+            return
+        task = self._start_upstream(request, addr[0], start_time)
+        task.add_done_callback(lambda t: self._send_udp_reply(t, transport, data, request, addr))
+
+    def _start_upstream(self, request, client_ip, start_time):
+        """Create the task forwarding a cache miss, counted in inflight until it is done"""
+        self.inflight += 1
+        task = self.loop.create_task(self._resolve_upstream(request, client_ip, start_time))
+        task.add_done_callback(self._upstream_done)
+        return task
+
+    def _upstream_done(self, task):
+        """Release the inflight slot of a finished or cancelled upstream task"""
+        self.inflight -= 1
+
+    def _send_udp_reply(self, task, transport, data, request, addr):
+        """Send the reply for a query resolved in the worker pool"""
+        if task.cancelled() or transport.is_closing():
+            return
+        transport.sendto(self._fit_udp(data, self._pack(request, task.result())), addr)
+
+    async def _handle_tcp_connection(self, reader, writer):
+        """Read length-prefixed queries and answer them as they complete
+
+        Queries on one connection are pipelined: each is resolved
+        concurrently and replies may be written out of order (RFC 7766).
+        """
+        client_ip = writer.get_extra_info('peername')[0]
+        pending = set()
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(reader.readexactly(2), self.tcp_idle_timeout)
+                    length = struct.unpack('!H', header)[0]
+                    data = await asyncio.wait_for(reader.readexactly(length), self.tcp_idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        asyncio.CancelledError, ConnectionError):
+                    break
+
+                self.stats['tcp_queries'] += 1
+                question = self._parse_question(data)
+                if question is None:
+                    break
+
+                # Stop reading while this connection has a full pipeline
+                if len(pending) >= TCP_PIPELINE_DEPTH:
+                    await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                task = self.loop.create_task(self._answer_tcp(data, question, client_ip, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _answer_tcp(self, data, question, client_ip, writer):
+        """Resolve one TCP query and write its framed reply"""
+        start_time = time.time()
+        rdata = self._resolve_local(data, question, client_ip, start_time)
+        if rdata is None:
+            request = self._parse_request(data)
+            if request is None:
+                return
+            if self.inflight >= self.max_concurrent_queries:
+                self.stats['dropped'] += 1
+                reply = self._error_reply(request)
+            else:
+                reply = await self._start_upstream(request, client_ip, start_time)
+            rdata = self._pack(request, reply)
+
+        if not writer.is_closing():
+            writer.write(struct.pack('!H', len(rdata)) + rdata)
+            await writer.drain()
+
+    def _parse_question(self, data):
+        """Read the question of a wire-format query, returning None for garbage"""
+        question = dns_wire.parse_question(data)
+        if question is None:
+            self.stats['errors'] += 1
+        return question
+
+    def _parse_request(self, data):
+        """Parse a wire-format query, returning None for garbage"""
+        try:
+            request = DNSRecord.parse(data)
+            if not request.questions:
+                return None
+            return request
+        except Exception:
+            self.stats['errors'] += 1
+            return None
+
+    def _resolve_local(self, data, question, client_ip, start_time):
+        """Blocklist and cache lookup on the event loop; returns reply bytes or None"""
+        try:
+            return self.resolver.resolve_local_wire(data, question, client_ip, start_time)
+        except Exception as e:
+            print(f"Error resolving DNS query: {e}")
+            self.stats['errors'] += 1
+            request = self._parse_request(data)
+            if request is None:
+                return None
+            return self._pack(request, self._error_reply(request))
+
+    async def _resolve_upstream(self, request, client_ip, start_time):
+        """Forward a cache miss from the worker pool"""
+        try:
+            return await self.loop.run_in_executor(
+                self.executor, self.resolver.resolve_upstream, request, client_ip, start_time)
+        except Exception as e:
+            print(f"Error resolving DNS query: {e}")
+            self.stats['errors'] += 1
+            return self._error_reply(request)
+
+    def _error_reply(self, request):
+        """Create a SERVFAIL reply"""
+        reply = request.reply()
+        reply.header.rcode = RCODE.SERVFAIL
+        return reply
+
+    def _pack(self, request, reply):
+        """Pack a reply carrying the client's transaction ID
+
+        Replies shared between coalesced queries carry the ID of the query
+        that went upstream, so the ID is patched in the wire bytes.
+        """
+        return dns_wire.set_id(reply.pack(), request.header.id)
+
+    def _fit_udp(self, data, rdata):
+        """Truncate a packed reply to the UDP payload size the query allows"""
+        if len(rdata) > dns_wire.udp_payload_size(data):
+            self.stats['truncated'] += 1
+            rdata = DNSRecord.parse(rdata).truncate().pack()
+        return rdata
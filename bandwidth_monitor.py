@@ -58,78 +58,93 @@ class BandwidthMonitor:
             try:
                 since_timestamp = int(time.time()) - (hours * 3600)
                 
-                conn = self.database._get_connection()
-                
-                # Basic query counts
-                cursor = conn.execute('''
-                    SELECT 
-                        COUNT(*) as total,
-                        SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked,
-                        SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END) as cached,
-                        SUM(bytes_saved) as total_bytes_saved,
-                        AVG(response_time) as avg_response_time
-                    FROM queries 
-                    WHERE timestamp > ?
-                ''', (since_timestamp,))
-                
-                stats = cursor.fetchone()
-                total_queries = stats[0] or 0
-                blocked_queries = stats[1] or 0
-                cached_queries = stats[2] or 0
-                total_bytes_saved = stats[3] or 0
-                avg_response_time = stats[4] or 0
-                
-                # Calculate bandwidth metrics
-                estimated_normal_bandwidth = total_queries * self.DNS_RESPONSE_SIZE
-                bandwidth_from_blocking = blocked_queries * self.BLOCKED_REQUEST_SAVINGS
-                bandwidth_from_caching = cached_queries * self.CACHED_RESPONSE_SAVINGS
-                total_bandwidth_saved = bandwidth_from_blocking + bandwidth_from_caching + total_bytes_saved
+                with self.database._get_connection() as conn:
+                    rollups = self.database.rollups
+                    if rollups is not None:
+                        total_queries, blocked_queries, cached_queries, total_bytes_saved, response_time = \
+                            rollups.totals(conn, since_timestamp)
+                        avg_response_time = response_time / total_queries if total_queries else 0
+                    else:
+                        # Basic query counts
+                        cursor = conn.execute(f'''
+                            SELECT 
+                                COUNT(*) as total,
+                                SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked,
+                                SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END) as cached,
+                                SUM(bytes_saved) as total_bytes_saved,
+                                AVG(response_time) as avg_response_time
+                            FROM {self.database.partitions.source(since_timestamp)} 
+                            WHERE timestamp > ?
+                        ''', (since_timestamp,))
+                    
+                        stats = cursor.fetchone()
+                        total_queries = stats[0] or 0
+                        blocked_queries = stats[1] or 0
+                        cached_queries = stats[2] or 0
+                        total_bytes_saved = stats[3] or 0
+                        avg_response_time = stats[4] or 0
                 
-                # Calculate total potential bandwidth usage
-                estimated_total_bandwidth = estimated_normal_bandwidth + bandwidth_from_blocking
+                    # Calculate bandwidth metrics
+                    estimated_normal_bandwidth = total_queries * self.DNS_RESPONSE_SIZE
+                    bandwidth_from_blocking = blocked_queries * self.BLOCKED_REQUEST_SAVINGS
+                    bandwidth_from_caching = cached_queries * self.CACHED_RESPONSE_SAVINGS
+                    total_bandwidth_saved = bandwidth_from_blocking + bandwidth_from_caching + total_bytes_saved
                 
-                # Calculate savings percentage
-                if estimated_total_bandwidth > 0:
-                    savings_percentage = (total_bandwidth_saved / estimated_total_bandwidth) * 100
-                else:
-                    savings_percentage = 0
+                    # Calculate total potential bandwidth usage
+                    estimated_total_bandwidth = estimated_normal_bandwidth + bandwidth_from_blocking
                 
-                # Top bandwidth-saving domains
-                cursor = conn.execute('''
-                    SELECT domain, COUNT(*) as count, SUM(bytes_saved) as saved
-                    FROM queries 
-                    WHERE timestamp > ? AND (blocked = 1 OR cached = 1)
-                    GROUP BY domain 
-                    ORDER BY saved DESC, count DESC
-                    LIMIT 10
-                ''', (since_timestamp,))
+                    # Calculate savings percentage
+                    if estimated_total_bandwidth > 0:
+                        savings_percentage = (total_bandwidth_saved / estimated_total_bandwidth) * 100
+                    else:
+                        savings_percentage = 0
                 
-                top_saving_domains = [
-                    {
-                        'domain': row[0], 
-                        'requests': row[1], 
-                        'bytes_saved': row[2] or 0
-                    } for row in cursor.fetchall()
-                ]
+                    # Top bandwidth-saving domains
+                    sketches = self.database.sketches
+                    window = sketches.window(since_timestamp) if sketches is not None else None
+                    if window is not None:
+                        rows = window.top_saving_domains(10)
+                    elif rollups is not None:
+                        rows = rollups.top_saving_domains(conn, since_timestamp, 10)
+                    else:
+                        domains = self.database.partitions.domain_source(
+                            since_timestamp, {'count': 'COUNT(*)', 'saved': 'SUM(bytes_saved)'},
+                            '(blocked = 1 OR cached = 1)')
+                        rows = conn.execute(f'''
+                            SELECT d.name, top.count, top.saved
+                            FROM (
+                                SELECT domain_id, count, saved FROM {domains} 
+                                ORDER BY saved DESC, count DESC
+                                LIMIT 10
+                            ) top
+                            JOIN query_domains d ON d.id = top.domain_id
+                            ORDER BY top.saved DESC, top.count DESC
+                        ''').fetchall()
                 
-                conn.close()
+                    top_saving_domains = [
+                        {
+                            'domain': row[0], 
+                            'requests': row[1], 
+                            'bytes_saved': row[2] or 0
+                        } for row in rows
+                    ]
                 
-                return {
-                    'total_queries': total_queries,
-                    'blocked_queries': blocked_queries,
-                    'cached_queries': cached_queries,
-                    'total_bandwidth_saved': total_bandwidth_saved,
-                    'estimated_total_bandwidth': estimated_total_bandwidth,
-                    'bandwidth_savings_percent': round(savings_percentage, 2),
-                    'avg_response_time': round(avg_response_time, 2),
-                    'bandwidth_efficiency': {
-                        'dns_overhead': estimated_normal_bandwidth,
-                        'blocked_savings': bandwidth_from_blocking,
-                        'cache_savings': bandwidth_from_caching,
-                        'additional_savings': total_bytes_saved
-                    },
-                    'top_saving_domains': top_saving_domains
-                }
+                    return {
+                        'total_queries': total_queries,
+                        'blocked_queries': blocked_queries,
+                        'cached_queries': cached_queries,
+                        'total_bandwidth_saved': total_bandwidth_saved,
+                        'estimated_total_bandwidth': estimated_total_bandwidth,
+                        'bandwidth_savings_percent': round(savings_percentage, 2),
+                        'avg_response_time': round(avg_response_time, 2),
+                        'bandwidth_efficiency': {
+                            'dns_overhead': estimated_normal_bandwidth,
+                            'blocked_savings': bandwidth_from_blocking,
+                            'cache_savings': bandwidth_from_caching,
+                            'additional_savings': total_bytes_saved
+                        },
+                        'top_saving_domains': top_saving_domains
+                    }
                 
             except Exception as e:
                 print(f"Error calculating bandwidth stats: {e}")
@@ -141,49 +156,52 @@ class BandwidthMonitor:
             try:
                 since_timestamp = int(time.time()) - (hours * 3600)
                 
-                conn = self.database._get_connection()
-                cursor = conn.execute('''
-                    SELECT 
-                        (timestamp / 3600) * 3600 as hour_timestamp,
-                        COUNT(*) as total_queries,
-                        SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked,
-                        SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END) as cached,
-                        SUM(bytes_saved) as bytes_saved
-                    FROM queries 
-                    WHERE timestamp > ?
-                    GROUP BY hour_timestamp
-                    ORDER BY hour_timestamp
-                ''', (since_timestamp,))
+                with self.database._get_connection() as conn:
+                    rollups = self.database.rollups
+                    if rollups is not None:
+                        rows = rollups.hourly(conn, since_timestamp)
+                    else:
+                        rows = conn.execute(f'''
+                            SELECT 
+                                (timestamp / 3600) * 3600 as hour_timestamp,
+                                COUNT(*) as total_queries,
+                                SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked,
+                                SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END) as cached,
+                                SUM(bytes_saved) as bytes_saved
+                            FROM {self.database.partitions.source(since_timestamp)} 
+                            WHERE timestamp > ?
+                            GROUP BY hour_timestamp
+                            ORDER BY hour_timestamp
+                        ''', (since_timestamp,)).fetchall()
                 
-                hourly_data = []
-                for row in cursor.fetchall():
-                    hour_timestamp = int(row[0])
-                    total_queries = row[1]
-                    blocked = row[2] or 0
-                    cached = row[3] or 0
-                    bytes_saved = row[4] or 0
+                    hourly_data = []
+                    for row in rows:
+                        hour_timestamp = int(row[0])
+                        total_queries = row[1]
+                        blocked = row[2] or 0
+                        cached = row[3] or 0
+                        bytes_saved = row[4] or 0
                     
-                    # Calculate bandwidth for this hour
-                    normal_bandwidth = total_queries * self.DNS_RESPONSE_SIZE
-                    blocked_savings = blocked * self.BLOCKED_REQUEST_SAVINGS
-                    cached_savings = cached * self.CACHED_RESPONSE_SAVINGS
-                    total_savings = blocked_savings + cached_savings + bytes_saved
+                        # Calculate bandwidth for this hour
+                        normal_bandwidth = total_queries * self.DNS_RESPONSE_SIZE
+                        blocked_savings = blocked * self.BLOCKED_REQUEST_SAVINGS
+                        cached_savings = cached * self.CACHED_RESPONSE_SAVINGS
+                        total_savings = blocked_savings + cached_savings + bytes_saved
                     
-                    hourly_data.append({
-                        'timestamp': hour_timestamp,
-                        'hour': datetime.fromtimestamp(hour_timestamp).strftime('%H:%M'),
-                        'date': datetime.fromtimestamp(hour_timestamp).strftime('%Y-%m-%d'),
-                        'total_queries': total_queries,
-                        'blocked': blocked,
-                        'cached': cached,
-                        'allowed': total_queries - blocked,
-                        'bandwidth_used': normal_bandwidth,
-                        'bandwidth_saved': total_savings,
-                        'savings_percent': round((total_savings / max(normal_bandwidth + blocked_savings, 1)) * 100, 2)
-                    })
+                        hourly_data.append({
+                            'timestamp': hour_timestamp,
+                            'hour': datetime.fromtimestamp(hour_timestamp).strftime('%H:%M'),
+                            'date': datetime.fromtimestamp(hour_timestamp).strftime('%Y-%m-%d'),
+                            'total_queries': total_queries,
+                            'blocked': blocked,
+                            'cached': cached,
+                            'allowed': total_queries - blocked,
+                            'bandwidth_used': normal_bandwidth,
+                            'bandwidth_saved': total_savings,
+                            'savings_percent': round((total_savings / max(normal_bandwidth + blocked_savings, 1)) * 100, 2)
+                        })
                 
-                conn.close()
-                return hourly_data
+                    return hourly_data
                 
             except Exception as e:
                 print(f"Error getting hourly bandwidth stats: {e}")
@@ -195,47 +213,44 @@ class BandwidthMonitor:
             try:
                 since_timestamp = int(time.time()) - (24 * 3600)  # Last 24 hours
                 
-                conn = self.database._get_connection()
-                cursor = conn.execute('''
-                    SELECT 
-                        COUNT(*) as total_requests,
-                        SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked_requests,
-                        SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END) as cached_requests,
-                        SUM(bytes_saved) as total_bytes_saved,
-                        AVG(response_time) as avg_response_time
-                    FROM queries 
-                    WHERE timestamp > ? AND domain = ?
-                ''', (since_timestamp, domain))
-                
-                stats = cursor.fetchone()
-                if not stats or stats[0] == 0:
-                    conn.close()
-                    return None
+                with self.database._get_connection() as conn:
+                    cursor = conn.execute(f'''
+                        SELECT 
+                            COUNT(*) as total_requests,
+                            SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END) as blocked_requests,
+                            SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END) as cached_requests,
+                            SUM(bytes_saved) as total_bytes_saved,
+                            AVG(response_time) as avg_response_time
+                        FROM {self.database.partitions.source(since_timestamp)} 
+                        WHERE timestamp > ? AND domain_id = (SELECT id FROM query_domains WHERE name = ?)
+                    ''', (since_timestamp, domain))
                 
-                total_requests = stats[0]
-                blocked_requests = stats[1] or 0
-                cached_requests = stats[2] or 0
-                bytes_saved = stats[3] or 0
-                avg_response_time = stats[4] or 0
+                    stats = cursor.fetchone()
+                    if not stats or stats[0] == 0:
+                        return None
                 
-                # Calculate impact
-                estimated_savings = self.calculate_bandwidth_savings(domain, 
-                                                                   blocked=blocked_requests > 0, 
-                                                                   cached=cached_requests > 0)
-                total_impact = (blocked_requests * self.BLOCKED_REQUEST_SAVINGS) + \
-                              (cached_requests * self.CACHED_RESPONSE_SAVINGS) + bytes_saved
+                    total_requests = stats[0]
+                    blocked_requests = stats[1] or 0
+                    cached_requests = stats[2] or 0
+                    bytes_saved = stats[3] or 0
+                    avg_response_time = stats[4] or 0
                 
-                conn.close()
+                    # Calculate impact
+                    estimated_savings = self.calculate_bandwidth_savings(domain, 
+                                                                       blocked=blocked_requests > 0, 
+                                                                       cached=cached_requests > 0)
+                    total_impact = (blocked_requests * self.BLOCKED_REQUEST_SAVINGS) + \
+                                  (cached_requests * self.CACHED_RESPONSE_SAVINGS) + bytes_saved
                 
-                return {
-                    'domain': domain,
-                    'total_requests': total_requests,
-                    'blocked_requests': blocked_requests,
-                    'cached_requests': cached_requests,
-                    'bandwidth_saved': total_impact,
-                    'avg_response_time': round(avg_response_time, 2),
-                    'efficiency_score': round((total_impact / max(total_requests * self.DNS_RESPONSE_SIZE, 1)) * 100, 2)
-                }
+                    return {
+                        'domain': domain,
+                        'total_requests': total_requests,
+                        'blocked_requests': blocked_requests,
+                        'cached_requests': cached_requests,
+                        'bandwidth_saved': total_impact,
+                        'avg_response_time': round(avg_response_time, 2),
+                        'efficiency_score': round((total_impact / max(total_requests * self.DNS_RESPONSE_SIZE, 1)) * 100, 2)
+                    }
                 
             except Exception as e:
                 print(f"Error analyzing domain bandwidth impact: {e}")
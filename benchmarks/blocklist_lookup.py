@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Blocklist Lookup Benchmark
+Compares SuffixIndex with the previous split-and-join set lookup
+
+Builds a synthetic blocklist of N registrable domains and subdomains,
+then times is_blocked-style lookups separately for exact blocked names,
+subdomains of blocked names and names that are not blocked (the bulk
+of real traffic).
+
+Usage: python benchmarks/blocklist_lookup.py [--sizes 1000000,5000000] [--lookups N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from domain_index import SuffixIndex
+
+TLDS = ["com", "net", "org", "io", "de", "co.uk", "info", "xyz"]
+
+class SetLookup:
+    """The lookup as it was before the suffix index"""
+
+    def __init__(self, domains):
+        self.blocked_domains = domains
+        self.lock = threading.RLock()
+
+    def contains(self, domain):
+        with self.lock:
+            domain = domain.lower()
+            if domain in self.blocked_domains:
+                return True
+            parts = domain.split('.')
+            for i in range(len(parts)):
+                parent_domain = '.'.join(parts[i:])
+                if parent_domain in self.blocked_domains:
+                    return True
+            return False
+
+class IndexLookup:
+    """The current is_blocked path"""
+
+    def __init__(self, domains):
+        self.index = SuffixIndex(domains)
+        self.lock = threading.RLock()
+
+    def contains(self, domain):
+        with self.lock:
+            return self.index.contains(domain.lower())
+
+def make_domains(count, rng):
+    """Blocked names: a mix of registrable domains and deeper hosts"""
+    domains = set()
+    while len(domains) < count:
+        base = f"{rng.getrandbits(40):x}.{rng.choice(TLDS)}"
+        if rng.random() < 0.5:
+            base = f"{rng.choice(['ads', 'track', 'cdn', 'pixel'])}{rng.randrange(100)}.{base}"
+        domains.add(base)
+    return domains
+
+def make_queries(domains, count, rng):
+    """Query lists of exact blocked names, subdomains of blocked names and clean names"""
+    sample = rng.sample(sorted(domains), min(len(domains), count))
+    # Fresh string objects, like names parsed from packets, with no cached hash
+    exact = [sample[i % len(sample)].encode().decode() for i in range(count)]
+    subdomains = [f"www.img.{name}" for name in exact]
+    clean = [f"www.{rng.getrandbits(40):x}.{rng.choice(TLDS)}" for _ in range(count)]
+    return {"exact": exact, "subdomain": subdomains, "not blocked": clean}
+
+def time_lookups(lookup, queries, repeat=3):
+    """Best lookups per second over the query list"""
+    contains = lookup.contains
+    best = 0.0
+    for _ in range(repeat):
+        names = [name.encode().decode() for name in queries]
+        start = time.perf_counter()
+        for name in names:
+            contains(name)
+        best = max(best, len(names) / (time.perf_counter() - start))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="1000000,5000000")
+    parser.add_argument("--lookups", type=int, default=200000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    for size in (int(size) for size in args.sizes.split(",")):
+        domains = make_domains(size, rng)
+        queries = make_queries(domains, args.lookups, rng)
+
+        start = time.perf_counter()
+        index_lookup = IndexLookup(domains)
+        build = time.perf_counter() - start
+        set_lookup = SetLookup(domains)
+
+        for name in queries["exact"][:1000] + queries["not blocked"][:1000]:
+            assert index_lookup.contains(name) == set_lookup.contains(name)
+
+        print(f"{size} blocked domains (index built in {build:.2f}s, "
+              f"{len(index_lookup.index.interior)} interior suffixes), lookups/s:")
+        print(f"{'':>16}" + "".join(f"{kind:>14}" for kind in queries))
+        for label, lookup in (("split/join set", set_lookup), ("suffix index", index_lookup)):
+            rates = "".join(f"{time_lookups(lookup, names):14.0f}" for names in queries.values())
+            print(f"{label:>16}{rates}")
+        del domains, index_lookup, set_lookup
+
+if __name__ == "__main__":
+    main()
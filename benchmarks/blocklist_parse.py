@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Blocklist Parse Benchmark
+Compares the streaming blocklist parser with the previous line-by-line parser
+
+Writes a synthetic list of N lines mixing hosts, AdBlock and plain-domain
+entries with comments and blank lines, then reports parse throughput
+(lines/s) and peak traced memory, in total and on top of the resulting
+set, for the previous per-line parser (over a whole downloaded body, as
+remote lists were parsed, and over the open file, as local lists were)
+and for the streaming parser.
+
+Usage: python benchmarks/blocklist_parse.py [--lines 2000000] [--keep FILE]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from blocklist_parser import parse_file
+
+class LineParser:
+    """The parser as it was before blocklist_parser"""
+
+    def parse_line(self, line):
+        if not line or line.startswith('#') or line.startswith('!'):
+            return None
+        if line.startswith('||') and line.endswith('^'):
+            return line[2:-1]
+        if line.startswith(('0.0.0.0', '127.0.0.1')):
+            parts = line.split()
+            if len(parts) >= 2:
+                return parts[1]
+        if self.is_valid_domain(line):
+            return line
+        return None
+
+    def is_valid_domain(self, domain):
+        if not domain or len(domain) > 253:
+            return False
+        domain_regex = re.compile(
+            r'^(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+'
+            r'[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?$'
+        )
+        return bool(domain_regex.match(domain))
+
+    def parse_body(self, filepath):
+        """Remote lists: response.text, then splitlines()"""
+        with open(filepath, 'r', encoding='utf-8') as f:
+            text = f.read()
+        domains = set()
+        for line in text.splitlines():
+            domain = self.parse_line(line.strip())
+            if domain:
+                domains.add(domain.lower())
+        return domains
+
+    def parse_lines(self, filepath):
+        """Local lists: iterate over the open file"""
+        domains = set()
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                domain = self.parse_line(line.strip())
+                if domain:
+                    domains.add(domain.lower())
+        return domains
+
+def write_list(path, count, rng):
+    """Synthetic list in the proportions of common public lists"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(count):
+            roll = rng.random()
+            domain = f"{rng.choice(['ads', 'track', 'cdn'])}{rng.randrange(100)}.{rng.getrandbits(40):x}.com"
+            if roll < 0.05:
+                f.write("# comment\n")
+            elif roll < 0.07:
+                f.write("\n")
+            elif roll < 0.40:
+                f.write(f"0.0.0.0 {domain}\n")
+            elif roll < 0.70:
+                f.write(f"||{domain}^\n")
+            else:
+                f.write(f"{domain}\n")
+
+def measure(parse, path, repeat=3):
+    """Best wall time over repeat runs, then traced memory of one run
+
+    Returns the peak and the part of it on top of the resulting set,
+    which is what the parser itself needed.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        domains = parse(path)
+        best = min(best, time.perf_counter() - start)
+        del domains
+    tracemalloc.start()
+    domains = parse(path)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, peak - retained, domains
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--lines", type=int, default=2000000)
+    parser.add_argument("--keep", help="write the synthetic list here and keep it")
+    args = parser.parse_args()
+
+    path = args.keep or os.path.join(tempfile.mkdtemp(), "blocklist.txt")
+    write_list(path, args.lines, random.Random(1))
+    size = os.path.getsize(path)
+    print(f"{args.lines} lines, {size / 1e6:.1f} MB")
+
+    legacy = LineParser()
+    expected = None
+    print(f"{'':>22}{'lines/s':>12}{'seconds':>10}{'peak MB':>10}{'parser MB':>11}")
+    for label, parse in (("line parser, body", legacy.parse_body),
+                         ("line parser, file", legacy.parse_lines),
+                         ("streaming parser", parse_file)):
+        seconds, peak, transient, domains = measure(parse, path)
+        if expected is None:
+            expected = domains
+        assert domains == expected
+        print(f"{label:>22}{args.lines / seconds:12.0f}{seconds:10.2f}{peak / 1e6:10.1f}{transient / 1e6:11.1f}")
+        del domains
+
+    if not args.keep:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+if __name__ == "__main__":
+    main()
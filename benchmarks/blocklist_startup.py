@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Blocklist Startup Benchmark
+Compares parsing blocklists at startup with mapping a compiled index file
+
+For N blocked domains, times what startup used to do (parse the list
+file and build a SuffixIndex), compiling that index into an index file
+once, and opening the file with MappedSuffixIndex, which is what a
+restart does while no source has changed. Lookup rates of both indexes
+are shown for names that are not blocked, subdomains of blocked names
+and exact blocked names, along with the size, false positive rate and
+speed of the Bloom filter stored in the index file on its own.
+
+Usage: python benchmarks/blocklist_startup.py [--sizes 1000000,3000000] [--lookups N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from blocklist_parser import parse_file
+from domain_index import MappedSuffixIndex, SuffixIndex, source_fingerprint, write_index
+
+class FilterOnly:
+    """The Bloom filter check MappedSuffixIndex makes before any exact probe"""
+
+    def __init__(self, bloom):
+        self.bloom = bloom
+
+    def contains(self, name):
+        key = name.encode()
+        might_contain = self.bloom.might_contain
+        if might_contain(key):
+            return True
+        pos = key.find(b'.')
+        while pos != -1:
+            if might_contain(key[pos + 1:]):
+                return True
+            pos = key.find(b'.', pos + 1)
+        return False
+
+TLDS = ["com", "net", "org", "io", "de", "co.uk", "info", "xyz"]
+
+def write_list(path, count, rng):
+    """Hosts-format list of registrable domains and deeper hosts"""
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(count):
+            domain = f"{rng.getrandbits(40):x}.{rng.choice(TLDS)}"
+            if rng.random() < 0.5:
+                domain = f"{rng.choice(['ads', 'track', 'cdn', 'pixel'])}{rng.randrange(100)}.{domain}"
+            f.write(f"0.0.0.0 {domain}\n")
+
+def time_lookups(index, names, repeat=3):
+    """Best lookups per second over the names"""
+    contains = index.contains
+    best = 0.0
+    for _ in range(repeat):
+        fresh = [name.encode().decode() for name in names]
+        start = time.perf_counter()
+        for name in fresh:
+            contains(name)
+        best = max(best, len(fresh) / (time.perf_counter() - start))
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="1000000,3000000")
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    workdir = tempfile.mkdtemp()
+    list_path = os.path.join(workdir, "list.txt")
+    index_path = os.path.join(workdir, "blocklist.idx")
+    try:
+        for size in (int(size) for size in args.sizes.split(",")):
+            write_list(list_path, size, rng)
+
+            # Traced separately: tracemalloc slows allocation down
+            tracemalloc.start()
+            index = SuffixIndex(parse_file(list_path))
+            index_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del index
+
+            start = time.perf_counter()
+            index = SuffixIndex(parse_file(list_path))
+            parse_time = time.perf_counter() - start
+
+            fingerprint = source_fingerprint([(list_path, size)])
+            start = time.perf_counter()
+            write_index(index, index_path, fingerprint)
+            compile_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            mapped = MappedSuffixIndex.open(index_path, fingerprint)
+            open_time = time.perf_counter() - start
+
+            sample = rng.sample(sorted(index.blocked), min(len(index), args.lookups))
+            queries = {
+                "not blocked": [f"www.{rng.getrandbits(40):x}.{rng.choice(TLDS)}"
+                                for _ in range(args.lookups)],
+                "subdomain": [f"www.img.{name}" for name in sample],
+                "exact": sample,
+            }
+            for names in queries.values():
+                for name in names[:1000]:
+                    assert mapped.contains(name) == index.contains(name)
+            filter_only = FilterOnly(mapped.bloom)
+            false_positives = sum(map(filter_only.contains, queries["not blocked"]))
+
+            print(f"{len(index)} blocked domains, {len(index.interior)} interior suffixes")
+            print(f"  parse + build SuffixIndex  {parse_time:8.2f} s   {index_memory / 1e6:8.1f} MB traced")
+            print(f"  compile index file         {compile_time:8.2f} s   "
+                  f"{os.path.getsize(index_path) / 1e6:8.1f} MB on disk")
+            print(f"  open MappedSuffixIndex     {open_time * 1000:8.2f} ms")
+            print(f"  Bloom filter               {mapped.bloom.nbytes / 1e6:8.1f} MB   "
+                  f"{false_positives / len(queries['not blocked']):8.2%} of clean names pass")
+            print(f"  lookups/s {'':>16}" + "".join(f"{kind:>14}" for kind in queries))
+            for label, lookup in (("SuffixIndex", index), ("MappedSuffixIndex", mapped),
+                                  ("Bloom filter only", filter_only)):
+                rates = "".join(f"{time_lookups(lookup, names):14.0f}" for names in queries.values())
+                print(f"  {label:>24}{rates}")
+            del index, mapped, filter_only
+    finally:
+        for path in (list_path, index_path):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+DNS Cache Benchmark
+Compares the sharded DNSCache with the previous single-lock cache
+
+Measures memory per entry with tracemalloc and cache-hit throughput
+from several threads, for each eviction policy. The single-lock cache
+is reproduced below as it was before sharding: one OrderedDict of dict
+entries behind one RLock.
+
+Usage: python benchmarks/cache_bench.py [--entries N] [--lookups N] [--threads 1,4,8] [--policies lru,tinylfu]
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dnslib import DNSRecord, RR, A
+import dns_wire
+from dns_cache import DNSCache
+
+class SingleLockCache:
+    """The cache layout before sharding, reduced to its hit and insert paths"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def lookup_wire(self, key, txid):
+        with self.lock:
+            entry = self.cache.get(key)
+            current_time = time.time()
+            if entry is None or current_time >= entry['expires']:
+                self.stats['misses'] += 1
+                return None, False
+            self.cache.move_to_end(key)
+            self.stats['hits'] += 1
+            entry['hits'] += 1
+            age = current_time - entry['created']
+            data = entry['wire']
+            offsets = entry['ttl_offsets']
+        return dns_wire.patch_reply(data, txid, offsets, age=int(age)), False
+
+    def set(self, key, response, ttl):
+        data = response.pack()
+        offsets = dns_wire.ttl_offsets(data)
+        with self.lock:
+            current_time = time.time()
+            if key in self.cache:
+                del self.cache[key]
+            self.cache[key] = {
+                'wire': data,
+                'ttl_offsets': offsets,
+                'expires': current_time + ttl,
+                'stale_until': current_time + ttl,
+                'created': current_time,
+                'ttl': ttl,
+                'hits': 0,
+                'refreshing': False
+            }
+            while len(self.cache) > self.max_size:
+                del self.cache[next(iter(self.cache))]
+                self.stats['evictions'] += 1
+        return True
+
+class PackedReply:
+    """Stands in for a DNSRecord whose wire form is already known"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def pack(self):
+        return self.data
+
+def make_replies(count):
+    """Yield (key, reply) for count distinct single-A-record answers"""
+    template_name = "host%07d.example" % 0
+    reply = DNSRecord.question(template_name).reply()
+    reply.add_answer(RR(template_name, rdata=A("192.0.2.1"), ttl=3600))
+    template = reply.pack()
+    marker = template_name.split('.')[0].encode()
+    for i in range(count):
+        label = b"host%07d" % i
+        yield f"host{i:07d}.example:A", PackedReply(template.replace(marker, label))
+
+def fill(cache, count):
+    for key, reply in make_replies(count):
+        cache.set(key, reply, ttl=3600)
+
+def measure_memory(factory, entries):
+    """Bytes allocated per cached entry"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = factory(entries)
+    fill(cache, entries)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / entries
+
+def measure_hits(cache, keys, threads, lookups):
+    """Total cache hits per second across the given number of threads"""
+    per_thread = lookups // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        sample = [rng.choice(keys) for _ in range(per_thread)]
+        lookup = cache.lookup_wire
+        barrier.wait()
+        for key in sample:
+            lookup(key, 1234)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=400000)
+    parser.add_argument("--threads", default="1,4,8")
+    parser.add_argument("--shards", type=int, default=16)
+    parser.add_argument("--policies", default="lru,tinylfu")
+    args = parser.parse_args()
+    thread_counts = [int(n) for n in args.threads.split(",")]
+
+    implementations = [("single-lock", lambda size: SingleLockCache(size))]
+    for policy in args.policies.split(","):
+        implementations.append((f"{policy}/{args.shards}",
+                                lambda size, policy=policy: DNSCache(size, shards=args.shards,
+                                                                     eviction_policy=policy)))
+
+    print(f"Memory per entry at {args.entries} entries")
+    for label, factory in implementations:
+        print(f"{label:>16}: {measure_memory(factory, args.entries):8.1f} bytes")
+
+    hot_keys = 10000
+    print(f"\nCache hit throughput, {args.lookups} lookups over {hot_keys} keys")
+    for label, factory in implementations:
+        # Room to spare, so uneven shards evict nothing and every lookup hits
+        cache = factory(2 * hot_keys)
+        fill(cache, hot_keys)
+        keys = [key for key, _ in make_replies(hot_keys)]
+        results = "  ".join(f"{threads} thr {measure_hits(cache, keys, threads, args.lookups):9.0f}/s"
+                            for threads in thread_counts)
+        print(f"{label:>16}: {results}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Cache Policy Trace Replay
+Reports the hit rate of each eviction policy on a recorded query stream
+
+The trace is read from the `queries` table of a DNS Filter database (or
+a CSV export of it with domain and query_type columns) in timestamp
+order. Blocked queries are skipped since they never reach the cache.
+Every policy replays the same keys at several cache sizes; record TTLs
+are not modelled, so the numbers isolate eviction decisions.
+
+Without a trace the replay falls back to a synthetic one: a Zipf-like
+working set interrupted by bursts of unique names, like a client
+scanning or random-subdomain tracker beacons.
+
+Usage: python benchmarks/cache_policy_replay.py [--db dns_filter.db | --csv queries.csv] [--sizes 1000,10000]
+"""
+
+import argparse
+import csv
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cache_policy import POLICIES
+
+def load_db_trace(path):
+    """Cache keys of non-blocked queries, oldest first"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = conn.execute(
+            "SELECT domain, query_type FROM queries WHERE blocked = 0 ORDER BY timestamp, id")
+        return [f"{domain.lower()}:{qtype}" for domain, qtype in cursor]
+    finally:
+        conn.close()
+
+def load_csv_trace(path):
+    """Cache keys from a CSV export with domain and query_type columns"""
+    with open(path, newline='', encoding='utf-8') as f:
+        return [f"{row['domain'].lower()}:{row['query_type']}" for row in csv.DictReader(f)
+                if row.get('blocked', '0') in ('0', '', 'False')]
+
+def synthetic_trace(length, names=50000, scan_every=20000, scan_length=5000, seed=1):
+    """Zipf-distributed lookups with periodic scans of one-off names"""
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(names)]
+    popular = rng.choices(range(names), weights=weights, k=length)
+    trace = []
+    scans = 0
+    for i, rank in enumerate(popular):
+        if i and i % scan_every == 0:
+            scans += 1
+            trace.extend(f"{scans}-{n}.scan.example:A" for n in range(scan_length))
+        trace.append(f"host{rank}.example:A")
+    return trace
+
+def replay(policy_class, trace, size):
+    """Run a trace through one policy; returns the hit rate in percent"""
+    policy = policy_class(size)
+    hits = 0
+    for key in trace:
+        if policy.get(key) is not None:
+            policy.on_hit(key)
+            hits += 1
+        else:
+            policy.on_miss(key)
+            policy.put(key, True)
+    return hits / len(trace) * 100 if trace else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--db", help="DNS Filter database to read the queries table from")
+    parser.add_argument("--csv", help="CSV export of the queries table")
+    parser.add_argument("--sizes", default="1000,5000,20000")
+    parser.add_argument("--synthetic-length", type=int, default=500000)
+    args = parser.parse_args()
+
+    trace = []
+    if args.csv:
+        trace = load_csv_trace(args.csv)
+        source = args.csv
+    elif args.db:
+        trace = load_db_trace(args.db)
+        source = args.db
+    if not trace:
+        trace = synthetic_trace(args.synthetic_length)
+        source = "synthetic Zipf trace with scans"
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    print(f"{len(trace)} lookups, {len(set(trace))} distinct keys ({source})")
+    print(f"{'policy':>10}" + "".join(f"{size:>12}" for size in sizes))
+    for name, policy_class in POLICIES.items():
+        rates = "".join(f"{replay(policy_class, trace, size):11.2f}%" for size in sizes)
+        print(f"{name:>10}{rates}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+DNS Front End Load Benchmark
+Compares the asyncio listener with the dnslib threaded server
+
+Both servers run the real DNSFilterResolver against a temporary database,
+a small blocklist and a pre-warmed cache, so the numbers cover the front
+end plus filtering and caching without any upstream traffic.
+
+Usage: python benchmarks/dns_load.py [--queries N] [--clients N]
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dnslib import DNSRecord, RR, A
+from dnslib.server import DNSServer as DNSLibServer, DNSLogger
+from async_dns_server import AsyncDNSServer
+from blocklist_manager import BlocklistManager
+from config import Config
+from database import Database
+from dns_server import DNSFilterResolver
+from domain_index import SuffixIndex
+
+def build_resolver(tmp, names):
+    """Create a resolver with a warm cache and a few blocked names"""
+    config = Config(os.path.join(tmp, "config.json"))
+    config.cache_size = 100000
+    database = Database(os.path.join(tmp, "bench.db"))
+    database.initialize()
+    blocklist_manager = BlocklistManager(database)
+    blocklist_manager.index = SuffixIndex(f"blocked{i}.example" for i in range(100))
+
+    resolver = DNSFilterResolver(config, database, blocklist_manager)
+    for name in names:
+        reply = DNSRecord.question(name).reply()
+        reply.add_answer(RR(name, rdata=A("192.0.2.1"), ttl=3600))
+        resolver.cache.set(f"{name}:A", reply, ttl=3600)
+    return database, resolver
+
+async def run_clients(port, names, total_queries, clients):
+    """Send queries from concurrent UDP clients and collect latencies"""
+    loop = asyncio.get_running_loop()
+    latencies = []
+    per_client = total_queries // clients
+
+    async def client(index):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect(("127.0.0.1", port))
+        try:
+            for i in range(per_client):
+                name = names[(index + i) % len(names)]
+                packet = DNSRecord.question(name).pack()
+                start = time.perf_counter()
+                await loop.sock_sendall(sock, packet)
+                try:
+                    await asyncio.wait_for(loop.sock_recv(sock, 4096), 1.0)
+                except asyncio.TimeoutError:
+                    continue
+                latencies.append(time.perf_counter() - start)
+        finally:
+            sock.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+def report(label, latencies, elapsed, total_queries):
+    """Print QPS and latency percentiles"""
+    if not latencies:
+        print(f"{label:>10}: no answers received")
+        return
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print(f"{label:>10}: {len(latencies) / elapsed:10.0f} qps  "
+          f"p50 {p50:6.3f} ms  p99 {p99:6.3f} ms  "
+          f"answered {len(latencies)}/{total_queries}  "
+          f"mean {statistics.mean(latencies) * 1000:.3f} ms")
+
+def bench_threaded(resolver, names, args):
+    """Benchmark the dnslib socketserver front end"""
+    server = DNSLibServer(resolver, port=0, address="127.0.0.1", tcp=False,
+                          logger=DNSLogger(logf=lambda s: None))
+    server.start_thread()
+    port = server.server.server_address[1]
+    try:
+        latencies, elapsed = asyncio.run(run_clients(port, names, args.queries, args.clients))
+    finally:
+        server.stop()
+    report("threaded", latencies, elapsed, args.queries)
+
+def bench_async(resolver, names, args):
+    """Benchmark the asyncio front end"""
+    server = AsyncDNSServer(resolver, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    while server.udp_transport is None:
+        time.sleep(0.01)
+    try:
+        latencies, elapsed = asyncio.run(run_clients(server.port, names, args.queries, args.clients))
+    finally:
+        server.stop()
+        thread.join(2)
+    report("asyncio", latencies, elapsed, args.queries)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=32)
+    args = parser.parse_args()
+
+    names = [f"host{i}.example" for i in range(1000)] + [f"blocked{i}.example" for i in range(100)]
+    with tempfile.TemporaryDirectory() as tmp:
+        database, resolver = build_resolver(tmp, names)
+        try:
+            print(f"{args.queries} queries from {args.clients} concurrent UDP clients")
+            bench_threaded(resolver, names, args)
+            bench_async(resolver, names, args)
+        finally:
+            database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Query Retention Benchmark
+Compares query log retention by DELETE on one table with dropping day partitions
+
+Writes N synthetic queries spread over the retention period plus a few
+extra days, once into a single queries table with the covering indexes
+and once through Database into per-day partitions. Then removes the
+rows older than the retention period: with DELETE ... WHERE timestamp
+< ? on the single table, as cleanup_old_queries used to, and with
+cleanup_old_queries dropping whole partitions. The time each takes is
+the time every log write waits for the database write lock. A window
+of the last 24 hours is also read from both layouts.
+
+Usage: python benchmarks/query_retention.py [--rows 5000000] [--days 30] [--expired-days 2]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database
+
+def generate(rows, days, now, chunk=100000):
+    """Chunks of synthetic rows over the days before now, oldest first"""
+    rng = random.Random(1)
+    domains = [f"{rng.choice(['www', 'api', 'cdn', 'ads'])}.{rng.getrandbits(32):x}.com"
+               for _ in range(50000)]
+    span = days * 86400
+    for start in range(0, rows, chunk):
+        batch = []
+        for i in range(start, min(start + chunk, rows)):
+            blocked = rng.random() < 0.15
+            cached = not blocked and rng.random() < 0.3
+            batch.append((now - span + i * span // rows, domains[int(50000 * rng.random() ** 3)],
+                          'A', '192.168.1.2', int(blocked), int(cached), 5.0,
+                          1024 if blocked else 50 if cached else 0))
+        yield batch
+
+def fill_single(path, args, now):
+    """One queries table with the indexes it had before partitioning"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('''
+        CREATE TABLE queries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER NOT NULL,
+            domain TEXT NOT NULL,
+            query_type TEXT NOT NULL,
+            client_ip TEXT NOT NULL,
+            blocked INTEGER DEFAULT 0,
+            cached INTEGER DEFAULT 0,
+            response_time REAL DEFAULT 0,
+            bytes_saved INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_queries_stats '
+                 'ON queries(timestamp, blocked, cached, domain, bytes_saved, response_time)')
+    conn.execute('CREATE INDEX idx_queries_domain_time ON queries(domain, timestamp)')
+    for batch in generate(args.rows, args.days + args.expired_days, now):
+        conn.executemany('''
+            INSERT INTO queries (timestamp, domain, query_type, client_ip, blocked, cached,
+                                 response_time, bytes_saved)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+        conn.commit()
+    return conn
+
+def fill_partitioned(path, args, now):
+    """The same rows written through Database into day partitions"""
+    database = Database(path, stats_rollups=False, stats_sketch_hours=0)
+    database.initialize()
+    database.log_writer.stop()
+    for batch in generate(args.rows, args.days + args.expired_days, now):
+        database.partitions.prepare(batch)
+        with database.connections.writer() as conn:
+            database.partitions.insert(conn, batch)
+    return database
+
+def window_time(conn, source, repeat=3):
+    """Best time to summarise the last 24 hours"""
+    since = int(time.time()) - 24 * 3600
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(f'SELECT COUNT(*), SUM(blocked), SUM(cached), SUM(bytes_saved) '
+                     f'FROM {source} WHERE timestamp > ?', (since,)).fetchone()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--expired-days", type=int, default=2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    single_path = os.path.join(workdir, "single.db")
+    partitioned_path = os.path.join(workdir, "partitioned.db")
+    try:
+        # Both layouts get identical timestamps
+        now = int(time.time())
+        single = fill_single(single_path, args, now)
+        database = fill_partitioned(partitioned_path, args, now)
+        print(f"{args.rows} queries over {args.days + args.expired_days} days, "
+              f"keeping {args.days}")
+
+        # Same cutoff for both: the start of the oldest day kept
+        cutoff = int(time.time()) - args.days * 86400
+        cutoff -= cutoff % 86400
+
+        start = time.perf_counter()
+        with single:
+            deleted = single.execute('DELETE FROM queries WHERE timestamp < ?', (cutoff,)).rowcount
+        delete_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dropped = database.cleanup_old_queries(args.days)
+        drop_time = time.perf_counter() - start
+        assert dropped == deleted, (dropped, deleted)
+
+        with database.connections.reader() as partitions:
+            print(f"  {'':<34}{'seconds':>10}{'rows':>10}")
+            print(f"  {'DELETE on one table':<34}{delete_time:10.3f}{deleted:10}")
+            print(f"  {'drop day partitions':<34}{drop_time:10.3f}{dropped:10}")
+            print(f"  {'last 24 hours, one table':<34}{window_time(single, 'queries'):10.3f}")
+            since = int(time.time()) - 24 * 3600
+            print(f"  {'last 24 hours, partitions':<34}"
+                  f"{window_time(partitions, database.partitions.source(since)):10.3f}")
+            single.close()
+            database.close()
+    finally:
+        for path in (single_path, partitioned_path):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        os.rmdir(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Query Schema Benchmark
+Compares the size and GROUP BY domain speed of text and dictionary-id query log rows
+
+Writes N synthetic queries over the last 24 hours twice, in batches
+as the log writer does: into a partition that stores domain, query
+type and client address as text (the layout before the dictionary
+tables) with its covering indexes, and through Database into
+partitions holding ids interned by QueryNames. Reports the bytes each
+logged query takes in the tables and indexes, the write time per
+batch, and the time to find the top domains, top blocked domains and
+distinct-domain count of the 24 hours, checking both give the same
+answers.
+
+Usage: python benchmarks/query_schema.py [--rows 2000000] [--domains 50000] [--clients 40]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database
+
+QUERY_TYPES = ('A', 'A', 'A', 'AAAA', 'AAAA', 'HTTPS', 'PTR', 'TXT')
+
+def generate(rows, domain_count, client_count, start, rng, batch_size=500):
+    """Batches of (timestamp, domain, ...) rows over the 24 hours from start, oldest first"""
+    domains = [f"{rng.choice(['www', 'api', 'cdn', 'ads'])}.{rng.getrandbits(32):x}.com"
+               for _ in range(domain_count)]
+    clients = [f"192.168.1.{i}" for i in range(1, client_count)] + ['fd00::1a2b:3c4d:5e6f:7']
+    batch = []
+    for i in range(rows):
+        blocked = rng.random() < 0.15
+        cached = not blocked and rng.random() < 0.3
+        batch.append((start + i * (24 * 3600 - 1) // rows, domains[int(domain_count * rng.random() ** 3)],
+                      rng.choice(QUERY_TYPES), rng.choice(clients), int(blocked), int(cached),
+                      rng.random() * 40, 1024 if blocked else 50 if cached else 0))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def fill_text(path, batches):
+    """One partition with text columns and the indexes it had; returns seconds per batch"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('''
+        CREATE TABLE queries_text (
+            id INTEGER PRIMARY KEY,
+            timestamp INTEGER NOT NULL,
+            domain TEXT NOT NULL,
+            query_type TEXT NOT NULL,
+            client_ip TEXT NOT NULL,
+            blocked INTEGER DEFAULT 0,
+            cached INTEGER DEFAULT 0,
+            response_time REAL DEFAULT 0,
+            bytes_saved INTEGER DEFAULT 0
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_queries_text_stats '
+                 'ON queries_text(timestamp, blocked, cached, domain, bytes_saved, response_time)')
+    conn.execute('CREATE INDEX idx_queries_text_domain_time ON queries_text(domain, timestamp)')
+    elapsed = 0
+    count = 0
+    for batch in batches:
+        start = time.perf_counter()
+        with conn:
+            conn.executemany('''
+                INSERT INTO queries_text (timestamp, domain, query_type, client_ip, blocked, cached,
+                                          response_time, bytes_saved)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+        elapsed += time.perf_counter() - start
+        count += 1
+    return conn, elapsed / count
+
+def fill_ids(path, batches):
+    """The same rows through Database into id partitions; returns seconds per batch"""
+    database = Database(path, stats_rollups=False, stats_sketch_hours=0)
+    database.initialize()
+    database.log_writer.stop()
+    elapsed = 0
+    count = 0
+    for batch in batches:
+        start = time.perf_counter()
+        database.partitions.prepare(batch)
+        with database.connections.writer() as conn:
+            database.partitions.insert(conn, batch)
+        elapsed += time.perf_counter() - start
+        count += 1
+    return database, elapsed / count
+
+def sizes(conn):
+    """Bytes in the query log tables, their indexes and the dictionaries"""
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    totals = {'rows': 0, 'indexes': 0, 'dictionaries': 0}
+    for name, table, kind, size in conn.execute('''
+        SELECT m.name, m.tbl_name, m.type, SUM(s.pgsize) FROM dbstat s
+        JOIN sqlite_master m ON m.name = s.name
+        GROUP BY m.name
+    '''):
+        if table.startswith('query_'):
+            totals['dictionaries'] += size
+        elif table.startswith('queries_'):
+            totals['indexes' if kind == 'index' else 'rows'] += size
+    return totals
+
+def best_of(call, repeat=3):
+    """Best wall time of call and its last result"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--domains", type=int, default=50000)
+    parser.add_argument("--clients", type=int, default=40)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    text_path = os.path.join(workdir, "text.db")
+    ids_path = os.path.join(workdir, "ids.db")
+    try:
+        # Both layouts get identical rows
+        start = int(time.time()) - 24 * 3600 + 1
+        text, text_write = fill_text(text_path, generate(args.rows, args.domains, args.clients,
+                                                         start, random.Random(1)))
+        database, ids_write = fill_ids(ids_path, generate(args.rows, args.domains, args.clients,
+                                                          start, random.Random(1)))
+        text.execute('ANALYZE')
+        with database.connections.writer() as conn:
+            conn.execute('ANALYZE')
+        with database.connections.reader() as ids:
+            since = int(time.time()) - 24 * 3600
+
+            def from_text():
+                top = ('SELECT domain, COUNT(*) AS c FROM queries_text WHERE timestamp > ? {} '
+                       'GROUP BY +domain ORDER BY c DESC, domain LIMIT 10')
+                return (text.execute(top.format(''), (since,)).fetchall(),
+                        text.execute(top.format('AND blocked = 1'), (since,)).fetchall(),
+                        text.execute('SELECT COUNT(DISTINCT domain) FROM queries_text WHERE timestamp > ?',
+                                     (since,)).fetchone()[0])
+
+            def from_ids():
+                counts = database._query_counts_raw(ids, since)
+                return ([tuple(row) for row in counts[5]], [tuple(row) for row in counts[4]], counts[3])
+
+            print(f"{args.rows} queries, {args.domains} domains, {args.clients} clients in 24 hours")
+            print(f"  {'':<34}{'text':>12}{'ids':>12}")
+            text_sizes = sizes(text)
+            ids_sizes = sizes(ids)
+            for label in ('rows', 'indexes', 'dictionaries'):
+                print(f"  {label + ' (bytes per query)':<34}"
+                      f"{text_sizes[label] / args.rows:12.1f}{ids_sizes[label] / args.rows:12.1f}")
+            text_total = sum(text_sizes.values()) / args.rows
+            ids_total = sum(ids_sizes.values()) / args.rows
+            print(f"  {'total (bytes per query)':<34}{text_total:12.1f}{ids_total:12.1f}"
+                  f"   {1 - ids_total / text_total:.0%} smaller")
+            print(f"  {'write per 500-row batch (ms)':<34}{text_write * 1000:12.2f}{ids_write * 1000:12.2f}")
+            text_time, text_result = best_of(from_text)
+            ids_time, ids_result = best_of(from_ids)
+            print(f"  {'top domains, blocked, distinct (s)':<34}{text_time:12.3f}{ids_time:12.3f}"
+                  f"   {text_time / ids_time:.1f}x")
+            # Ties in the top 10 may be ordered differently; compare the counts
+            same = ([row[1] for row in text_result[0]] == [row[1] for row in ids_result[0]] and
+                    [row[1] for row in text_result[1]] == [row[1] for row in ids_result[1]] and
+                    text_result[2] == ids_result[2])
+            print(f"  same answers: {'yes' if same else 'NO'}")
+            text.close()
+            database.close()
+    finally:
+        for path in (text_path, ids_path):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        os.rmdir(workdir)
+
+if __name__ == "__main__":
+    main()
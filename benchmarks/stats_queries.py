@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Stats Query Benchmark
+Times the raw-table stats queries with the previous and the covering indexes
+
+Fills a single queries table, as the log was stored before it was
+partitioned, with N synthetic rows spread over the retention period.
+Then runs get_query_stats, get_hourly_stats and the bandwidth monitor's
+detailed and hourly stats (with rollups and sketches disabled, so they
+read the query log) twice: as the statements they used to run on that
+table with the previous single-column indexes and separate COUNT(*)
+scans, and after Database.initialize() has moved it into per-day
+partitions with covering indexes and dictionary ids, using the
+single-pass summary. Every statement that runs is captured and its
+query plan printed; the partitioned layout is checked to answer all of
+them from an index without reading the table rows.
+
+Usage: python benchmarks/stats_queries.py [--rows 10000000] [--days 30] [--hours 24]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bandwidth_monitor import BandwidthMonitor
+from database import Database
+
+LEGACY_INDEXES = (
+    'CREATE INDEX idx_queries_timestamp ON queries(timestamp)',
+    'CREATE INDEX idx_queries_domain ON queries(domain)',
+    'CREATE INDEX idx_queries_blocked ON queries(blocked)',
+)
+
+class LegacyQueryStats:
+    """The statements the stats ran on the single queries table"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def get_query_stats(self, hours=24):
+        with self.database.connections.reader() as conn:
+            since = int(time.time()) - hours * 3600
+            counts = [conn.execute(sql, (since,)).fetchone()[0] for sql in (
+                'SELECT COUNT(*) FROM queries WHERE timestamp > ?',
+                'SELECT COUNT(*) FROM queries WHERE timestamp > ? AND blocked = 1',
+                'SELECT COUNT(*) FROM queries WHERE timestamp > ? AND cached = 1',
+                'SELECT COUNT(DISTINCT domain) FROM queries WHERE timestamp > ?',
+                'SELECT SUM(bytes_saved) FROM queries WHERE timestamp > ?',
+            )]
+            for blocked in (' AND blocked = 1', ''):
+                conn.execute(f'''
+                    SELECT domain, COUNT(*) as count FROM queries
+                    WHERE timestamp > ?{blocked}
+                    GROUP BY domain ORDER BY count DESC LIMIT 10
+                ''', (since,)).fetchall()
+            return counts
+
+    def get_hourly_stats(self, hours=24):
+        since = int(time.time()) - hours * 3600
+        with self.database.connections.reader() as conn:
+            return conn.execute('''
+                SELECT (timestamp / 3600) * 3600 as hour_timestamp, COUNT(*), SUM(blocked)
+                FROM queries WHERE timestamp > ?
+                GROUP BY hour_timestamp ORDER BY hour_timestamp
+            ''', (since,)).fetchall()
+
+    def get_detailed_stats(self, hours=24):
+        with self.database.connections.reader() as conn:
+            since = int(time.time()) - hours * 3600
+            return (conn.execute('''
+                SELECT COUNT(*), SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END), SUM(bytes_saved), AVG(response_time)
+                FROM queries WHERE timestamp > ?
+            ''', (since,)).fetchone(), conn.execute('''
+                SELECT domain, COUNT(*) as count, SUM(bytes_saved) as saved
+                FROM queries WHERE timestamp > ? AND (blocked = 1 OR cached = 1)
+                GROUP BY domain ORDER BY saved DESC, count DESC LIMIT 10
+            ''', (since,)).fetchall())
+
+    def get_hourly_bandwidth_stats(self, hours=24):
+        since = int(time.time()) - hours * 3600
+        with self.database.connections.reader() as conn:
+            return conn.execute('''
+                SELECT (timestamp / 3600) * 3600 as hour_timestamp, COUNT(*),
+                       SUM(CASE WHEN blocked = 1 THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN cached = 1 THEN 1 ELSE 0 END), SUM(bytes_saved)
+                FROM queries WHERE timestamp > ?
+                GROUP BY hour_timestamp ORDER BY hour_timestamp
+            ''', (since,)).fetchall()
+
+def fill(path, rows, days, rng):
+    """Write rows synthetic queries over the last days into one unindexed queries table"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('''
+        CREATE TABLE queries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER NOT NULL,
+            domain TEXT NOT NULL,
+            query_type TEXT NOT NULL,
+            client_ip TEXT NOT NULL,
+            blocked INTEGER DEFAULT 0,
+            cached INTEGER DEFAULT 0,
+            response_time REAL DEFAULT 0,
+            bytes_saved INTEGER DEFAULT 0
+        )
+    ''')
+    domains = [f"{rng.choice(['www', 'api', 'cdn', 'ads'])}.{rng.getrandbits(32):x}.com"
+               for _ in range(50000)]
+    clients = [f"192.168.1.{i}" for i in range(1, 40)]
+    now = int(time.time())
+    span = days * 86400
+    chunk = 100000
+    for start in range(0, rows, chunk):
+        batch = []
+        for _ in range(min(chunk, rows - start)):
+            # Skewed towards popular domains, as real traffic is
+            domain = domains[int(len(domains) * rng.random() ** 3)]
+            blocked = rng.random() < 0.15
+            cached = not blocked and rng.random() < 0.3
+            batch.append((now - rng.randrange(span), domain, 'A', rng.choice(clients),
+                          int(blocked), int(cached), rng.random() * 40,
+                          1024 if blocked else 50 if cached else 0))
+        conn.executemany('''
+            INSERT INTO queries (timestamp, domain, query_type, client_ip, blocked, cached,
+                                 response_time, bytes_saved)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+        conn.commit()
+    conn.close()
+
+def set_indexes(path, legacy):
+    """Index the single table as before, or let Database partition it with covering indexes"""
+    start = time.perf_counter()
+    if legacy:
+        conn = sqlite3.connect(path)
+        for sql in LEGACY_INDEXES:
+            conn.execute(sql)
+        conn.commit()
+        conn.close()
+    else:
+        database = Database(path, stats_rollups=False, stats_sketch_hours=0)
+        database.initialize()
+        database.close()
+    conn = sqlite3.connect(path)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+    return time.perf_counter() - start
+
+def run(database, calls, repeat):
+    """Best time of each call and the statements it ran"""
+    with database.connections.reader() as conn:
+        results = []
+        for label, call in calls:
+            call()
+            statements = []
+            conn.set_trace_callback(statements.append)
+            call()
+            conn.set_trace_callback(None)
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                call()
+                best = min(best, time.perf_counter() - start)
+            plans = []
+            for sql in statements:
+                if sql.lstrip().upper().startswith('SELECT'):
+                    plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+                    plans.append([row[3] for row in plan])
+            results.append((label, best, plans))
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=10000000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "queries.db")
+    start = time.perf_counter()
+    fill(path, args.rows, args.days, random.Random(1))
+    print(f"{args.rows} rows written in {time.perf_counter() - start:.1f} s")
+
+    timings = {}
+    covered = True
+    for legacy in (True, False):
+        layout = "single table, previous indexes" if legacy else "day partitions, covering indexes"
+        build_time = set_indexes(path, legacy)
+        print(f"\n{layout}: built in {build_time:.1f} s, "
+              f"database {os.path.getsize(path) / 1e6:.0f} MB")
+        database = Database(path, stats_rollups=False, stats_sketch_hours=0)
+        if legacy:
+            query_stats = monitor = LegacyQueryStats(database)
+        else:
+            query_stats = database
+            monitor = BandwidthMonitor(database)
+            monitor.monitoring = False
+        calls = [
+            ("get_query_stats", lambda: query_stats.get_query_stats(args.hours)),
+            ("get_hourly_stats", lambda: query_stats.get_hourly_stats(args.hours)),
+            ("get_detailed_stats", lambda: monitor.get_detailed_stats(args.hours)),
+            ("get_hourly_bandwidth_stats", lambda: monitor.get_hourly_bandwidth_stats(args.hours)),
+        ]
+        for label, seconds, plans in run(database, calls, args.repeat):
+            timings.setdefault(label, []).append(seconds)
+            print(f"  {label:<28}{seconds * 1000:10.1f} ms  {len(plans)} statements")
+            for plan in plans:
+                print(f"      {' / '.join(plan)}")
+                if not legacy and not any("COVERING INDEX" in step for step in plan):
+                    covered = False
+        database.close()
+
+    print(f"\n{'':<30}{'previous':>10}{'covering':>10}{'speedup':>10}")
+    for label, (before, after) in timings.items():
+        print(f"  {label:<28}{before * 1000:8.1f}ms{after * 1000:8.1f}ms{before / after:9.1f}x")
+    print(f"\nEvery statement answered from a covering index: {'yes' if covered else 'NO'}")
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.rmdir(os.path.dirname(path))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Top Domains Benchmark
+Compares top-K and distinct-domain answers from the in-memory sketches with GROUP BY queries
+
+Writes N synthetic queries over the last 24 hours, drawn from a long
+tail of distinct domains, into a queries table and its rollups. The
+same queries are streamed into QuerySketches, timing the cost that
+adds to logging each query. Then the top domains, top blocked, top
+bandwidth-saving domains and distinct-domain count of the last 24
+hours are answered from the sketches, from the per-hour rollups and
+from the raw table, with the sketch answers checked against the exact
+ones.
+
+Usage: python benchmarks/top_domains.py [--rows 2000000] [--domains 200000] [--keep FILE]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database
+from stats_sketch import QuerySketches
+
+def generate(rows, domain_count, rng):
+    """(timestamp, domain, ...) rows over the last 24 hours, oldest first"""
+    domains = [f"{rng.choice(['www', 'api', 'cdn', 'ads'])}.{rng.getrandbits(32):x}.com"
+               for _ in range(domain_count)]
+    now = int(time.time())
+    start = now - 24 * 3600 + 1
+    batch = []
+    for i in range(rows):
+        domain = domains[int(domain_count * rng.random() ** 4)]
+        blocked = rng.random() < 0.15
+        cached = not blocked and rng.random() < 0.3
+        batch.append((start + i * (24 * 3600 - 1) // rows, domain, 'A', '192.168.1.2',
+                      int(blocked), int(cached), 5.0, 1024 if blocked else 50 if cached else 0))
+    return batch
+
+def best_of(call, repeat=5):
+    """Best wall time of call and its last result"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = call()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--domains", type=int, default=200000)
+    parser.add_argument("--keep", help="build the table in this file and keep it")
+    args = parser.parse_args()
+
+    path = args.keep or os.path.join(tempfile.mkdtemp(), "queries.db")
+    rows = generate(args.rows, args.domains, random.Random(1))
+    since = int(time.time()) - 24 * 3600
+
+    sketches = QuerySketches(hours=24)
+    sketches.seed([], since)
+    add = sketches.add
+    start = time.perf_counter()
+    for timestamp, domain, _, _, blocked, cached, _, bytes_saved in rows:
+        add(timestamp, domain, blocked, cached, bytes_saved)
+    add_time = (time.perf_counter() - start) / len(rows)
+
+    database = Database(path, stats_sketch_hours=0)
+    database.initialize()
+    database.partitions.prepare(rows)
+    with database.connections.writer() as conn:
+        database.partitions.insert(conn, rows)
+        database.rollups.rebuild(conn)
+    with database.connections.reader() as conn:
+        distinct = len({row[1] for row in rows})
+        del rows
+
+        rollups = database.rollups
+
+        def from_sketches():
+            window = sketches.window(since)
+            return (window.top_domains(10), window.top_domains(10, blocked_only=True),
+                    window.top_saving_domains(10), window.unique_domains())
+
+        def from_rollups():
+            return (rollups.top_domains(conn, since, 10),
+                    rollups.top_domains(conn, since, 10, blocked_only=True),
+                    rollups.top_saving_domains(conn, since, 10),
+                    rollups.unique_domains(conn, since))
+
+        def from_table():
+            source = database.partitions.source(since)
+            top = (f'SELECT d.name, top.c FROM (SELECT domain_id, COUNT(*) AS c FROM {source} '
+                   'WHERE timestamp > ? {} GROUP BY +domain_id ORDER BY c DESC LIMIT 10) top '
+                   'JOIN query_domains d ON d.id = top.domain_id ORDER BY top.c DESC')
+            return (conn.execute(top.format(''), (since,)).fetchall(),
+                    conn.execute(top.format('AND blocked = 1'), (since,)).fetchall(),
+                    conn.execute(f'''
+                        SELECT d.name, top.c, top.s FROM (
+                            SELECT domain_id, COUNT(*) AS c, SUM(bytes_saved) AS s FROM {source}
+                            WHERE timestamp > ? AND (blocked = 1 OR cached = 1)
+                            GROUP BY +domain_id ORDER BY s DESC, c DESC LIMIT 10
+                        ) top JOIN query_domains d ON d.id = top.domain_id ORDER BY top.s DESC, top.c DESC
+                    ''', (since,)).fetchall(),
+                    conn.execute(f'SELECT COUNT(DISTINCT domain_id) FROM {source} WHERE timestamp > ?',
+                                 (since,)).fetchone()[0])
+
+        sources = {"sketches": from_sketches, "rollups": from_rollups, "raw table": from_table}
+
+        print(f"{args.rows} queries, {distinct} distinct domains in 24 hours")
+        print(f"  sketch update per logged query {add_time * 1e6:8.2f} us")
+        # The first window of each hour merges every past hour; later ones reuse that
+        start = time.perf_counter()
+        from_sketches()
+        print(f"  sketches    {(time.perf_counter() - start) * 1000:10.1f} ms for the first call in an hour")
+        results = {}
+        for label, call in sources.items():
+            seconds, results[label] = best_of(call, repeat=5 if label == "sketches" else 2)
+            print(f"  {label:<12}{seconds * 1000:10.1f} ms for top domains, top blocked, top saving, distinct")
+
+        exact = results["raw table"]
+        estimate = results["sketches"]
+        for label, i in (("top domains", 0), ("top blocked", 1), ("top saving", 2)):
+            exact_counts = {row[0]: row[1] for row in exact[i]}
+            overlap = sum(row[0] in exact_counts for row in estimate[i])
+            error = max((abs(row[1] - exact_counts[row[0]]) / exact_counts[row[0]]
+                         for row in estimate[i] if row[0] in exact_counts), default=0)
+            print(f"  {label:<12} {overlap}/10 of the exact top 10, counts within {error:.2%}")
+        print(f"  distinct domains {estimate[3]} estimated, {exact[3]} exact "
+              f"({(estimate[3] - exact[3]) / exact[3]:+.2%})")
+
+        database.close()
+        if not args.keep:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            os.rmdir(os.path.dirname(path))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Blocklist Fetcher
+Concurrent, conditional downloads of remote blocklists
+"""
+
+import codecs
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from blocklist_parser import CHUNK_SIZE, BlocklistParser, parse_file
+
+class FetchResult:
+    """Outcome of fetching one remote blocklist"""
+
+    __slots__ = ('url', 'status', 'domains', 'error')
+
+    UPDATED = 'updated'
+    NOT_MODIFIED = 'not_modified'
+    FAILED = 'failed'
+
+    def __init__(self, url, status, domains=None, error=None):
+        self.url = url
+        self.status = status
+        self.domains = domains
+        self.error = error
+
+class BlocklistFetcher:
+    """Downloads remote blocklists in parallel over pooled HTTP sessions
+
+    The ETag and Last-Modified validators of every list are stored in
+    the remote_blocklists table and sent back as If-None-Match and
+    If-Modified-Since, so an unchanged list costs a 304 instead of a full
+    download. The last body of every list is kept in cache_dir, so a 304
+    can still be served after a restart. Bodies are streamed: each chunk
+    is written to that file and fed to a BlocklistParser as it arrives,
+    so a list is never held in memory as a whole.
+    """
+
+    def __init__(self, database, cache_dir=os.path.join("blocklists", "remote"),
+                 max_workers=4, timeout=30):
+        self.database = database
+        self.cache_dir = cache_dir
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        # Long-lived workers, so each keeps its session's connections open
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix='blocklist-fetch')
+        self._local = threading.local()
+
+    def _session(self):
+        """This thread's keep-alive session"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def cache_path(self, url):
+        """File holding the last downloaded body of a list"""
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()[:24]
+        return os.path.join(self.cache_dir, f"{name}.list")
+
+    def parse_cached(self, url):
+        """Parse the last downloaded body of a list; returns a set or None"""
+        try:
+            return parse_file(self.cache_path(url))
+        except OSError:
+            return None
+
+    def fetch_all(self, urls, have_copy=()):
+        """Fetch every URL concurrently; returns {url: FetchResult}
+
+        Validators are only sent for lists in have_copy or with a cached
+        body on disk, since a 304 is useless without a previous copy.
+        """
+        if not urls:
+            return {}
+        validators = self.database.get_remote_blocklist_validators()
+        futures = {
+            url: self.executor.submit(self.fetch, url, validators.get(url),
+                                      url in have_copy or os.path.exists(self.cache_path(url)))
+            for url in urls
+        }
+        return {url: future.result() for url, future in futures.items()}
+
+    def fetch(self, url, validators=None, conditional=True):
+        """Fetch one list, conditionally when validators are known"""
+        headers = {}
+        if conditional and validators:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        try:
+            with self._session().get(url, headers=headers, timeout=self.timeout,
+                                     stream=True) as response:
+                if response.status_code == 304:
+                    self.database.update_remote_blocklist_validators(url, *validators)
+                    return FetchResult(url, FetchResult.NOT_MODIFIED)
+                response.raise_for_status()
+
+                domains = self._download(url, response)
+            self.database.update_remote_blocklist_validators(
+                url, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            return FetchResult(url, FetchResult.UPDATED, domains=domains)
+        except Exception as e:
+            return FetchResult(url, FetchResult.FAILED, error=e)
+
+    def close(self):
+        """Stop the worker threads"""
+        self.executor.shutdown(wait=False)
+
+    def _download(self, url, response):
+        """Stream a body into the cache file and the parser at the same time
+
+        The cache file only replaces the previous copy once the whole
+        body has arrived.
+        """
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        parser = BlocklistParser()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(url)
+        try:
+            with open(f"{path}.tmp", 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    parser.feed(decoder.decode(chunk))
+            os.replace(f"{path}.tmp", path)
+        except BaseException:
+            try:
+                os.remove(f"{path}.tmp")
+            except OSError:
+                pass
+            raise
+        parser.feed(decoder.decode(b'', final=True))
+        return parser.close()
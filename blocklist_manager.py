@@ -4,175 +4,366 @@ Handles loading, updating, and querying of DNS blocklists
 """
 
 import os
-import re
 import threading
-import requests
 import time
+from collections import Counter
 from urllib.parse import urlparse
+from blocklist_fetcher import BlocklistFetcher, FetchResult
+from blocklist_parser import is_valid_domain, parse_file
+from domain_index import MappedSuffixIndex, SuffixIndex, source_fingerprint, write_index
 
 class BlocklistManager:
-    """Manages DNS blocklists for filtering"""
+    """Manages DNS blocklists for filtering
     
-    def __init__(self, database):
+    Every list file and remote list is a source with its own domain set,
+    and refcounts holds how many sources list each domain. A refreshed
+    source is applied to the published index as a delta: domains whose
+    count rises from zero are added, domains whose count drops to zero
+    are discarded. Domains blocked or unblocked by hand are stored in the
+    custom_domains table and applied on top of the lists.
+    
+    is_blocked never takes a lock: it reads whichever SuffixIndex or
+    MappedSuffixIndex self.index points at. Deltas and edits are applied
+    to it in place under self.lock; a full rebuild makes a complete new
+    index without holding self.lock and publishes it with a single
+    assignment, so queries keep being filtered by the old lists until
+    the new ones are ready.
+    
+    Deltas leave the index file as it was. It is compiled again once
+    compile_threshold domains have changed since it was written, and on
+    close(), so a refresh does not rewrite the whole file.
+    """
+    
+    def __init__(self, database, fetch_workers=4, fetch_timeout=30, index_file="blocklist.idx",
+                 compile_threshold=100000):
         self.database = database
-        self.blocked_domains = set()
+        self.index = SuffixIndex()
+        self.fetcher = BlocklistFetcher(database, max_workers=fetch_workers, timeout=fetch_timeout)
+        # Compiled index reused across restarts until a source changes ("" disables)
+        self.index_file = index_file
+        self.compile_threshold = compile_threshold
+        # Fingerprint of the sources the index file lags behind (None if up to date)
+        self.pending_fingerprint = None
+        # Domains added or removed by deltas since the index file was written
+        self.pending_changes = 0
+        # Domains of every source (file path or URL), None until first parsed
+        self.sources = None
+        # (size, mtime_ns) of each local file when it was parsed
+        self.source_stats = {}
+        # Number of sources listing each domain
+        self.refcounts = Counter()
+        # Manual overrides: domain -> True (blocked) or False (unblocked)
+        self.custom_domains = None
         self.blocklists = []
         self.lock = threading.RLock()
+        self.reload_lock = threading.Lock()
         self.last_update = None
         
     def load_blocklists(self):
-        """Load all configured blocklists"""
-        with self.lock:
+        """Bring the index up to date with all configured blocklists
+        
+        Nothing is parsed if the sources match the compiled index file and
+        none have been parsed in this process yet. Otherwise only sources
+        that changed are parsed and applied as deltas; the first time, all
+        of them are parsed and a new index is built.
+        """
+        with self.reload_lock:
             print("Loading blocklists...")
-            self.blocked_domains.clear()
-            
-            # Load local blocklist files
-            blocklist_dir = "blocklists"
-            if os.path.exists(blocklist_dir):
-                for filename in os.listdir(blocklist_dir):
-                    if filename.endswith('.txt'):
-                        filepath = os.path.join(blocklist_dir, filename)
-                        self._load_local_blocklist(filepath)
+            self._load_custom_domains()
+            local_files = self._local_blocklist_files()
             
-            # Load remote blocklists from database config
+            # Fetch remote blocklists from database config
             remote_lists = self.database.get_remote_blocklists()
-            for url in remote_lists:
-                self._load_remote_blocklist(url)
+            results = self.fetcher.fetch_all(remote_lists, have_copy=self.sources or ())
+            fingerprint = self._source_fingerprint(local_files, remote_lists)
             
+            if self.sources is None:
+                index = self._open_compiled_index(fingerprint)
+                if index is None:
+                    self._rebuild(local_files, remote_lists, results, fingerprint)
+                elif index is self.index:
+                    print("Blocklists unchanged")
+                else:
+                    self._publish(index)
+                    print(f"Loaded {len(index)} blocked domains from {self.index_file}")
+                return
+            
+            if not self._update_sources(local_files, remote_lists, results):
+                print("Blocklists unchanged")
+                return
+            if self.index_file:
+                # The deltas are already live; the file catches up later
+                self.pending_fingerprint = fingerprint
+                if self.pending_changes >= self.compile_threshold:
+                    index = self._compile_index(SuffixIndex(set(self.refcounts)), fingerprint)
+                    if isinstance(index, MappedSuffixIndex):
+                        self._publish(index)
+            print(f"Loaded {len(self.index)} blocked domains")
+    
+    def load_compiled_index(self):
+        """Serve the compiled index file if no local source or cached remote list changed
+        
+        Needs no network access and no parsing, so the DNS server can start
+        right away; load_blocklists() should follow to pick up remote
+        changes. Returns True if the index was loaded.
+        """
+        with self.reload_lock:
+            self._load_custom_domains()
+            remote_lists = self.database.get_remote_blocklists()
+            fingerprint = self._source_fingerprint(self._local_blocklist_files(), remote_lists)
+            index = self._open_compiled_index(fingerprint)
+            if index is None:
+                return False
+            if index is not self.index:
+                self._publish(index)
+            print(f"Loaded {len(index)} blocked domains from {self.index_file}")
+            return True
+    
+    def _rebuild(self, local_files, remote_lists, results, fingerprint):
+        """Parse every source and publish a new index built from all of them"""
+        sources = {}
+        for filepath in local_files:
+            domains = self._load_local_blocklist(filepath)
+            if domains is not None:
+                sources[filepath] = domains
+        for url in remote_lists:
+            domains = self._load_remote_blocklist(url, results[url], None)
+            if domains is not None:
+                sources[url] = domains
+        
+        refcounts = Counter()
+        for domains in sources.values():
+            refcounts.update(domains)
+        
+        # Compile the suffix index used by is_blocked
+        index = self._compile_index(SuffixIndex(set(refcounts)), fingerprint)
+        with self.lock:
+            self.sources = sources
+            self.refcounts = refcounts
+        self._publish(index)
+        print(f"Loaded {len(index)} blocked domains")
+    
+    def save_index(self):
+        """Write the index file if deltas were applied since it was compiled"""
+        with self.reload_lock:
+            if self.pending_fingerprint is None or self.sources is None:
+                return
+            with self.lock:
+                domains = set(self.refcounts)
+            try:
+                write_index(SuffixIndex(domains), self.index_file, self.pending_fingerprint)
+                self.pending_fingerprint = None
+                self.pending_changes = 0
+            except Exception as e:
+                print(f"Error compiling blocklist index {self.index_file}: {e}")
+    
+    def close(self):
+        """Bring the index file up to date and stop the fetcher"""
+        self.save_index()
+        self.fetcher.close()
+    
+    def _update_sources(self, local_files, remote_lists, results):
+        """Apply changed, new and removed sources as deltas; returns how many changed"""
+        changed = 0
+        configured = set(local_files).union(remote_lists)
+        for name in [name for name in self.sources if name not in configured]:
+            self._replace_source(name, None)
+            changed += 1
+        
+        for filepath in local_files:
+            if filepath in self.sources and self._file_stat(filepath) == self.source_stats.get(filepath):
+                continue
+            domains = self._load_local_blocklist(filepath)
+            if domains is not None:
+                self._replace_source(filepath, domains)
+                changed += 1
+        
+        for url in remote_lists:
+            previous = self.sources.get(url)
+            domains = self._load_remote_blocklist(url, results[url], previous)
+            if domains is not None and domains is not previous:
+                self._replace_source(url, domains)
+                changed += 1
+        return changed
+    
+    def _replace_source(self, name, domains):
+        """Swap one source's domain set (None removes it) and apply the difference"""
+        previous = self.sources.get(name, set())
+        added = domains - previous if domains is not None else set()
+        removed = previous - domains if domains is not None else previous
+        
+        with self.lock:
+            index = self.index
+            refcounts = self.refcounts
+            custom = self.custom_domains
+            for domain in added:
+                refcounts[domain] += 1
+                if refcounts[domain] == 1 and custom.get(domain) is not False:
+                    index.add(domain)
+            for domain in removed:
+                refcounts[domain] -= 1
+                if not refcounts[domain]:
+                    del refcounts[domain]
+                    if custom.get(domain) is not True:
+                        index.discard(domain)
+            self.pending_changes += len(added) + len(removed)
+            if domains is None:
+                self.sources.pop(name, None)
+                self.source_stats.pop(name, None)
+            else:
+                self.sources[name] = domains
+        print(f"Applied blocklist {name}: +{len(added)} -{len(removed)} domains")
+    
+    def _publish(self, index):
+        """Apply the manual overrides to a new index and swap it in"""
+        with self.lock:
+            for domain, blocked in self.custom_domains.items():
+                if blocked:
+                    index.add(domain)
+                else:
+                    index.discard(domain)
+            # Publish: readers see either the old or the new index
+            self.index = index
             self.last_update = time.time()
-            print(f"Loaded {len(self.blocked_domains)} blocked domains")
     
-    def _load_local_blocklist(self, filepath):
-        """Load blocklist from local file"""
+    def _load_custom_domains(self):
+        """Read the manual overrides from the database once"""
+        with self.lock:
+            if self.custom_domains is None:
+                self.custom_domains = self.database.get_custom_domains()
+            return self.custom_domains
+    
+    def _local_blocklist_files(self):
+        """Paths of the local blocklist files"""
+        blocklist_dir = "blocklists"
+        if not os.path.exists(blocklist_dir):
+            return []
+        return [os.path.join(blocklist_dir, filename)
+                for filename in sorted(os.listdir(blocklist_dir))
+                if filename.endswith('.txt')]
+    
+    def _file_stat(self, path):
+        """(size, mtime_ns) of a file, None if it is missing"""
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                for line in f:
-                    domain = self._parse_blocklist_line(line.strip())
-                    if domain:
-                        self.blocked_domains.add(domain.lower())
-            print(f"Loaded local blocklist: {filepath}")
-        except Exception as e:
-            print(f"Error loading local blocklist {filepath}: {e}")
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+    
+    def _source_fingerprint(self, local_files, remote_lists):
+        """Fingerprint of the files an index would be built from"""
+        paths = [(path, path) for path in local_files]
+        paths.extend((url, self.fetcher.cache_path(url)) for url in remote_lists)
+        sources = []
+        for name, path in paths:
+            stat = self._file_stat(path)
+            if stat is not None:
+                sources.append((name,) + stat)
+        return source_fingerprint(sources)
+    
+    def _open_compiled_index(self, fingerprint):
+        """The current or on-disk compiled index if it matches fingerprint, else None"""
+        if not self.index_file:
+            return None
+        current = self.index
+        if isinstance(current, MappedSuffixIndex) and current.fingerprint == fingerprint:
+            return current
+        return MappedSuffixIndex.open(self.index_file, fingerprint)
     
-    def _load_remote_blocklist(self, url):
-        """Load blocklist from remote URL"""
+    def _compile_index(self, index, fingerprint):
+        """Write index to the index file and map it, keeping index if that fails"""
+        if not self.index_file:
+            return index
         try:
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
-            
-            for line in response.text.splitlines():
-                domain = self._parse_blocklist_line(line.strip())
-                if domain:
-                    self.blocked_domains.add(domain.lower())
-            
-            print(f"Loaded remote blocklist: {url}")
+            write_index(index, self.index_file, fingerprint)
+            self.pending_fingerprint = None
+            self.pending_changes = 0
+            mapped = MappedSuffixIndex.open(self.index_file, fingerprint)
+            if mapped is not None:
+                return mapped
         except Exception as e:
-            print(f"Error loading remote blocklist {url}: {e}")
+            print(f"Error compiling blocklist index {self.index_file}: {e}")
+        return index
     
-    def _parse_blocklist_line(self, line):
-        """Parse a single line from a blocklist file"""
-        # Skip comments and empty lines
-        if not line or line.startswith('#') or line.startswith('!'):
+    def _load_local_blocklist(self, filepath):
+        """Parse a local blocklist file; returns its domains, or None on error"""
+        try:
+            stat = self._file_stat(filepath)
+            domains = parse_file(filepath)
+            self.source_stats[filepath] = stat
+            print(f"Loaded local blocklist: {filepath}")
+            return domains
+        except Exception as e:
+            print(f"Error loading local blocklist {filepath}: {e}")
             return None
+    
+    def _load_remote_blocklist(self, url, result, previous):
+        """Domains of a fetched remote blocklist
         
-        # Handle different blocklist formats
-        # AdBlock format: ||domain.com^
-        if line.startswith('||') and line.endswith('^'):
-            return line[2:-1]
-        
-        # Hosts file format: 0.0.0.0 domain.com or 127.0.0.1 domain.com
-        if line.startswith(('0.0.0.0', '127.0.0.1')):
-            parts = line.split()
-            if len(parts) >= 2:
-                return parts[1]
-        
-        # Plain domain format
-        if self._is_valid_domain(line):
-            return line
+        Returns previous unchanged if the server reported the list
+        unchanged (304) or the download failed, so it is not parsed again.
+        Without a previous set the body cached on disk is parsed; None
+        means there is no copy of the list at all.
+        """
+        if result.status == FetchResult.UPDATED:
+            print(f"Loaded remote blocklist: {url}")
+            return result.domains
         
-        return None
+        if result.status == FetchResult.FAILED:
+            print(f"Error loading remote blocklist {url}: {result.error}")
+        if previous is None:
+            previous = self.fetcher.parse_cached(url)
+        if result.status == FetchResult.NOT_MODIFIED and previous is not None:
+            print(f"Remote blocklist unchanged: {url}")
+        return previous
     
     def _is_valid_domain(self, domain):
         """Check if string is a valid domain name"""
-        if not domain or len(domain) > 253:
-            return False
-        
-        # Basic domain validation
-        domain_regex = re.compile(
-            r'^(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+'
-            r'[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?$'
-        )
-        return bool(domain_regex.match(domain))
+        return is_valid_domain(domain)
     
     def is_blocked(self, domain):
         """Check if a domain is blocked"""
-        with self.lock:
-            domain = domain.lower()
-            
-            # Check exact match
-            if domain in self.blocked_domains:
-                return True
-            
-            # Check subdomain blocking
-            parts = domain.split('.')
-            for i in range(len(parts)):
-                parent_domain = '.'.join(parts[i:])
-                if parent_domain in self.blocked_domains:
-                    return True
-            
-            return False
+        # Exact match or any parent domain, in one pass over the name
+        return self.index.contains(domain.lower())
     
     def add_domain(self, domain):
         """Add a domain to the blocklist"""
         with self.lock:
             if self._is_valid_domain(domain):
-                self.blocked_domains.add(domain.lower())
-                # Save to local blocklist file
-                self._save_custom_domains()
+                domain = domain.lower()
+                custom = self._load_custom_domains()
+                if custom.get(domain) is not True:
+                    self.database.set_custom_domain(domain, True)
+                    custom[domain] = True
+                self.index.add(domain)
                 return True
             return False
     
     def remove_domain(self, domain):
-        """Remove a domain from the blocklist"""
+        """Remove a domain from the blocklist
+        
+        A domain that a blocklist lists (or might, if the lists have not
+        been parsed in this process) is remembered as unblocked, so it
+        stays unblocked when the lists are reloaded.
+        """
         with self.lock:
             domain = domain.lower()
-            if domain in self.blocked_domains:
-                self.blocked_domains.remove(domain)
-                self._save_custom_domains()
+            if domain in self.index:
+                self.index.discard(domain)
+                custom = self._load_custom_domains()
+                if self.sources is None or domain in self.refcounts:
+                    self.database.set_custom_domain(domain, False)
+                    custom[domain] = False
+                elif custom.pop(domain, None) is not None:
+                    self.database.remove_custom_domain(domain)
                 return True
             return False
     
-    def _save_custom_domains(self):
-        """Save custom domains to a local file"""
-        try:
-            custom_file = "blocklists/custom.txt"
-            os.makedirs("blocklists", exist_ok=True)
-            
-            # Read existing custom domains
-            existing_domains = set()
-            if os.path.exists(custom_file):
-                with open(custom_file, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        domain = line.strip()
-                        if domain and not domain.startswith('#'):
-                            existing_domains.add(domain)
-            
-            # Find domains that were manually added
-            custom_domains = self.blocked_domains - existing_domains
-            
-            # Write custom domains to file
-            if custom_domains:
-                with open(custom_file, 'a', encoding='utf-8') as f:
-                    for domain in sorted(custom_domains):
-                        f.write(f"{domain}\n")
-        except Exception as e:
-            print(f"Error saving custom domains: {e}")
-    
     def get_stats(self):
         """Get blocklist statistics"""
         with self.lock:
             return {
-                'total_blocked_domains': len(self.blocked_domains),
+                'total_blocked_domains': len(self.index),
                 'last_update': self.last_update,
                 'blocklist_count': len(self.blocklists)
             }
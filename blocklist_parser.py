@@ -0,0 +1,96 @@
+"""
+Blocklist Parser
+Streams hosts, AdBlock and plain-domain blocklists into sets of domains
+"""
+
+import re
+
+CHUNK_SIZE = 1 << 20
+
+DOMAIN_PATTERN = re.compile(
+    r'^(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+'
+    r'[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?$'
+)
+
+# Applied to whole lowercased blocks that start and end with a newline,
+# one pattern per format. Each starts with a literal newline so the regex
+# engine can skip ahead to candidate lines instead of trying every
+# position, and a line only matches the pattern of its own format:
+# comments (# and !) and blank lines match none of them.
+ADBLOCK_PATTERN = re.compile(r'\n\|\|([^\n^]+)\^[ \t]*(?=\n)')
+HOSTS_PATTERN = re.compile(r'\n(?:0\.0\.0\.0|127\.0\.0\.1)\S*[ \t]+(\S+)')
+# Labels are 1 to 63 characters and do not start or end with a hyphen,
+# as in DOMAIN_PATTERN; the lookbehind checks the last character without
+# the backtracking an optional group would need
+PLAIN_PATTERN = re.compile(
+    r'\n([a-z0-9][a-z0-9-]{0,62}(?<!-)(?:\.[a-z0-9][a-z0-9-]{0,62}(?<!-))+)[ \t]*(?=\n)'
+)
+LINE_PATTERNS = (ADBLOCK_PATTERN, HOSTS_PATTERN, PLAIN_PATTERN)
+INDENT_PATTERN = re.compile(r'\n[ \t]+')
+
+def is_valid_domain(domain):
+    """Check if string is a valid domain name"""
+    if not domain or len(domain) > 253:
+        return False
+    return DOMAIN_PATTERN.match(domain) is not None
+
+class BlocklistParser:
+    """Incremental blocklist parser fed with arbitrary chunks of text
+
+    Text is only split at the last newline of each chunk; the complete
+    lines are classified and extracted in bulk, and the partial line at
+    the end is carried over to the next chunk. Memory use is bounded by
+    the chunk size, not the size of the list.
+    """
+
+    def __init__(self, domains=None):
+        self.domains = set() if domains is None else domains
+        self.lines = 0
+        # Always starts with the newline that ended the previous block
+        self._tail = '\n'
+
+    def feed(self, chunk):
+        """Parse the complete lines in chunk and keep the rest for later"""
+        text = self._tail + chunk
+        end = text.rfind('\n')
+        if end == 0:
+            self._tail = text
+            return
+        self._tail = text[end:]
+        self._parse_block(text[:end + 1])
+
+    def close(self):
+        """Parse the final line and return the set of domains"""
+        if self._tail != '\n':
+            self.feed('\n')
+        return self.domains
+
+    def _parse_block(self, block):
+        """Extract domains from newline-delimited lines"""
+        self.lines += block.count('\n') - 1
+        block = block.lower()
+        if '\r' in block:
+            block = block.replace('\r', '')
+        if '\n ' in block or '\n\t' in block:
+            block = INDENT_PATTERN.sub('\n', block)
+        domains = self.domains
+        for pattern in LINE_PATTERNS:
+            domains.update(pattern.findall(block))
+
+def parse_text(text, domains=None):
+    """Parse a whole blocklist held in memory"""
+    parser = BlocklistParser(domains)
+    for start in range(0, len(text), CHUNK_SIZE):
+        parser.feed(text[start:start + CHUNK_SIZE])
+    return parser.close()
+
+def parse_file(filepath, domains=None, chunk_size=CHUNK_SIZE):
+    """Parse a blocklist file chunk by chunk"""
+    parser = BlocklistParser(domains)
+    with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    return parser.close()
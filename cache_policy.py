@@ -0,0 +1,246 @@
+"""
+Cache Eviction Policies
+Decide which entries a DNSCache shard keeps when it is full
+"""
+
+from collections import OrderedDict
+
+class LRUPolicy:
+    """Evicts the least recently used entry"""
+
+    name = 'lru'
+
+    def __init__(self, max_size):
+        self.max_size = max(1, max_size)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the value for a key without counting an access"""
+        return self.entries.get(key)
+
+    def on_hit(self, key):
+        """Record a lookup that found the key"""
+        self.entries.move_to_end(key)
+
+    def on_miss(self, key):
+        """Record a lookup for a key that is not cached"""
+
+    def put(self, key, value):
+        """Insert or replace a key; returns the (key, value) pairs evicted"""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        evicted = []
+        while len(self.entries) > self.max_size:
+            evicted.append(self.entries.popitem(last=False))
+        return evicted
+
+    def pop(self, key):
+        """Remove a key, returning its value or None"""
+        return self.entries.pop(key, None)
+
+    def clear(self):
+        """Remove every key"""
+        self.entries.clear()
+
+    def items(self):
+        """List (key, value) pairs, the next eviction first"""
+        return list(self.entries.items())
+
+    def load(self, items):
+        """Fill an empty policy from pairs in items() order
+
+        Returns how many leading pairs did not fit and were left out.
+        """
+        skipped = max(len(items) - self.max_size, 0)
+        self.entries.update(items[skipped:])
+        return skipped
+
+class CountMinSketch:
+    """Approximate access counts for TinyLFU admission
+
+    Four rows of byte counters capped at MAX_COUNT, each indexed by its
+    own 16 bits of the key's hash, so rows are at most 65536 counters
+    wide. After 10 accesses per entry of capacity every counter is
+    halved, so old popularity fades.
+    """
+
+    MAX_COUNT = 15
+    ROWS = 4
+    MAX_WIDTH = 1 << 16
+    HALVE = bytes(count >> 1 for count in range(256))
+
+    def __init__(self, capacity):
+        width = 16
+        while width < capacity and width < self.MAX_WIDTH:
+            width *= 2
+        self.mask = width - 1
+        self.rows = [bytearray(width) for _ in range(self.ROWS)]
+        self.sample_size = 10 * max(1, capacity)
+        self.additions = 0
+
+    def increment(self, key):
+        """Count one access to a key"""
+        h = hash(key)
+        mask = self.mask
+        for row in self.rows:
+            index = h & mask
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+            h >>= 16
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [row.translate(self.HALVE) for row in self.rows]
+            self.additions //= 2
+
+    def frequency(self, key):
+        """Estimated recent access count of a key"""
+        h = hash(key)
+        mask = self.mask
+        count = self.MAX_COUNT
+        for row in self.rows:
+            count = min(count, row[h & mask])
+            h >>= 16
+        return count
+
+class TinyLFUPolicy:
+    """W-TinyLFU: an LRU window in front of a frequency-gated segmented LRU
+
+    New keys enter a small window. A key pushed out of the window only
+    takes the place of the main area's eviction candidate if the sketch
+    has seen it more often, so a burst of one-off names cannot flush the
+    names that are asked for all the time. The main area is split into
+    probation and protected segments; a hit in probation promotes a key.
+    """
+
+    name = 'tinylfu'
+
+    WINDOW_RATIO = 0.01
+    PROTECTED_RATIO = 0.8
+
+    def __init__(self, max_size):
+        self.max_size = max(1, max_size)
+        self.window_size = max(1, int(self.max_size * self.WINDOW_RATIO))
+        self.main_size = self.max_size - self.window_size
+        self.protected_size = int(self.main_size * self.PROTECTED_RATIO)
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.sketch = CountMinSketch(self.max_size)
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def get(self, key):
+        """Return the value for a key without counting an access"""
+        value = self.protected.get(key)
+        if value is None:
+            value = self.probation.get(key)
+            if value is None:
+                value = self.window.get(key)
+        return value
+
+    def on_hit(self, key):
+        """Record a lookup that found the key
+
+        Only keys that can still be compared for admission, those in the
+        window and probation, are counted in the sketch. Hits on protected
+        keys, most hits on a warm cache, cost no more than an LRU hit.
+        """
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return
+        self.sketch.increment(key)
+        self._touch(key)
+
+    def on_miss(self, key):
+        """Record a lookup for a key that is not cached"""
+        self.sketch.increment(key)
+
+    def put(self, key, value):
+        """Insert or replace a key; returns the (key, value) pairs evicted"""
+        for segment in (self.protected, self.probation, self.window):
+            if key in segment:
+                segment[key] = value
+                self._touch(key)
+                return []
+
+        self.window[key] = value
+        if len(self.window) <= self.window_size:
+            return []
+        return self._admit(*self.window.popitem(last=False))
+
+    def pop(self, key):
+        """Remove a key, returning its value or None"""
+        for segment in (self.protected, self.probation, self.window):
+            value = segment.pop(key, None)
+            if value is not None:
+                return value
+        return None
+
+    def clear(self):
+        """Remove every key"""
+        self.window.clear()
+        self.probation.clear()
+        self.protected.clear()
+
+    def items(self):
+        """List (key, value) pairs, roughly the next eviction first"""
+        return (list(self.probation.items()) + list(self.protected.items())
+                + list(self.window.items()))
+
+    def load(self, items):
+        """Fill an empty policy from pairs in items() order
+
+        The newest pairs go to the window, the ones before them to the
+        protected segment and the rest to probation. Returns how many
+        leading pairs did not fit and were left out.
+        """
+        skipped = max(len(items) - self.max_size, 0)
+        items = items[skipped:]
+        window_start = max(len(items) - self.window_size, 0)
+        protected_start = max(window_start - self.protected_size, 0)
+        self.probation.update(items[:protected_start])
+        self.protected.update(items[protected_start:window_start])
+        self.window.update(items[window_start:])
+        return skipped
+
+    def _touch(self, key):
+        """Move a key up within its segment, promoting it out of probation"""
+        if key in self.protected:
+            self.protected.move_to_end(key)
+        elif key in self.probation:
+            self.protected[key] = self.probation.pop(key)
+            if len(self.protected) > self.protected_size:
+                demoted_key, demoted = self.protected.popitem(last=False)
+                self.probation[demoted_key] = demoted
+        elif key in self.window:
+            self.window.move_to_end(key)
+
+    def _admit(self, key, value):
+        """Let a key leaving the window into the main area if it earns a place"""
+        if len(self.probation) + len(self.protected) < self.main_size:
+            self.probation[key] = value
+            return []
+
+        victims = self.probation if self.probation else self.protected
+        if not victims:
+            return [(key, value)]
+        victim_key = next(iter(victims))
+        if self.sketch.frequency(key) <= self.sketch.frequency(victim_key):
+            return [(key, value)]
+
+        victim = victims.pop(victim_key)
+        self.probation[key] = value
+        return [(victim_key, victim)]
+
+POLICIES = {
+    LRUPolicy.name: LRUPolicy,
+    TinyLFUPolicy.name: TinyLFUPolicy
+}
+
+def get_policy(name):
+    """Look up a policy class by name, defaulting to LRU"""
+    return POLICIES.get(name, LRUPolicy)
@@ -25,7 +25,35 @@ class Config:
             "cache_ttl": 300,
             "log_queries": True,
             "enable_blocking": True,
-            "cleanup_days": 30
+            "cleanup_days": 30,
+            "log_queue_size": 100000,
+            "log_batch_size": 500,
+            "log_flush_interval": 1.0,
+            "dns_engine": "asyncio",
+            "max_concurrent_queries": 1024,
+            "upstream_workers": 64,
+            "tcp_enabled": True,
+            "tcp_idle_timeout": 10.0,
+            "upstream_pool_size": 4,
+            "upstream_timeout": 2.0,
+            "upstream_deadline": 5.0,
+            "upstream_strategy": "fastest",
+            "upstream_race_count": 2,
+            "cache_min_ttl": 0,
+            "negative_cache_ttl": 300,
+            "serve_stale": True,
+            "serve_stale_ttl": 86400,
+            "prefetch_threshold": 0.9,
+            "prefetch_min_hits": 3,
+            "cache_shards": 16,
+            "cache_eviction_policy": "tinylfu",
+            "cache_snapshot_file": "dns_cache.snapshot",
+            "cache_snapshot_interval": 300,
+            "blocklist_fetch_workers": 4,
+            "blocklist_fetch_timeout": 30,
+            "blocklist_index_file": "blocklist.idx",
+            "stats_rollups": True,
+            "stats_sketch_hours": 24
         }
         
         if os.path.exists(self.config_file):
@@ -57,7 +85,35 @@ class Config:
                 "cache_ttl": self.cache_ttl,
                 "log_queries": self.log_queries,
                 "enable_blocking": self.enable_blocking,
-                "cleanup_days": self.cleanup_days
+                "cleanup_days": self.cleanup_days,
+                "log_queue_size": self.log_queue_size,
+                "log_batch_size": self.log_batch_size,
+                "log_flush_interval": self.log_flush_interval,
+                "dns_engine": self.dns_engine,
+                "max_concurrent_queries": self.max_concurrent_queries,
+                "upstream_workers": self.upstream_workers,
+                "tcp_enabled": self.tcp_enabled,
+                "tcp_idle_timeout": self.tcp_idle_timeout,
+                "upstream_pool_size": self.upstream_pool_size,
+                "upstream_timeout": self.upstream_timeout,
+                "upstream_deadline": self.upstream_deadline,
+                "upstream_strategy": self.upstream_strategy,
+                "upstream_race_count": self.upstream_race_count,
+                "cache_min_ttl": self.cache_min_ttl,
+                "negative_cache_ttl": self.negative_cache_ttl,
+                "serve_stale": self.serve_stale,
+                "serve_stale_ttl": self.serve_stale_ttl,
+                "prefetch_threshold": self.prefetch_threshold,
+                "prefetch_min_hits": self.prefetch_min_hits,
+                "cache_shards": self.cache_shards,
+                "cache_eviction_policy": self.cache_eviction_policy,
+                "cache_snapshot_file": self.cache_snapshot_file,
+                "cache_snapshot_interval": self.cache_snapshot_interval,
+                "blocklist_fetch_workers": self.blocklist_fetch_workers,
+                "blocklist_fetch_timeout": self.blocklist_fetch_timeout,
+                "blocklist_index_file": self.blocklist_index_file,
+                "stats_rollups": self.stats_rollups,
+                "stats_sketch_hours": self.stats_sketch_hours
             }
         
         try:
@@ -87,5 +143,33 @@ class Config:
             "cache_ttl": self.cache_ttl,
             "log_queries": self.log_queries,
             "enable_blocking": self.enable_blocking,
-            "cleanup_days": self.cleanup_days
+            "cleanup_days": self.cleanup_days,
+            "log_queue_size": self.log_queue_size,
+            "log_batch_size": self.log_batch_size,
+            "log_flush_interval": self.log_flush_interval,
+            "dns_engine": self.dns_engine,
+            "max_concurrent_queries": self.max_concurrent_queries,
+            "upstream_workers": self.upstream_workers,
+            "tcp_enabled": self.tcp_enabled,
+            "tcp_idle_timeout": self.tcp_idle_timeout,
+            "upstream_pool_size": self.upstream_pool_size,
+            "upstream_timeout": self.upstream_timeout,
+            "upstream_deadline": self.upstream_deadline,
+            "upstream_strategy": self.upstream_strategy,
+            "upstream_race_count": self.upstream_race_count,
+            "cache_min_ttl": self.cache_min_ttl,
+            "negative_cache_ttl": self.negative_cache_ttl,
+            "serve_stale": self.serve_stale,
+            "serve_stale_ttl": self.serve_stale_ttl,
+            "prefetch_threshold": self.prefetch_threshold,
+            "prefetch_min_hits": self.prefetch_min_hits,
+            "cache_shards": self.cache_shards,
+            "cache_eviction_policy": self.cache_eviction_policy,
+            "cache_snapshot_file": self.cache_snapshot_file,
+            "cache_snapshot_interval": self.cache_snapshot_interval,
+            "blocklist_fetch_workers": self.blocklist_fetch_workers,
+            "blocklist_fetch_timeout": self.blocklist_fetch_timeout,
+            "blocklist_index_file": self.blocklist_index_file,
+            "stats_rollups": self.stats_rollups,
+            "stats_sketch_hours": self.stats_sketch_hours
         }
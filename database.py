@@ -4,47 +4,41 @@ Handles SQLite database operations for query logging and configuration
 """
 
 import sqlite3
-import threading
 import time
 from datetime import datetime, timedelta
+from db_connections import ConnectionManager
+from query_log_writer import QueryLogWriter
+from query_names import unpack_address
+from query_partitions import QueryPartitions
+from stats_rollups import QueryRollups
+from stats_sketch import QuerySketches
 
 class Database:
     """SQLite database manager for DNS filter application"""
     
-    def __init__(self, db_path="dns_filter.db"):
+    def __init__(self, db_path="dns_filter.db", log_queue_size=100000, log_batch_size=500,
+                 log_flush_interval=1.0, stats_rollups=True, stats_sketch_hours=24):
         self.db_path = db_path
-        self.lock = threading.RLock()
+        self.connections = ConnectionManager(db_path)
+        # Per-day tables the query log is written to and read from
+        self.partitions = QueryPartitions(self.connections)
+        # Pre-aggregated stats maintained by the log writer (None reads the raw table)
+        self.rollups = QueryRollups() if stats_rollups else None
+        # In-memory top-K and distinct-domain sketches of recent hours (None disables)
+        self.sketches = QuerySketches(stats_sketch_hours) if stats_sketch_hours else None
+        self.log_writer = QueryLogWriter(self.connections, self.partitions, queue_size=log_queue_size,
+                                         batch_size=log_batch_size,
+                                         flush_interval=log_flush_interval,
+                                         rollups=self.rollups)
     
     def _get_connection(self):
-        """Get database connection"""
-        return sqlite3.connect(self.db_path)
+        """Check out a pooled read-only connection; use it as a context manager"""
+        return self.connections.reader()
         
     def initialize(self):
         """Initialize database tables"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            try:
-                # Create queries table
-                conn.execute('''
-                    CREATE TABLE IF NOT EXISTS queries (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        timestamp INTEGER NOT NULL,
-                        domain TEXT NOT NULL,
-                        query_type TEXT NOT NULL,
-                        client_ip TEXT NOT NULL,
-                        blocked INTEGER DEFAULT 0,
-                        cached INTEGER DEFAULT 0,
-                        response_time REAL DEFAULT 0,
-                        bytes_saved INTEGER DEFAULT 0
-                    )
-                ''')
-                
-                # Add bytes_saved column if it doesn't exist (for existing databases)
-                try:
-                    conn.execute('ALTER TABLE queries ADD COLUMN bytes_saved INTEGER DEFAULT 0')
-                except sqlite3.OperationalError:
-                    pass  # Column already exists
-                
+        try:
+            with self.connections.writer() as conn:
                 # Create settings table
                 conn.execute('''
                     CREATE TABLE IF NOT EXISTS settings (
@@ -63,84 +57,109 @@ class Database:
                     )
                 ''')
                 
-                # Create indexes for better performance
-                conn.execute('CREATE INDEX IF NOT EXISTS idx_queries_timestamp ON queries(timestamp)')
-                conn.execute('CREATE INDEX IF NOT EXISTS idx_queries_domain ON queries(domain)')
-                conn.execute('CREATE INDEX IF NOT EXISTS idx_queries_blocked ON queries(blocked)')
+                # HTTP validators for conditional blocklist downloads
+                for column in ('etag', 'last_modified'):
+                    try:
+                        conn.execute(f'ALTER TABLE remote_blocklists ADD COLUMN {column} TEXT')
+                    except sqlite3.OperationalError:
+                        pass  # Column already exists
+                
+                # Domains blocked or unblocked by hand, applied on top of the lists
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS custom_domains (
+                        domain TEXT PRIMARY KEY,
+                        blocked INTEGER NOT NULL DEFAULT 1,
+                        updated INTEGER DEFAULT 0
+                    )
+                ''')
                 
-                conn.commit()
-                print("Database initialized successfully")
+                # Per-day query log tables and the queries view over them
+                self.partitions.create_tables(conn)
                 
-            except Exception as e:
-                print(f"Error initializing database: {e}")
-                conn.rollback()
-            finally:
-                conn.close()
+                self._initialize_rollups(conn)
+            
+            with self.connections.reader() as conn:
+                self.partitions.load(conn)
+                if self.sketches is not None:
+                    self._seed_sketches(conn)
+            
+            print("Database initialized successfully")
+            self.log_writer.start()
+            
+        except Exception as e:
+            print(f"Error initializing database: {e}")
+    
+    def _initialize_rollups(self, conn):
+        """Create the stats rollups, rebuilding them if rows were logged without them"""
+        QueryRollups().create_tables(conn)
+        row = conn.execute("SELECT value FROM settings WHERE key = 'stats_rollups_complete'").fetchone()
+        complete = row is not None and row[0] == '1'
+        if self.rollups is not None and not complete:
+            print("Building query stats rollups...")
+            self.rollups.rebuild(conn)
+        if complete != (self.rollups is not None):
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('stats_rollups_complete', ?)",
+                         ('1' if self.rollups is not None else '0',))
+    
+    def _seed_sketches(self, conn):
+        """Load the per-domain counts of the sketched hours from the database"""
+        now = int(time.time())
+        since = now - now % 3600 - self.sketches.hours * 3600
+        if self.rollups is not None:
+            rows = self.rollups.hour_domains(conn, since)
+        else:
+            rows = conn.execute(f'''
+                SELECT s.hour, d.name, s.total, s.blocked, s.cached, s.bytes_saved
+                FROM (
+                    SELECT (timestamp / 3600) * 3600 AS hour, domain_id, COUNT(*) AS total,
+                           SUM(blocked) AS blocked, SUM(cached) AS cached,
+                           COALESCE(SUM(bytes_saved), 0) AS bytes_saved
+                    FROM {self.partitions.source(since)} 
+                    WHERE timestamp >= ?
+                    GROUP BY 1, +domain_id
+                ) s
+                JOIN query_domains d ON d.id = s.domain_id
+            ''', (since,)).fetchall()
+        self.sketches.seed(rows, since)
     
     def log_query(self, domain, query_type, client_ip, blocked=False, cached=False, response_time=0, bytes_saved=0):
-        """Log a DNS query"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
-                conn.execute('''
-                    INSERT INTO queries (timestamp, domain, query_type, client_ip, blocked, cached, response_time, bytes_saved)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (int(time.time()), domain, query_type, client_ip, 
-                      1 if blocked else 0, 1 if cached else 0, response_time, bytes_saved))
-                conn.commit()
-                conn.close()
-            except Exception as e:
-                print(f"Error logging query: {e}")
+        """Queue a DNS query for the background log writer"""
+        timestamp = int(time.time())
+        blocked = 1 if blocked else 0
+        cached = 1 if cached else 0
+        if self.sketches is not None:
+            self.sketches.add(timestamp, domain, blocked, cached, bytes_saved)
+        self.log_writer.enqueue((timestamp, domain, query_type, client_ip,
+                                 blocked, cached, response_time, bytes_saved))
+    
+    def flush_query_log(self, timeout=5.0):
+        """Wait until queued query log rows are written"""
+        self.log_writer.flush(timeout)
+    
+    def get_log_writer_stats(self):
+        """Get query log writer statistics"""
+        return self.log_writer.get_stats()
+    
+    def close(self):
+        """Flush pending query logs, stop the writer thread and close connections"""
+        self.log_writer.stop()
+        self.connections.close()
     
     def get_query_stats(self, hours=24):
         """Get query statistics for the last N hours"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
+        try:
+            with self.connections.reader() as conn:
                 since_timestamp = int(time.time()) - (hours * 3600)
-                
-                # Total queries
-                cursor = conn.execute('SELECT COUNT(*) FROM queries WHERE timestamp > ?', (since_timestamp,))
-                total_queries = cursor.fetchone()[0]
-                
-                # Blocked queries
-                cursor = conn.execute('SELECT COUNT(*) FROM queries WHERE timestamp > ? AND blocked = 1', (since_timestamp,))
-                blocked_queries = cursor.fetchone()[0]
-                
-                # Cached queries
-                cursor = conn.execute('SELECT COUNT(*) FROM queries WHERE timestamp > ? AND cached = 1', (since_timestamp,))
-                cached_queries = cursor.fetchone()[0]
-                
-                # Unique domains
-                cursor = conn.execute('SELECT COUNT(DISTINCT domain) FROM queries WHERE timestamp > ?', (since_timestamp,))
-                unique_domains = cursor.fetchone()[0]
-                
-                # Top blocked domains
-                cursor = conn.execute('''
-                    SELECT domain, COUNT(*) as count 
-                    FROM queries 
-                    WHERE timestamp > ? AND blocked = 1 
-                    GROUP BY domain 
-                    ORDER BY count DESC 
-                    LIMIT 10
-                ''', (since_timestamp,))
-                top_blocked = cursor.fetchall()
-                
-                # Top queried domains
-                cursor = conn.execute('''
-                    SELECT domain, COUNT(*) as count 
-                    FROM queries 
-                    WHERE timestamp > ? 
-                    GROUP BY domain 
-                    ORDER BY count DESC 
-                    LIMIT 10
-                ''', (since_timestamp,))
-                top_domains = cursor.fetchall()
-                
-                # Bandwidth savings calculations
-                cursor = conn.execute('SELECT SUM(bytes_saved) FROM queries WHERE timestamp > ?', (since_timestamp,))
-                total_bytes_saved = cursor.fetchone()[0] or 0
-                
+            
+                # Top-K and distinct domains from the sketches if they cover the window
+                window = self.sketches.window(since_timestamp) if self.sketches is not None else None
+                if self.rollups is not None:
+                    counts = self._query_counts_rollups(conn, since_timestamp, window)
+                else:
+                    counts = self._query_counts_raw(conn, since_timestamp, window)
+                (total_queries, blocked_queries, cached_queries, unique_domains,
+                 top_blocked, top_domains, total_bytes_saved) = counts
+            
                 # Estimated bandwidth usage (approximate calculations)
                 # Average DNS response size: 100 bytes
                 # Average blocked request savings: 1KB (prevents HTTP request)
@@ -148,13 +167,11 @@ class Database:
                 dns_response_size = 100
                 blocked_request_savings = 1024  # 1KB per blocked request
                 cached_response_savings = 50    # 50 bytes per cached response
-                
+            
                 estimated_total_bandwidth = (total_queries * dns_response_size) + (blocked_queries * blocked_request_savings)
                 bandwidth_saved = (blocked_queries * blocked_request_savings) + (cached_queries * cached_response_savings) + total_bytes_saved
                 bandwidth_savings_percent = round((bandwidth_saved / max(estimated_total_bandwidth, 1) * 100), 2)
-                
-                conn.close()
-                
+            
                 return {
                     'total_queries': total_queries,
                     'blocked_queries': blocked_queries,
@@ -168,73 +185,144 @@ class Database:
                     'bandwidth_savings_percent': bandwidth_savings_percent,
                     'estimated_total_bandwidth': estimated_total_bandwidth
                 }
-                
-            except Exception as e:
-                print(f"Error getting query stats: {e}")
-                return {
-                    'total_queries': 0,
-                    'blocked_queries': 0,
-                    'cached_queries': 0,
-                    'unique_domains': 0,
-                    'block_rate': 0,
-                    'cache_rate': 0,
-                    'top_blocked': [],
-                    'top_domains': [],
-                    'bandwidth_saved': 0,
-                    'bandwidth_savings_percent': 0,
-                    'estimated_total_bandwidth': 0
-                }
+            
+        except Exception as e:
+            print(f"Error getting query stats: {e}")
+            return {
+                'total_queries': 0,
+                'blocked_queries': 0,
+                'cached_queries': 0,
+                'unique_domains': 0,
+                'block_rate': 0,
+                'cache_rate': 0,
+                'top_blocked': [],
+                'top_domains': [],
+                'bandwidth_saved': 0,
+                'bandwidth_savings_percent': 0,
+                'estimated_total_bandwidth': 0
+            }
+    
+    def _query_counts_rollups(self, conn, since_timestamp, window=None):
+        """Counts and top domains for get_query_stats, from the rollup tables"""
+        rollups = self.rollups
+        total_queries, blocked_queries, cached_queries, total_bytes_saved, _ = \
+            rollups.totals(conn, since_timestamp)
+        if window is not None:
+            unique_domains = window.unique_domains()
+            top_blocked = window.top_domains(10, blocked_only=True)
+            top_domains = window.top_domains(10)
+        else:
+            unique_domains = rollups.unique_domains(conn, since_timestamp)
+            top_blocked = rollups.top_domains(conn, since_timestamp, 10, blocked_only=True)
+            top_domains = rollups.top_domains(conn, since_timestamp, 10)
+        return (total_queries, blocked_queries, cached_queries, unique_domains,
+                top_blocked, top_domains, total_bytes_saved)
+    
+    def _query_counts_raw(self, conn, since_timestamp, window=None):
+        """Counts and top domains for get_query_stats, from the query log"""
+        # Totals, in one pass over the covering index
+        cursor = conn.execute(f'''
+            SELECT 
+                COUNT(*),
+                COALESCE(SUM(blocked), 0),
+                COALESCE(SUM(cached), 0),
+                COALESCE(SUM(bytes_saved), 0)
+            FROM {self.partitions.source(since_timestamp)} 
+            WHERE timestamp > ?
+        ''', (since_timestamp,))
+        total_queries, blocked_queries, cached_queries, total_bytes_saved = cursor.fetchone()
+        
+        # Top-K and distinct domains are left to the sketches when they cover the window
+        if window is not None:
+            return (total_queries, blocked_queries, cached_queries, window.unique_domains(),
+                    window.top_domains(10, blocked_only=True), window.top_domains(10),
+                    total_bytes_saved)
+        
+        # Per-domain counts, grouped by id in each day's partition and
+        # named only for the ten that are returned
+        domains = self.partitions.domain_source(since_timestamp, {'count': 'COUNT(*)'})
+        unique_domains = conn.execute(f'SELECT COUNT(*) FROM {domains}').fetchone()[0]
+        
+        # Top queried domains
+        cursor = conn.execute(f'''
+        SELECT d.name, top.count 
+        FROM (SELECT domain_id, count FROM {domains} ORDER BY count DESC LIMIT 10) top
+        JOIN query_domains d ON d.id = top.domain_id 
+        ORDER BY top.count DESC
+        ''')
+        top_domains = cursor.fetchall()
+        
+        # Top blocked domains
+        blocked = self.partitions.domain_source(since_timestamp, {'count': 'COUNT(*)'}, 'blocked = 1')
+        cursor = conn.execute(f'''
+        SELECT d.name, top.count 
+        FROM (SELECT domain_id, count FROM {blocked} ORDER BY count DESC LIMIT 10) top
+        JOIN query_domains d ON d.id = top.domain_id 
+        ORDER BY top.count DESC
+        ''')
+        top_blocked = cursor.fetchall()
+        
+        return (total_queries, blocked_queries, cached_queries, unique_domains,
+                top_blocked, top_domains, total_bytes_saved)
     
     def get_recent_queries(self, limit=100):
         """Get recent queries"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.execute('''
-                    SELECT timestamp, domain, query_type, client_ip, blocked, cached
-                    FROM queries 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                ''', (limit,))
-                
+        try:
+            with self.connections.reader() as conn:
+                # Newest day first, stopping once enough rows are found
+                rows = []
+                for table in self.partitions.tables():
+                    rows.extend(conn.execute(f'''
+                        SELECT p.timestamp, d.name, t.name, c.address, p.blocked, p.cached
+                        FROM {table} p
+                        JOIN query_domains d ON d.id = p.domain_id
+                        JOIN query_types t ON t.id = p.query_type_id
+                        JOIN query_clients c ON c.id = p.client_id
+                        ORDER BY p.timestamp DESC 
+                        LIMIT ?
+                    ''', (limit - len(rows),)).fetchall())
+                    if len(rows) >= limit:
+                        break
+            
                 queries = []
-                for row in cursor.fetchall():
+                for row in rows:
                     queries.append({
                         'timestamp': datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M:%S'),
                         'domain': row[1],
                         'query_type': row[2],
-                        'client_ip': row[3],
+                        'client_ip': unpack_address(row[3]),
                         'blocked': bool(row[4]),
                         'cached': bool(row[5])
                     })
-                
-                conn.close()
+            
                 return queries
-                
-            except Exception as e:
-                print(f"Error getting recent queries: {e}")
-                return []
+            
+        except Exception as e:
+            print(f"Error getting recent queries: {e}")
+            return []
     
     def get_hourly_stats(self, hours=24):
         """Get hourly query statistics"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
+        try:
+            with self.connections.reader() as conn:
                 since_timestamp = int(time.time()) - (hours * 3600)
-                
-                cursor = conn.execute('''
-                    SELECT 
-                        (timestamp / 3600) * 3600 as hour_timestamp,
-                        COUNT(*) as total,
-                        SUM(blocked) as blocked
-                    FROM queries 
-                    WHERE timestamp > ?
-                    GROUP BY hour_timestamp
-                    ORDER BY hour_timestamp
-                ''', (since_timestamp,))
-                
+            
+                if self.rollups is not None:
+                    rows = self.rollups.hourly(conn, since_timestamp)
+                else:
+                    rows = conn.execute(f'''
+                        SELECT 
+                            (timestamp / 3600) * 3600 as hour_timestamp,
+                            COUNT(*) as total,
+                            SUM(blocked) as blocked
+                        FROM {self.partitions.source(since_timestamp)} 
+                        WHERE timestamp > ?
+                        GROUP BY hour_timestamp
+                        ORDER BY hour_timestamp
+                    ''', (since_timestamp,)).fetchall()
+            
                 stats = []
-                for row in cursor.fetchall():
+                for row in rows:
                     stats.append({
                         'timestamp': int(row[0]),
                         'hour': datetime.fromtimestamp(row[0]).strftime('%H:%M'),
@@ -242,69 +330,115 @@ class Database:
                         'blocked': row[2],
                         'allowed': row[1] - row[2]
                     })
-                
-                conn.close()
+            
                 return stats
-                
-            except Exception as e:
-                print(f"Error getting hourly stats: {e}")
-                return []
+            
+        except Exception as e:
+            print(f"Error getting hourly stats: {e}")
+            return []
     
     def cleanup_old_queries(self, days=30):
         """Clean up queries older than specified days"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
-                cutoff_timestamp = int(time.time()) - (days * 24 * 3600)
-                
-                cursor = conn.execute('DELETE FROM queries WHERE timestamp < ?', (cutoff_timestamp,))
-                deleted_count = cursor.rowcount
-                
-                conn.commit()
-                conn.close()
-                
-                print(f"Cleaned up {deleted_count} old query records")
-                return deleted_count
-                
-            except Exception as e:
-                print(f"Error cleaning up old queries: {e}")
-                return 0
+        try:
+            cutoff_timestamp = int(time.time()) - (days * 24 * 3600)
+            # Whole days only: older partitions are dropped, the one holding
+            # the cutoff is kept, and the rollups keep matching the rows left
+            cutoff_timestamp -= cutoff_timestamp % 86400
+            
+            with self.connections.writer() as conn:
+                deleted_count = self.partitions.drop_before(conn, cutoff_timestamp)
+                if self.rollups is not None:
+                    self.rollups.delete_before(conn, cutoff_timestamp)
+            
+            print(f"Cleaned up {deleted_count} old query records")
+            return deleted_count
+            
+        except Exception as e:
+            print(f"Error cleaning up old queries: {e}")
+            return 0
     
     def get_remote_blocklists(self):
         """Get all remote blocklist URLs"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
+        try:
+            with self.connections.reader() as conn:
                 cursor = conn.execute('SELECT url FROM remote_blocklists WHERE enabled = 1')
                 urls = [row[0] for row in cursor.fetchall()]
-                conn.close()
                 return urls
-            except Exception as e:
-                print(f"Error getting remote blocklists: {e}")
-                return []
+        except Exception as e:
+            print(f"Error getting remote blocklists: {e}")
+            return []
+    
+    def get_remote_blocklist_validators(self):
+        """Get {url: (etag, last_modified)} for enabled remote blocklists"""
+        try:
+            with self.connections.reader() as conn:
+                cursor = conn.execute(
+                    'SELECT url, etag, last_modified FROM remote_blocklists WHERE enabled = 1')
+                return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        except Exception as e:
+            print(f"Error getting blocklist validators: {e}")
+            return {}
+    
+    def update_remote_blocklist_validators(self, url, etag, last_modified):
+        """Record a successful fetch of a remote blocklist and its HTTP validators"""
+        try:
+            with self.connections.writer() as conn:
+                conn.execute('''
+                    UPDATE remote_blocklists SET etag = ?, last_modified = ?, last_updated = ?
+                    WHERE url = ?
+                ''', (etag, last_modified, int(time.time()), url))
+            return True
+        except Exception as e:
+            print(f"Error updating blocklist validators: {e}")
+            return False
+    
+    def get_custom_domains(self):
+        """Get {domain: blocked} for domains blocked or unblocked by hand"""
+        try:
+            with self.connections.reader() as conn:
+                cursor = conn.execute('SELECT domain, blocked FROM custom_domains')
+                return {row[0]: bool(row[1]) for row in cursor.fetchall()}
+        except Exception as e:
+            print(f"Error getting custom domains: {e}")
+            return {}
+    
+    def set_custom_domain(self, domain, blocked):
+        """Record that a domain was blocked (True) or unblocked (False) by hand"""
+        try:
+            with self.connections.writer() as conn:
+                conn.execute('INSERT OR REPLACE INTO custom_domains (domain, blocked, updated) VALUES (?, ?, ?)',
+                             (domain, 1 if blocked else 0, int(time.time())))
+            return True
+        except Exception as e:
+            print(f"Error saving custom domain: {e}")
+            return False
+    
+    def remove_custom_domain(self, domain):
+        """Forget a domain blocked or unblocked by hand"""
+        try:
+            with self.connections.writer() as conn:
+                conn.execute('DELETE FROM custom_domains WHERE domain = ?', (domain,))
+            return True
+        except Exception as e:
+            print(f"Error removing custom domain: {e}")
+            return False
     
     def add_remote_blocklist(self, url):
         """Add a remote blocklist URL"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
+        try:
+            with self.connections.writer() as conn:
                 conn.execute('INSERT OR IGNORE INTO remote_blocklists (url) VALUES (?)', (url,))
-                conn.commit()
-                conn.close()
-                return True
-            except Exception as e:
-                print(f"Error adding remote blocklist: {e}")
-                return False
+            return True
+        except Exception as e:
+            print(f"Error adding remote blocklist: {e}")
+            return False
     
     def remove_remote_blocklist(self, url):
         """Remove a remote blocklist URL"""
-        with self.lock:
-            try:
-                conn = sqlite3.connect(self.db_path)
+        try:
+            with self.connections.writer() as conn:
                 conn.execute('DELETE FROM remote_blocklists WHERE url = ?', (url,))
-                conn.commit()
-                conn.close()
-                return True
-            except Exception as e:
-                print(f"Error removing remote blocklist: {e}")
-                return False
+            return True
+        except Exception as e:
+            print(f"Error removing remote blocklist: {e}")
+            return False
@@ -0,0 +1,128 @@
+"""
+Database Connection Manager
+Long-lived SQLite connections: one shared writer and a bounded pool of readers
+"""
+
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+class ConnectionManager:
+    """Hands out a single writer connection and pooled read connections
+
+    Read connections are opened on demand up to max_readers and returned
+    to the pool after each use, so short-lived request threads share a
+    few long-lived connections. A thread that already holds one gets the
+    same connection again, so nested reads never wait on the pool.
+    """
+
+    # Statements compiled per connection and reused by SQL text
+    STATEMENT_CACHE_SIZE = 256
+
+    def __init__(self, db_path, cache_size_kb=20000, mmap_size=268435456, synchronous="NORMAL",
+                 max_readers=8):
+        self.db_path = db_path
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+
+        self.write_lock = threading.RLock()
+        self._writer = None
+        self.max_readers = max(1, max_readers)
+        # Idle read connections; all opened ones are listed in _readers
+        self._idle = queue.Queue()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        """Open a connection with the shared pragmas applied"""
+        conn = sqlite3.connect(self.db_path, timeout=30,
+                               check_same_thread=False,
+                               cached_statements=self.STATEMENT_CACHE_SIZE)
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def _get_writer(self):
+        """Open the writer connection on first use"""
+        if self._writer is None:
+            conn = self._connect()
+            conn.execute('PRAGMA journal_mode = WAL')
+            self._writer = conn
+        return self._writer
+
+    @contextmanager
+    def writer(self):
+        """Hold the write lock and yield the writer connection inside a transaction"""
+        with self.write_lock:
+            conn = self._get_writer()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        """Check out a read-only connection for the duration of the block"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            with self._readers_lock:
+                # Not returned to the pool if close() ran in the meantime
+                pooled = conn in self._readers
+            if pooled:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+            else:
+                conn.close()
+
+    def _checkout(self):
+        """Take an idle reader, open one if below max_readers, or wait for one"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        # Make sure WAL is enabled before readers attach
+        with self.write_lock:
+            self._get_writer()
+        with self._readers_lock:
+            if len(self._readers) < self.max_readers:
+                conn = self._connect()
+                conn.execute('PRAGMA query_only = ON')
+                self._readers.append(conn)
+                return conn
+        return self._idle.get()
+
+    def close(self):
+        """Close the writer and every reader connection"""
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+            self._idle = queue.Queue()
+        for conn in readers:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        with self.write_lock:
+            if self._writer is not None:
+                try:
+                    self._writer.close()
+                except Exception:
+                    pass
+                self._writer = None
+        self._local = threading.local()
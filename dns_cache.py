@@ -3,116 +3,574 @@ DNS Cache Implementation
 Provides in-memory caching for DNS responses
 """
 
+import gc
+import mmap
+import os
+import struct
 import time
 import threading
-from collections import OrderedDict
+from dnslib import DNSRecord, QTYPE, RCODE
+import dns_wire
+from cache_policy import get_policy
+
+class _Flight:
+    """One in-progress call that other callers can wait on"""
+    
+    __slots__ = ('event', 'result', 'error', 'waiters')
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one call"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {
+            'leaders': 0,
+            'coalesced': 0
+        }
+    
+    def do(self, key, fn):
+        """Run fn() once per key at a time; returns (result, shared)
+        
+        The first caller for a key runs fn(). Callers arriving while it is
+        running wait for it and receive the same result, with shared=True.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self.flights[key] = flight
+                self.stats['leaders'] += 1
+                leader = True
+            else:
+                flight.waiters += 1
+                self.stats['coalesced'] += 1
+                leader = False
+        
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        
+        try:
+            flight.result = fn()
+            return flight.result, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+    
+    def get_stats(self):
+        """Get coalescing statistics"""
+        with self.lock:
+            return {
+                'leaders': self.stats['leaders'],
+                'coalesced': self.stats['coalesced'],
+                'in_flight': len(self.flights)
+            }
+
+class _CacheEntry:
+    """One cached response in wire format"""
+    
+    __slots__ = ('wire', 'ttl_offsets', 'created', 'ttl', 'expires', 'stale_until',
+                 'hits', 'refreshing', 'bucket')
+    
+    def __init__(self, wire, ttl_offsets, created, ttl, stale_ttl):
+        self.wire = wire
+        self.ttl_offsets = ttl_offsets
+        self.created = created
+        self.ttl = ttl
+        self.expires = created + ttl
+        self.stale_until = self.expires + stale_ttl
+        self.hits = 0
+        self.refreshing = False
+        self.bucket = None          # expiry wheel slot, set by the shard
+
+class _CacheShard:
+    """A slice of the cache with its own lock, counters and eviction policy
+    
+    The policy decides which entries stay when the shard is full. Every
+    entry also sits in a one-second bucket of an expiry wheel keyed on
+    the time it may be dropped (stale_until), so expired entries are
+    found without scanning the shard. Callers hold the shard lock around
+    every method.
+    """
+    
+    __slots__ = ('lock', 'policy', 'wheel', 'cursor', 'hits', 'misses',
+                 'evictions', 'expirations', 'stale_served', 'prefetches')
+    
+    def __init__(self, max_size, policy_class):
+        self.lock = threading.Lock()
+        self.policy = policy_class(max_size)
+        self.wheel = {}             # second -> set of keys dropped in that second
+        self.cursor = int(time.time())
+        self.reset_stats()
+    
+    def reset_stats(self):
+        """Zero the shard's counters"""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_served = 0
+        self.prefetches = 0
+    
+    def insert(self, key, entry):
+        """Add or replace an entry, evicting whatever the policy gives up"""
+        old = self.policy.get(key)
+        if old is not None:
+            self._unschedule(key, old)
+        self._schedule(key, entry)
+        for evicted_key, evicted in self.policy.put(key, entry):
+            self._unschedule(evicted_key, evicted)
+            self.evictions += 1
+    
+    def restore(self, items):
+        """Bulk insert (key, entry) pairs, oldest first, into an empty shard"""
+        if len(self.policy):
+            for key, entry in items:
+                self.insert(key, entry)
+            return
+        skipped = self.policy.load(items)
+        for key, entry in items[skipped:]:
+            self._schedule(key, entry)
+    
+    def remove(self, key):
+        """Drop an entry and its expiry wheel slot"""
+        entry = self.policy.pop(key)
+        if entry is not None:
+            self._unschedule(key, entry)
+    
+    def clear(self):
+        """Drop every entry"""
+        self.policy.clear()
+        self.wheel.clear()
+    
+    def _schedule(self, key, entry):
+        """Put a key in the wheel bucket for its stale_until second"""
+        # Entries due before the cursor go in its bucket so the next tick sees them
+        entry.bucket = max(int(entry.stale_until), self.cursor)
+        bucket = self.wheel.get(entry.bucket)
+        if bucket is None:
+            self.wheel[entry.bucket] = {key}
+        else:
+            bucket.add(key)
+    
+    def _unschedule(self, key, entry):
+        """Take a key out of its wheel bucket"""
+        bucket = self.wheel.get(entry.bucket)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self.wheel[entry.bucket]
+    
+    def expire(self, now, limit):
+        """Drop up to limit entries past stale_until; returns True when caught up
+        
+        Only whole seconds before now are processed, so every key in a
+        visited bucket is due and entries outlive stale_until by at most
+        a second (lookups check stale_until themselves).
+        """
+        removed = 0
+        while self.cursor < int(now):
+            bucket = self.wheel.pop(self.cursor, None)
+            while bucket:
+                if removed >= limit:
+                    self.wheel[self.cursor] = bucket
+                    return False
+                self.policy.pop(bucket.pop())
+                self.expirations += 1
+                removed += 1
+            self.cursor += 1
+        return True
 
 class DNSCache:
-    """Thread-safe DNS response cache with TTL support"""
+    """Thread-safe DNS response cache with TTL support
+    
+    Entries live for the smallest TTL in the answer, clamped to
+    [min_ttl, max_ttl]. NXDOMAIN and NODATA answers are cached for the
+    SOA negative TTL (RFC 2308), capped at negative_ttl.
+    
+    Responses are stored packed, with the offsets of their TTL fields, so
+    a hit is a byte copy with the transaction ID and TTLs patched in.
+    Keys are spread by hash over independently locked shards of
+    max_size / shards entries, so concurrent lookups rarely contend. Which
+    entries a full shard keeps is up to eviction_policy ('lru' or
+    'tinylfu', see cache_policy).
+    
+    With serve_stale, expired entries are kept for stale_ttl more seconds
+    and may be answered while they are refreshed (RFC 8767). Entries hit
+    at least prefetch_min_hits times are refreshed once prefetch_threshold
+    of their TTL has passed, before they expire.
+    """
     
-    def __init__(self, max_size=10000):
+    # TTL given to clients for answers served stale (RFC 8767 section 4)
+    STALE_ANSWER_TTL = 30
+    
+    # Seconds between cleanup ticks, and entries expired per shard per tick
+    CLEANUP_INTERVAL = 1.0
+    CLEANUP_BATCH = 1000
+    
+    # Snapshot file layout: a header, then one record per entry followed by
+    # its key, wire bytes and TTL offsets
+    SNAPSHOT_MAGIC = b'DNSC'
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_HEADER = struct.Struct('<4sHI')         # magic, version, entry count
+    SNAPSHOT_RECORD = struct.Struct('<ddHHH')        # created, ttl, key, wire, offset counts
+    
+    def __init__(self, max_size=10000, min_ttl=0, max_ttl=300, negative_ttl=300,
+                 serve_stale=True, stale_ttl=86400, prefetch_threshold=0.9, prefetch_min_hits=3,
+                 shards=16, eviction_policy='tinylfu', snapshot_file=None, snapshot_interval=300):
         self.max_size = max_size
-        self.cache = OrderedDict()
-        self.lock = threading.RLock()
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.serve_stale = serve_stale
+        self.stale_ttl = stale_ttl if serve_stale else 0
+        self.prefetch_threshold = prefetch_threshold
+        self.prefetch_min_hits = prefetch_min_hits
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self._last_snapshot = time.time()
+        
+        # Round the shard count up to a power of two so a mask picks the shard
+        count = 1
+        while count < max(1, shards):
+            count *= 2
+        per_shard = max(1, -(-max_size // count))
+        policy_class = get_policy(eviction_policy)
+        self.eviction_policy = policy_class.name
+        self.shards = [_CacheShard(per_shard, policy_class) for _ in range(count)]
+        self.shard_mask = count - 1
+        
+        self.lock = threading.Lock()    # guards self.stats only
+        self.inflight = SingleFlight()
         self.stats = {
-            'hits': 0,
-            'misses': 0,
-            'evictions': 0
+            'negative': 0,
+            'uncacheable': 0,
+            'refresh_failures': 0
         }
         
         # Start cleanup thread
+        self._stop_event = threading.Event()
         self.cleanup_thread = threading.Thread(target=self._cleanup_expired, daemon=True)
         self.cleanup_thread.start()
     
-    def get(self, key):
-        """Get cached DNS response if not expired"""
-        with self.lock:
-            if key in self.cache:
-                entry = self.cache[key]
-                current_time = time.time()
-                
-                if current_time < entry['expires']:
-                    # Move to end (most recently used)
-                    self.cache.move_to_end(key)
-                    self.stats['hits'] += 1
-                    return entry['response']
-                else:
-                    # Expired, remove from cache
-                    del self.cache[key]
-            
-            self.stats['misses'] += 1
-            return None
+    def _shard(self, key):
+        """Pick the shard that owns a key"""
+        return self.shards[hash(key) & self.shard_mask]
     
-    def set(self, key, response, ttl=300):
-        """Set DNS response in cache with TTL"""
-        with self.lock:
+    def get(self, key, txid=0):
+        """Get a copy of a cached DNS response with TTLs aged, if not expired"""
+        response, refresh = self.lookup(key, txid, allow_stale=False)
+        return response
+    
+    def lookup(self, key, txid=0, allow_stale=True, query=None):
+        """Like lookup_wire(), but returns a parsed DNSRecord"""
+        data, refresh = self.lookup_wire(key, txid, allow_stale, query)
+        if data is None:
+            return None, refresh
+        return DNSRecord.parse(data), refresh
+    
+    def lookup_wire(self, key, txid, allow_stale=True, query=None):
+        """Look up a response in wire format; returns (data, refresh)
+        
+        data is a copy of the cached message carrying transaction ID txid
+        and aged TTLs, or None on a miss. Given the client's query bytes,
+        the copy also takes its RD bit and question name spelling. refresh is True when the caller
+        should fetch a new answer in the background, because the entry is
+        served stale or is due for a prefetch, and then call set() or
+        refresh_failed(). Only one caller is asked to refresh at a time.
+        """
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.policy.get(key)
             current_time = time.time()
-            expires = current_time + ttl
-            
-            # Remove existing entry if present
-            if key in self.cache:
-                del self.cache[key]
-            
-            # Add new entry
-            self.cache[key] = {
-                'response': response,
-                'expires': expires,
-                'created': current_time
-            }
             
-            # Move to end (most recently used)
-            self.cache.move_to_end(key)
+            if entry is None or current_time >= entry.stale_until:
+                if entry is not None:
+                    shard.remove(key)
+                shard.policy.on_miss(key)
+                shard.misses += 1
+                return None, False
             
-            # Evict oldest entries if cache is full
-            while len(self.cache) > self.max_size:
-                oldest_key = next(iter(self.cache))
-                del self.cache[oldest_key]
-                self.stats['evictions'] += 1
+            if current_time >= entry.expires:
+                if not (allow_stale and self.serve_stale):
+                    shard.policy.on_miss(key)
+                    shard.misses += 1
+                    return None, False
+                shard.policy.on_hit(key)
+                shard.stale_served += 1
+                refresh = not entry.refreshing
+                entry.refreshing = True
+                stale = True
+            else:
+                shard.policy.on_hit(key)
+                shard.hits += 1
+                entry.hits += 1
+                age = current_time - entry.created
+                refresh = False
+                stale = False
+                if (not entry.refreshing
+                        and entry.hits >= self.prefetch_min_hits
+                        and age >= entry.ttl * self.prefetch_threshold):
+                    entry.refreshing = True
+                    shard.prefetches += 1
+                    refresh = True
+        
+        if stale:
+            return dns_wire.patch_reply(entry.wire, txid, entry.ttl_offsets,
+                                        ttl=self.STALE_ANSWER_TTL, query=query), refresh
+        return dns_wire.patch_reply(entry.wire, txid, entry.ttl_offsets,
+                                    age=int(age), query=query), refresh
+    
+    def refresh_failed(self, key):
+        """Allow another refresh attempt after a failed one"""
+        with self.lock:
+            self.stats['refresh_failures'] += 1
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.policy.get(key)
+            if entry is not None:
+                entry.refreshing = False
+    
+    def set(self, key, response, ttl=None):
+        """Set DNS response in cache; the TTL defaults to the response's own
+        
+        Returns False when the response must not be cached.
+        """
+        if ttl is None:
+            ttl = self.response_ttl(response)
+            if ttl is None:
+                with self.lock:
+                    self.stats['uncacheable'] += 1
+                return False
+            if self.is_negative(response):
+                with self.lock:
+                    self.stats['negative'] += 1
+        
+        # Entries hold the packed message; hits only patch the ID and TTLs
+        data = response.pack()
+        entry = _CacheEntry(data, dns_wire.ttl_offsets(data), time.time(), ttl, self.stale_ttl)
+        
+        shard = self._shard(key)
+        with shard.lock:
+            shard.insert(key, entry)
+        return True
+    
+    def __len__(self):
+        """Number of cached entries, including stale ones"""
+        return sum(len(shard.policy) for shard in self.shards)
+    
+    @staticmethod
+    def is_negative(response):
+        """Check for an NXDOMAIN or NODATA answer"""
+        rcode = response.header.rcode
+        return rcode == RCODE.NXDOMAIN or (rcode == RCODE.NOERROR and not response.rr)
+    
+    def response_ttl(self, response):
+        """Work out how long a response may be cached, or None if it may not"""
+        if self.is_negative(response):
+            # RFC 2308: min(SOA TTL, SOA MINIMUM); no SOA means no caching
+            for rr in response.auth:
+                if rr.rtype == QTYPE.SOA:
+                    ttl = min(rr.ttl, rr.rdata.times[-1])
+                    ttl = min(max(ttl, self.min_ttl), self.negative_ttl)
+                    return ttl if ttl > 0 else None
+            return None
+        
+        if response.header.rcode != RCODE.NOERROR:
+            # SERVFAIL, REFUSED and friends are retried rather than cached
+            return None
+        
+        ttl = min(rr.ttl for rr in response.rr)
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        return ttl if ttl > 0 else None
     
     def clear(self):
         """Clear all cached entries"""
+        for shard in self.shards:
+            with shard.lock:
+                shard.clear()
+                shard.reset_stats()
         with self.lock:
-            self.cache.clear()
             self.stats = {
-                'hits': 0,
-                'misses': 0,
-                'evictions': 0
+                'negative': 0,
+                'uncacheable': 0,
+                'refresh_failures': 0
             }
     
     def get_stats(self):
         """Get cache statistics"""
+        totals = {'size': 0, 'hits': 0, 'misses': 0, 'evictions': 0,
+                  'expirations': 0, 'stale_served': 0, 'prefetches': 0}
+        for shard in self.shards:
+            with shard.lock:
+                totals['size'] += len(shard.policy)
+                totals['hits'] += shard.hits
+                totals['misses'] += shard.misses
+                totals['evictions'] += shard.evictions
+                totals['expirations'] += shard.expirations
+                totals['stale_served'] += shard.stale_served
+                totals['prefetches'] += shard.prefetches
         with self.lock:
-            total_requests = self.stats['hits'] + self.stats['misses']
-            hit_rate = (self.stats['hits'] / total_requests * 100) if total_requests > 0 else 0
+            stats = dict(self.stats)
+        inflight = self.inflight.get_stats()
+        
+        total_requests = totals['hits'] + totals['stale_served'] + totals['misses']
+        hit_rate = (totals['hits'] / total_requests * 100) if total_requests > 0 else 0
+        return {
+            'size': totals['size'],
+            'max_size': self.max_size,
+            'shards': len(self.shards),
+            'eviction_policy': self.eviction_policy,
+            'hits': totals['hits'],
+            'misses': totals['misses'],
+            'evictions': totals['evictions'],
+            'expirations': totals['expirations'],
+            'negative': stats['negative'],
+            'uncacheable': stats['uncacheable'],
+            'stale_served': totals['stale_served'],
+            'prefetches': totals['prefetches'],
+            'refresh_failures': stats['refresh_failures'],
+            'hit_rate': round(hit_rate, 2),
+            'total_requests': total_requests,
+            'upstream_fetches': inflight['leaders'],
+            'coalesced': inflight['coalesced'],
+            'in_flight': inflight['in_flight']
+        }
+    
+    def stop(self):
+        """Stop the cleanup thread and write a final snapshot"""
+        self._stop_event.set()
+        if self.cleanup_thread.is_alive() and self.cleanup_thread is not threading.current_thread():
+            self.cleanup_thread.join(timeout=5)
+        if self.snapshot_file:
+            self.save_snapshot()
+    
+    def save_snapshot(self, path=None):
+        """Write every entry still within its stale window to a snapshot file
+        
+        Entries keep their absolute creation time and TTL, so a restored
+        entry expires when it would have without the restart. The file is
+        written next to the target and renamed over it.
+        """
+        path = path or self.snapshot_file
+        current_time = time.time()
+        record = self.SNAPSHOT_RECORD
+        count = 0
+        tmp_path = f"{path}.tmp"
+        # Failed attempts also wait a full interval before the next one
+        self._last_snapshot = current_time
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, 0))
+                for shard in self.shards:
+                    with shard.lock:
+                        items = shard.policy.items()
+                    chunks = []
+                    for key, entry in items:
+                        if entry.stale_until <= current_time:
+                            continue
+                        key_bytes = key.encode('utf-8')
+                        offsets = entry.ttl_offsets
+                        chunks.append(record.pack(entry.created, entry.ttl, len(key_bytes),
+                                                  len(entry.wire), len(offsets)))
+                        chunks.append(key_bytes)
+                        chunks.append(entry.wire)
+                        chunks.append(struct.pack(f'<{len(offsets)}H', *offsets))
+                        count += 1
+                    f.write(b''.join(chunks))
+                f.seek(0)
+                f.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, count))
+            os.replace(tmp_path, path)
+            return count
+        except Exception as e:
+            print(f"Error saving cache snapshot {path}: {e}")
+            return 0
+    
+    def load_snapshot(self, path=None):
+        """Restore entries from a snapshot file; returns the number loaded
+        
+        Entries past their stale window are skipped. The file is read
+        through mmap, so records are decoded straight from the page cache.
+        """
+        path = path or self.snapshot_file
+        if not path or not os.path.exists(path) or os.path.getsize(path) < self.SNAPSHOT_HEADER.size:
+            return 0
+        
+        current_time = time.time()
+        record = self.SNAPSHOT_RECORD
+        offset_structs = {}
+        restored = [[] for _ in self.shards]
+        stale_ttl = self.stale_ttl
+        # Collections triggered by a million new objects would double the load time
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, version, count = self.SNAPSHOT_HEADER.unpack_from(data, 0)
+                if magic != self.SNAPSHOT_MAGIC or version != self.SNAPSHOT_VERSION:
+                    print(f"Ignoring cache snapshot {path}: unknown format")
+                    return 0
+                
+                offset = self.SNAPSHOT_HEADER.size
+                for _ in range(count):
+                    created, ttl, key_len, wire_len, offset_count = record.unpack_from(data, offset)
+                    offset += record.size
+                    key_end = offset + key_len
+                    wire_end = key_end + wire_len
+                    if created + ttl + stale_ttl > current_time:
+                        offsets_struct = offset_structs.get(offset_count)
+                        if offsets_struct is None:
+                            offsets_struct = offset_structs[offset_count] = struct.Struct(f'<{offset_count}H')
+                        key = data[offset:key_end].decode('utf-8')
+                        entry = _CacheEntry(data[key_end:wire_end],
+                                            offsets_struct.unpack_from(data, wire_end),
+                                            created, ttl, stale_ttl)
+                        restored[hash(key) & self.shard_mask].append((key, entry))
+                    offset = wire_end + 2 * offset_count
             
-            return {
-                'size': len(self.cache),
-                'max_size': self.max_size,
-                'hits': self.stats['hits'],
-                'misses': self.stats['misses'],
-                'evictions': self.stats['evictions'],
-                'hit_rate': round(hit_rate, 2),
-                'total_requests': total_requests
-            }
+            loaded = 0
+            for shard, items in zip(self.shards, restored):
+                with shard.lock:
+                    before = len(shard.policy)
+                    shard.restore(items)
+                    loaded += len(shard.policy) - before
+        except Exception as e:
+            print(f"Error loading cache snapshot {path}: {e}")
+            return 0
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        return loaded
     
     def _cleanup_expired(self):
-        """Background thread to cleanup expired entries"""
-        while True:
+        """Background thread that drops expired entries a little at a time
+        
+        Each tick takes every shard lock once and removes at most
+        CLEANUP_BATCH entries under it; a shard that falls further behind
+        catches up over the following ticks. Snapshots are written from
+        here as well.
+        """
+        while not self._stop_event.wait(self.CLEANUP_INTERVAL):
             try:
-                current_time = time.time()
-                expired_keys = []
-                
-                with self.lock:
-                    for key, entry in self.cache.items():
-                        if current_time >= entry['expires']:
-                            expired_keys.append(key)
-                    
-                    for key in expired_keys:
-                        del self.cache[key]
-                
-                # Sleep for 60 seconds before next cleanup
-                time.sleep(60)
+                for shard in self.shards:
+                    current_time = time.time()
+                    with shard.lock:
+                        shard.expire(current_time, self.CLEANUP_BATCH)
                 
+                if self.snapshot_file and time.time() - self._last_snapshot >= self.snapshot_interval:
+                    self.save_snapshot()
             except Exception as e:
                 print(f"Error in cache cleanup: {e}")
-                time.sleep(60)
@@ -3,12 +3,15 @@ DNS Server Implementation
 Handles DNS query interception, filtering, and forwarding
 """
 
-import socket
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dnslib import DNSRecord, DNSHeader, QTYPE, RCODE
 from dnslib.server import DNSServer as DNSLibServer, BaseResolver
 from dns_cache import DNSCache
+from async_dns_server import AsyncDNSServer
+from upstream_client import UpstreamClient
+import dns_wire
 
 class DNSFilterResolver(BaseResolver):
     """Custom DNS resolver with filtering and caching capabilities"""
@@ -17,64 +20,174 @@ class DNSFilterResolver(BaseResolver):
         self.config = config
         self.database = database
         self.blocklist_manager = blocklist_manager
-        self.cache = DNSCache(config.cache_size)
+        self.cache = DNSCache(
+            config.cache_size,
+            min_ttl=config.cache_min_ttl,
+            max_ttl=config.cache_ttl,
+            negative_ttl=config.negative_cache_ttl,
+            serve_stale=config.serve_stale,
+            stale_ttl=config.serve_stale_ttl,
+            prefetch_threshold=config.prefetch_threshold,
+            prefetch_min_hits=config.prefetch_min_hits,
+            shards=config.cache_shards,
+            eviction_policy=config.cache_eviction_policy,
+            snapshot_file=config.cache_snapshot_file or None,
+            snapshot_interval=config.cache_snapshot_interval
+        )
+        # Background refreshes for stale and prefetched cache entries
+        self.refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='dns-refresh')
         self.upstream_servers = config.upstream_dns
+        self.upstream_client = UpstreamClient(
+            config.upstream_dns,
+            pool_size=config.upstream_pool_size,
+            timeout=config.upstream_timeout,
+            deadline=config.upstream_deadline,
+            strategy=config.upstream_strategy,
+            race_count=config.upstream_race_count
+        )
         
     def resolve(self, request, handler):
         """Resolve DNS query with filtering and caching"""
         try:
             start_time = time.time()
-            
-            # Parse the request
-            query = request.get_q()
-            qname = str(query.qname).rstrip('.')
-            qtype = QTYPE[query.qtype]
-            
-            # Log the initial query
             client_ip = handler.client_address[0] if handler else "unknown"
             
-            # Check if domain is blocked
-            if self.blocklist_manager.is_blocked(qname):
-                response_time = (time.time() - start_time) * 1000  # Convert to milliseconds
-                # Estimate bandwidth saved by blocking (prevents HTTP requests)
-                bytes_saved = 1024  # Average 1KB saved per blocked request
-                self.database.log_query(qname, qtype, client_ip, blocked=True, 
-                                      response_time=response_time, bytes_saved=bytes_saved)
-                return self._create_blocked_response(request)
-            
-            # Check cache first
-            cache_key = f"{qname}:{qtype}"
-            cached_response = self.cache.get(cache_key)
-            if cached_response:
-                response_time = (time.time() - start_time) * 1000
-                # Estimate bandwidth saved by caching (no upstream query)
-                bytes_saved = 50  # Average 50 bytes saved per cached response
-                self.database.log_query(qname, qtype, client_ip, cached=True,
-                                      response_time=response_time, bytes_saved=bytes_saved)
-                return cached_response
-            
-            # Forward to upstream DNS
-            response = self._forward_query(request)
-            if response:
-                response_time = (time.time() - start_time) * 1000
-                # Calculate response size for bandwidth tracking
-                response_size = len(response.pack()) if hasattr(response, 'pack') else 100
-                
-                # Cache the response
-                self.cache.set(cache_key, response, ttl=300)  # 5 minutes default TTL
-                
-                # Log successful query with bandwidth usage
-                self.database.log_query(qname, qtype, client_ip, response_time=response_time)
-                return response
-            else:
-                response_time = (time.time() - start_time) * 1000
-                self.database.log_query(qname, qtype, client_ip, response_time=response_time)
-                return self._create_error_response(request)
+            reply = self.resolve_local(request, client_ip, start_time)
+            if reply is None:
+                reply = self.resolve_upstream(request, client_ip, start_time)
+            return reply
                 
         except Exception as e:
             print(f"Error resolving DNS query: {e}")
             return self._create_error_response(request)
     
+    def resolve_local(self, request, client_ip, start_time=None):
+        """Answer from the blocklist or the cache; returns None when upstream is needed"""
+        if start_time is None:
+            start_time = time.time()
+        
+        # Parse the request
+        query = request.get_q()
+        qname = str(query.qname).rstrip('.')
+        qtype = QTYPE[query.qtype]
+        
+        # Check if domain is blocked
+        if self.blocklist_manager.is_blocked(qname):
+            self._log_blocked(qname, qtype, client_ip, start_time)
+            return self._create_blocked_response(request)
+        
+        # Check cache first
+        cache_key = self._cache_key(qname, qtype)
+        cached_response, refresh = self.cache.lookup(cache_key, request.header.id,
+                                                      query=request.pack())
+        if cached_response:
+            if refresh:
+                self.refresh_executor.submit(self._refresh, request, cache_key)
+            self._log_cached(qname, qtype, client_ip, start_time)
+            return cached_response
+        
+        return None
+    
+    def resolve_local_wire(self, data, question, client_ip, start_time=None):
+        """Wire-format resolve_local used by the asyncio engine
+        
+        question is dns_wire.parse_question(data). Returns the reply bytes,
+        or None when upstream is needed. Cache hits are answered by
+        patching the cached bytes, without building any dnslib objects.
+        """
+        if start_time is None:
+            start_time = time.time()
+        
+        qname, qtype, _ = question
+        qtype = QTYPE[qtype]
+        
+        if self.blocklist_manager.is_blocked(qname):
+            self._log_blocked(qname, qtype, client_ip, start_time)
+            return self._create_blocked_response(DNSRecord.parse(data)).pack()
+        
+        cache_key = self._cache_key(qname, qtype)
+        cached_data, refresh = self.cache.lookup_wire(cache_key, dns_wire.get_id(data), query=data)
+        if cached_data is None:
+            return None
+        if refresh:
+            self.refresh_executor.submit(self._refresh, DNSRecord.parse(data), cache_key)
+        self._log_cached(qname, qtype, client_ip, start_time)
+        return cached_data
+    
+    @staticmethod
+    def _cache_key(qname, qtype):
+        """Cache key for a query name and type name"""
+        return f"{qname.lower()}:{qtype}"
+    
+    def _log_blocked(self, qname, qtype, client_ip, start_time):
+        """Log a blocked query"""
+        response_time = (time.time() - start_time) * 1000  # Convert to milliseconds
+        # Estimate bandwidth saved by blocking (prevents HTTP requests)
+        bytes_saved = 1024  # Average 1KB saved per blocked request
+        self.database.log_query(qname, qtype, client_ip, blocked=True, 
+                              response_time=response_time, bytes_saved=bytes_saved)
+    
+    def _log_cached(self, qname, qtype, client_ip, start_time):
+        """Log a query answered from the cache"""
+        response_time = (time.time() - start_time) * 1000
+        # Estimate bandwidth saved by caching (no upstream query)
+        bytes_saved = 50  # Average 50 bytes saved per cached response
+        self.database.log_query(qname, qtype, client_ip, cached=True,
+                              response_time=response_time, bytes_saved=bytes_saved)
+    
+    def resolve_upstream(self, request, client_ip, start_time=None):
+        """Forward a query that missed the cache and cache the answer"""
+        if start_time is None:
+            start_time = time.time()
+        
+        query = request.get_q()
+        qname = str(query.qname).rstrip('.')
+        qtype = QTYPE[query.qtype]
+        cache_key = self._cache_key(qname, qtype)
+        
+        # Concurrent misses for the same name share one upstream query
+        response, shared = self.cache.inflight.do(
+            cache_key, lambda: self._fetch_and_cache(request, cache_key))
+        response_time = (time.time() - start_time) * 1000
+        
+        if response is None:
+            self.database.log_query(qname, qtype, client_ip, response_time=response_time)
+            return self._create_error_response(request)
+        
+        if shared:
+            # Give this client its own copy carrying its transaction ID
+            reply = bytearray(response.pack())
+            dns_wire.copy_question(reply, request.pack())
+            response = DNSRecord.parse(bytes(reply))
+            response.header.id = request.header.id
+            # No upstream query was made for this client, like a cache hit
+            self.database.log_query(qname, qtype, client_ip, cached=True,
+                                  response_time=response_time, bytes_saved=50)
+            return response
+        
+        # Log successful query with bandwidth usage
+        self.database.log_query(qname, qtype, client_ip, response_time=response_time)
+        return response
+    
+    def _refresh(self, request, cache_key):
+        """Re-fetch a stale or soon-to-expire cache entry in the background"""
+        try:
+            response, shared = self.cache.inflight.do(
+                cache_key, lambda: self._fetch_and_cache(request, cache_key))
+            if not shared and (response is None or self.cache.response_ttl(response) is None):
+                self.cache.refresh_failed(cache_key)
+        except Exception as e:
+            print(f"Error refreshing {cache_key}: {e}")
+            self.cache.refresh_failed(cache_key)
+    
+    def _fetch_and_cache(self, request, cache_key):
+        """Forward a query upstream and cache the response"""
+        response = self._forward_query(request)
+        if response:
+            # Cache the response for as long as its records allow
+            self.cache.set(cache_key, response)
+        return response
+    
     def _create_blocked_response(self, request):
         """Create a response for blocked domains"""
         reply = request.reply()
@@ -89,29 +202,7 @@ class DNSFilterResolver(BaseResolver):
     
     def _forward_query(self, request):
         """Forward query to upstream DNS servers"""
-        for upstream in self.upstream_servers:
-            try:
-                # Create socket for DNS query
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.settimeout(5.0)  # 5 second timeout
-                
-                # Send query to upstream server
-                query_data = request.pack()
-                sock.sendto(query_data, (upstream, 53))
-                
-                # Receive response
-                response_data, _ = sock.recvfrom(512)
-                sock.close()
-                
-                # Parse and return response
-                response = DNSRecord.parse(response_data)
-                return response
-                
-            except Exception as e:
-                print(f"Error forwarding to {upstream}: {e}")
-                continue
-        
-        return None
+        return self.upstream_client.query(request)
 
 class DNSServer:
     """DNS Server wrapper class"""
@@ -128,14 +219,25 @@ class DNSServer:
         """Start the DNS server"""
         try:
             self.running = True
-            self.server = DNSLibServer(
-                self.resolver,
-                port=self.config.dns_port,
-                address=self.config.dns_host,
-                tcp=False
-            )
+            if self.config.dns_engine == "threaded":
+                self.server = DNSLibServer(
+                    self.resolver,
+                    port=self.config.dns_port,
+                    address=self.config.dns_host,
+                    tcp=False
+                )
+            else:
+                self.server = AsyncDNSServer(
+                    self.resolver,
+                    self.config.dns_host,
+                    self.config.dns_port,
+                    max_concurrent_queries=self.config.max_concurrent_queries,
+                    upstream_workers=self.config.upstream_workers,
+                    tcp_enabled=self.config.tcp_enabled,
+                    tcp_idle_timeout=self.config.tcp_idle_timeout
+                )
             
-            print(f"DNS Server listening on {self.config.dns_host}:{self.config.dns_port}")
+            print(f"DNS Server listening on {self.config.dns_host}:{self.config.dns_port} ({self.config.dns_engine})")
             self.server.start()
             
         except Exception as e:
@@ -151,3 +253,5 @@ class DNSServer:
                 print("DNS Server stopped")
             except Exception as e:
                 print(f"Error stopping DNS server: {e}")
+        self.resolver.upstream_client.stop()
+        self.resolver.cache.stop()
@@ -0,0 +1,144 @@
+"""
+DNS Wire Format Helpers
+Minimal parsing of raw DNS messages without building dnslib objects
+"""
+
+import struct
+
+HEADER_SIZE = 12
+
+TYPE_OPT = 41
+
+# Largest UDP reply for clients that do not advertise an EDNS buffer size
+DEFAULT_UDP_PAYLOAD = 512
+
+def read_name(data, offset):
+    """Read a possibly compressed domain name; returns (name, end_offset)
+
+    The name is returned lowercased without the trailing dot. end_offset
+    is the position right after the name in the original message.
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 32:
+                raise ValueError("Compression loop in DNS name")
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        labels.append(bytes(data[offset:offset + length]).decode('ascii', 'replace'))
+        offset += length
+
+    return '.'.join(labels).lower(), end if end is not None else offset
+
+def skip_name(data, offset):
+    """Return the offset right after a (possibly compressed) name"""
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+def parse_question(data):
+    """Return (qname, qtype, qclass) of the first question, or None"""
+    try:
+        if len(data) < HEADER_SIZE or struct.unpack_from('!H', data, 4)[0] == 0:
+            return None
+        qname, offset = read_name(data, HEADER_SIZE)
+        qtype, qclass = struct.unpack_from('!HH', data, offset)
+        return qname, qtype, qclass
+    except (IndexError, ValueError, struct.error):
+        return None
+
+def get_id(data):
+    """Return the transaction ID of a message"""
+    return struct.unpack_from('!H', data, 0)[0]
+
+def set_id(data, txid):
+    """Return a copy of the message carrying a different transaction ID"""
+    return struct.pack('!H', txid) + bytes(data[2:])
+
+def is_truncated(data):
+    """Check the TC bit of a message"""
+    return len(data) > 2 and bool(data[2] & 0x02)
+
+def _skip_questions(data):
+    """Return the offset of the answer section"""
+    offset = HEADER_SIZE
+    for _ in range(struct.unpack_from('!H', data, 4)[0]):
+        offset = skip_name(data, offset) + 4
+    return offset
+
+def ttl_offsets(data):
+    """Return the offsets of the TTL field of every record except OPT"""
+    ancount, nscount, arcount = struct.unpack_from('!HHH', data, 6)
+    offset = _skip_questions(data)
+    offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = skip_name(data, offset)
+        rtype, _, _, rdlength = struct.unpack_from('!HHIH', data, offset)
+        if rtype != TYPE_OPT:
+            offsets.append(offset + 4)
+        offset += 10 + rdlength
+    return tuple(offsets)
+
+def copy_question(reply, query):
+    """Give a reply bytearray the RD bit and question name spelling of a query
+
+    Cache keys ignore case, so the cached reply may spell the name
+    differently from this client's query (e.g. with 0x20 randomization).
+    The name is only copied when both are the same length.
+    """
+    reply[2] = (reply[2] & 0xFE) | (query[2] & 0x01)
+    try:
+        end = skip_name(query, HEADER_SIZE)
+        if skip_name(reply, HEADER_SIZE) == end:
+            reply[HEADER_SIZE:end] = query[HEADER_SIZE:end]
+    except IndexError:
+        pass
+
+def patch_reply(data, txid, offsets, age=0, ttl=None, query=None):
+    """Copy a cached message with a new ID and its TTLs aged or replaced
+
+    offsets comes from ttl_offsets(). Every TTL is set to ttl when given,
+    otherwise reduced by age seconds (never below zero). When the query
+    bytes are given, its RD bit and question name are copied as well.
+    """
+    reply = bytearray(data)
+    struct.pack_into('!H', reply, 0, txid)
+    if query is not None:
+        copy_question(reply, query)
+    if ttl is not None:
+        for offset in offsets:
+            struct.pack_into('!I', reply, offset, ttl)
+    elif age > 0:
+        for offset in offsets:
+            remaining = struct.unpack_from('!I', reply, offset)[0] - age
+            struct.pack_into('!I', reply, offset, remaining if remaining > 0 else 0)
+    return bytes(reply)
+
+def udp_payload_size(data):
+    """Return the UDP reply size a query allows, from its EDNS OPT record"""
+    try:
+        ancount, nscount, arcount = struct.unpack_from('!HHH', data, 6)
+        offset = _skip_questions(data)
+        for index in range(ancount + nscount + arcount):
+            offset = skip_name(data, offset)
+            rtype, rclass, _, rdlength = struct.unpack_from('!HHIH', data, offset)
+            if rtype == TYPE_OPT and index >= ancount + nscount:
+                return max(DEFAULT_UDP_PAYLOAD, rclass)
+            offset += 10 + rdlength
+    except (IndexError, struct.error):
+        pass
+    return DEFAULT_UDP_PAYLOAD
@@ -19,10 +19,18 @@ class DNSFilterApp:
     def __init__(self):
         """Initialize the DNS filtering application"""
         self.config = Config()
-        self.database = Database()
-        self.blocklist_manager = BlocklistManager(self.database)
+        self.database = Database(log_queue_size=self.config.log_queue_size,
+                                 log_batch_size=self.config.log_batch_size,
+                                 log_flush_interval=self.config.log_flush_interval,
+                                 stats_rollups=self.config.stats_rollups,
+                                 stats_sketch_hours=self.config.stats_sketch_hours)
+        self.blocklist_manager = BlocklistManager(self.database,
+                                                  fetch_workers=self.config.blocklist_fetch_workers,
+                                                  fetch_timeout=self.config.blocklist_fetch_timeout,
+                                                  index_file=self.config.blocklist_index_file)
         self.dns_server = DNSServer(self.config, self.database, self.blocklist_manager)
-        self.web_dashboard = WebDashboard(self.config, self.database, self.blocklist_manager)
+        self.web_dashboard = WebDashboard(self.config, self.database, self.blocklist_manager,
+                                          self.dns_server)
         
         # Threading control
         self.running = True
@@ -35,7 +43,18 @@ class DNSFilterApp:
         
         # Initialize database and blocklists
         self.database.initialize()
-        self.blocklist_manager.load_blocklists()
+        # Serve the compiled blocklist index right away if no list changed on
+        # disk, and check remote lists for updates in the background
+        if self.blocklist_manager.load_compiled_index():
+            threading.Thread(target=self.blocklist_manager.update_blocklists, daemon=True).start()
+        else:
+            self.blocklist_manager.load_blocklists()
+        
+        # Restore cached answers from the last run before serving
+        cache = self.dns_server.resolver.cache
+        if cache.snapshot_file:
+            loaded = cache.load_snapshot()
+            print(f"Restored {loaded} cached DNS responses")
         
         # Start DNS server in a separate thread
         self.dns_thread = threading.Thread(target=self.dns_server.start, daemon=True)
@@ -73,6 +92,12 @@ class DNSFilterApp:
         if self.web_dashboard:
             self.web_dashboard.stop()
             
+        if self.blocklist_manager:
+            self.blocklist_manager.close()
+            
+        if self.database:
+            self.database.close()
+            
         print("Application stopped successfully.")
         
     def signal_handler(self, sig, frame):
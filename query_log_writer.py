@@ -0,0 +1,140 @@
+"""
+Query Log Writer
+Background pipeline that batches DNS query log rows into SQLite
+"""
+
+import queue
+import threading
+import time
+
+class QueryLogWriter:
+    """Bounded in-memory queue drained by a writer thread in batches"""
+
+    def __init__(self, connections, partitions, queue_size=100000, batch_size=500, flush_interval=1.0,
+                 rollups=None):
+        self.connections = connections
+        # QueryPartitions routing each row to the table for its day
+        self.partitions = partitions
+        # QueryRollups updated in the same transaction as each batch
+        self.rollups = rollups
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.stats = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped': 0,
+            'batches': 0,
+            'errors': 0
+        }
+
+        self.running = False
+        self.writer_thread = None
+        self._flush_requested = threading.Event()
+        self._flushed = threading.Condition()
+
+    def start(self):
+        """Start the background writer thread"""
+        if self.running:
+            return
+        self.running = True
+        self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the writer thread after draining queued rows"""
+        if not self.running:
+            return
+        self.running = False
+        self._flush_requested.set()
+        if self.writer_thread:
+            self.writer_thread.join(timeout)
+            self.writer_thread = None
+
+    def enqueue(self, row):
+        """Queue a row for writing; never blocks, drops the row when full"""
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            with self.lock:
+                self.stats['dropped'] += 1
+            return False
+
+        with self.lock:
+            self.stats['enqueued'] += 1
+        return True
+
+    def flush(self, timeout=5.0):
+        """Block until everything queued so far has been written"""
+        if not self.running:
+            self._write_batch(self._drain())
+            return
+        with self._flushed:
+            self._flush_requested.set()
+            self._flushed.wait(timeout)
+
+    def get_stats(self):
+        """Get writer statistics"""
+        with self.lock:
+            stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+    def _drain(self, limit=None):
+        """Take up to limit rows from the queue without waiting"""
+        rows = []
+        while limit is None or len(rows) < limit:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _writer_loop(self):
+        """Collect rows until the batch is full or the deadline passes"""
+        try:
+            while self.running or not self.queue.empty():
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+                while len(batch) < self.batch_size:
+                    if self._flush_requested.is_set():
+                        batch.extend(self._drain())
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=min(remaining, 0.1)))
+                    except queue.Empty:
+                        continue
+
+                self._write_batch(batch)
+
+                if self._flush_requested.is_set() and self.queue.empty():
+                    self._flush_requested.clear()
+                    with self._flushed:
+                        self._flushed.notify_all()
+        finally:
+            with self._flushed:
+                self._flushed.notify_all()
+
+    def _write_batch(self, batch):
+        """Insert a batch of rows in a single transaction"""
+        if not batch:
+            return
+
+        try:
+            self.partitions.prepare(batch)
+            with self.connections.writer() as conn:
+                self.partitions.insert(conn, batch)
+                if self.rollups is not None:
+                    self.rollups.apply(conn, batch)
+            with self.lock:
+                self.stats['written'] += len(batch)
+                self.stats['batches'] += 1
+        except Exception as e:
+            print(f"Error writing query log batch: {e}")
+            with self.lock:
+                self.stats['errors'] += 1
@@ -0,0 +1,144 @@
+"""
+Query Log Dictionaries
+Interns the domains, query types and client addresses of the query log as integer ids
+"""
+
+import ipaddress
+from cache_policy import LRUPolicy
+
+# The view's client_ip: dotted quad for IPv4, hex for IPv6, anything else as stored
+CLIENT_IP_SQL = '''CASE typeof(c.address)
+    WHEN 'integer' THEN (c.address >> 24) || '.' || (c.address >> 16 & 255) || '.' ||
+                        (c.address >> 8 & 255) || '.' || (c.address & 255)
+    WHEN 'blob' THEN lower(hex(c.address))
+    ELSE c.address END'''
+
+def pack_address(client_ip):
+    """Stored form of a client address: an integer for IPv4, 16 bytes for IPv6"""
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return client_ip
+    return int(address) if address.version == 4 else address.packed
+
+def unpack_address(address):
+    """Text form of an address stored by pack_address"""
+    if isinstance(address, int):
+        return str(ipaddress.IPv4Address(address))
+    if isinstance(address, bytes):
+        return str(ipaddress.IPv6Address(address))
+    return address
+
+class NameDictionary:
+    """A (id, value) table with an LRU cache of the ids of recent keys"""
+
+    def __init__(self, table, column, cache_size, pack=None):
+        self.table = table
+        self.column = column
+        self.pack = pack
+        self.cache = LRUPolicy(cache_size)
+
+    def ids(self, conn, keys):
+        """{key: id} for keys, adding the ones not in the table yet
+
+        Only ids already committed are cached: a key added here belongs
+        to the caller's transaction, which may still roll back, so it is
+        looked up again (and cached) the next time it is seen.
+        """
+        cache = self.cache
+        ids = {}
+        for key in keys:
+            value = cache.get(key)
+            if value is not None:
+                cache.on_hit(key)
+                ids[key] = value
+                continue
+            stored = self.pack(key) if self.pack else key
+            row = conn.execute(f'SELECT id FROM {self.table} WHERE {self.column} = ?',
+                               (stored,)).fetchone()
+            if row is None:
+                ids[key] = conn.execute(f'INSERT INTO {self.table} ({self.column}) VALUES (?)',
+                                        (stored,)).lastrowid
+            else:
+                ids[key] = row[0]
+                cache.put(key, row[0])
+        return ids
+
+class QueryNames:
+    """Dictionary tables behind the integer columns of the query log partitions
+
+    query_domains and query_types hold names and query_clients holds
+    addresses packed by pack_address, each under an INTEGER PRIMARY KEY
+    that the partitions store instead of the text. The log writer turns
+    names into ids through an LRU cache per dictionary, so only names
+    it has not seen recently are looked up. Domains no partition refers
+    to are deleted when retention drops partitions; query types and
+    clients are few and kept.
+    """
+
+    def __init__(self, domain_cache_size=20000, client_cache_size=1000):
+        self.domains = NameDictionary('query_domains', 'name', domain_cache_size)
+        self.query_types = NameDictionary('query_types', 'name', 64)
+        self.clients = NameDictionary('query_clients', 'address', client_cache_size,
+                                      pack=pack_address)
+
+    def create_tables(self, conn):
+        """Create the dictionary tables"""
+        for table in ('query_domains', 'query_types'):
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL UNIQUE
+                )
+            ''')
+        # No declared type, so IPv4 integers and IPv6 blobs are kept as given
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_clients (
+                id INTEGER PRIMARY KEY,
+                address NOT NULL UNIQUE
+            )
+        ''')
+
+    def encode(self, conn, rows):
+        """Replace the domain, query_type and client_ip of (timestamp, domain, ...) rows with ids"""
+        domains = self.domains.ids(conn, {row[1] for row in rows})
+        query_types = self.query_types.ids(conn, {row[2] for row in rows})
+        clients = self.clients.ids(conn, {row[3] for row in rows})
+        return [(timestamp, domains[domain], query_types[query_type], clients[client],
+                 blocked, cached, response_time, bytes_saved)
+                for timestamp, domain, query_type, client, blocked, cached, response_time, bytes_saved
+                in rows]
+
+    def import_rows(self, conn, source, target, where='1', params=()):
+        """Copy rows of a query log table with text columns into the partition target"""
+        conn.execute(f'INSERT OR IGNORE INTO query_domains (name) '
+                     f'SELECT DISTINCT domain FROM {source} WHERE {where}', params)
+        conn.execute(f'INSERT OR IGNORE INTO query_types (name) '
+                     f'SELECT DISTINCT query_type FROM {source} WHERE {where}', params)
+        clients = self.clients.ids(conn, {row[0] for row in conn.execute(
+            f'SELECT DISTINCT client_ip FROM {source} WHERE {where}', params)})
+        conn.create_function('query_client_id', 1, clients.get, deterministic=True)
+        try:
+            conn.execute(f'''
+                INSERT INTO {target} (timestamp, domain_id, query_type_id, client_id, blocked,
+                                      cached, response_time, bytes_saved)
+                SELECT q.timestamp, d.id, t.id, query_client_id(q.client_ip), q.blocked,
+                       q.cached, q.response_time, q.bytes_saved
+                FROM {source} q
+                JOIN query_domains d ON d.name = q.domain
+                JOIN query_types t ON t.name = q.query_type
+                WHERE {where}
+                ORDER BY q.timestamp
+            ''', params)
+        finally:
+            conn.create_function('query_client_id', 1, None)
+
+    def prune(self, conn, dropped, kept):
+        """Delete the domains of the dropped partitions that none of the kept ones refer to"""
+        candidates = ' UNION '.join(f'SELECT domain_id FROM {table}' for table in dropped)
+        # Newest first: a domain still in use is usually found in the first
+        unused = ''.join(f' AND NOT EXISTS (SELECT 1 FROM {table} WHERE domain_id = query_domains.id)'
+                         for table in kept)
+        conn.execute(f'DELETE FROM query_domains WHERE id IN ({candidates}){unused}')
+        # Deleted ids may be handed out again
+        self.domains.cache.clear()
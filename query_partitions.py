@@ -0,0 +1,247 @@
+"""
+Query Log Partitions
+Stores the query log in one table per UTC day behind a queries view
+"""
+
+import calendar
+import sqlite3
+import time
+from query_names import CLIENT_IP_SQL, QueryNames
+
+DAY = 86400
+PREFIX = 'queries_'
+COLUMNS = ('timestamp', 'domain_id', 'query_type_id', 'client_id', 'blocked', 'cached',
+           'response_time', 'bytes_saved')
+# Columns of each partition's covering stats index
+STATS_COLUMNS = ('timestamp', 'blocked', 'cached', 'domain_id', 'bytes_saved', 'response_time')
+# Columns of each partition's domain index, which serves per-domain
+# aggregates in domain order without sorting
+DOMAIN_COLUMNS = ('domain_id', 'timestamp', 'blocked', 'cached', 'bytes_saved')
+# Share of a partition's rows a window must cover before its per-domain
+# aggregates are read from the domain index: that reads every row of the
+# day but needs no sort, which costs about three times as much per row
+DOMAIN_SCAN_SHARE = 0.3
+
+class QueryPartitions:
+    """Routes query log writes and reads to per-day tables
+
+    Each logged row goes to queries_YYYYMMDD for its UTC day. Retention
+    drops whole days with DROP TABLE instead of deleting rows, and stats
+    read only the days a time window overlaps. A queries view over every
+    partition keeps the log readable as a single table for ad-hoc use.
+
+    Partitions store domains, query types and clients as ids into the
+    QueryNames dictionaries; the view joins the names back in. Rows are
+    written as (timestamp, domain, query_type, client_ip, ...) and
+    interned on the way in.
+
+    A partition is created in its own transaction before rows are written
+    to it, and only then listed in days, so readers never route to a
+    table they cannot see yet.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.names = QueryNames()
+        # Days (timestamp // DAY) that have a committed partition, oldest first
+        self.days = []
+
+    @staticmethod
+    def table(day):
+        """Partition table name of a day"""
+        return PREFIX + time.strftime('%Y%m%d', time.gmtime(day * DAY))
+
+    def create_tables(self, conn):
+        """Create the dictionaries, today's partition and the view, converting older layouts
+
+        Rows of an unpartitioned queries table are moved into partitions,
+        and partitions that store names as text are rewritten with ids.
+        """
+        self.names.create_tables(conn)
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'queries'").fetchone()
+        if row is not None and row[0] == 'table':
+            self._migrate(conn)
+        text_days = [day for day in self._partition_days(conn)
+                     if 'domain' in [row[1] for row in conn.execute(f'PRAGMA table_info({self.table(day)})')]]
+        if text_days:
+            print(f"Moving names of {len(text_days)} query log days into dictionary tables...")
+            conn.execute('DROP VIEW IF EXISTS queries')
+            for day in text_days:
+                self._normalize(conn, day)
+        self.create_partition(conn, int(time.time()) // DAY)
+
+    def load(self, conn):
+        """Read the list of partitions"""
+        self.days = self._partition_days(conn)
+
+    def create_partition(self, conn, day, view=True):
+        """Create the table and indexes of a day if missing and rebuild the view"""
+        table = self.table(day)
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                domain_id INTEGER NOT NULL,
+                query_type_id INTEGER NOT NULL,
+                client_id INTEGER NOT NULL,
+                blocked INTEGER DEFAULT 0,
+                cached INTEGER DEFAULT 0,
+                response_time REAL DEFAULT 0,
+                bytes_saved INTEGER DEFAULT 0
+            )
+        ''')
+        # Covers every column the stats read, so a time window is
+        # summarised from the index alone without touching the rows
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_stats ON {table}({", ".join(STATS_COLUMNS)})')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_domain ON {table}({", ".join(DOMAIN_COLUMNS)})')
+        if view:
+            self._create_view(conn)
+
+    def prepare(self, rows):
+        """Create the partitions rows will be written to, each committed before use"""
+        missing = {row[0] // DAY for row in rows}.difference(self.days)
+        if not missing:
+            return
+        with self.connections.write_lock:
+            with self.connections.writer() as conn:
+                for day in sorted(missing):
+                    self.create_partition(conn, day)
+            # Committed: readers may use them now
+            self.days = sorted(self.days + list(missing))
+
+    def insert(self, conn, rows):
+        """Write (timestamp, domain, ...) rows to their partitions"""
+        by_day = {}
+        for row in self.names.encode(conn, rows):
+            by_day.setdefault(row[0] // DAY, []).append(row)
+        columns = ', '.join(COLUMNS)
+        for day, day_rows in by_day.items():
+            conn.executemany(f'''
+                INSERT INTO {self.table(day)} ({columns})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', day_rows)
+
+    def source(self, since, columns=STATS_COLUMNS):
+        """FROM clause reading columns from the partitions holding timestamps after since
+
+        Only the requested columns are selected from each partition, so
+        a query over the default ones is answered from the stats indexes.
+        """
+        selected = self._window_days(since)
+        if not selected:
+            return '(SELECT ' + ', '.join(f'NULL AS {column}' for column in columns) + ' WHERE 0)'
+        if len(selected) == 1:
+            return self.table(selected[0])
+        columns = ', '.join(columns)
+        return '(' + ' UNION ALL '.join(f'SELECT {columns} FROM {self.table(day)}'
+                                        for day in selected) + ')'
+
+    def domain_source(self, since, aggregates, where=None):
+        """FROM clause of (domain_id, aggregates...) per domain over rows with timestamps after since
+
+        aggregates maps column names to COUNT or SUM expressions of the
+        domain index columns, and where optionally filters on them. Each
+        partition is grouped on its own, from the domain index if the
+        window covers enough of it, and the results are summed.
+        """
+        since = int(since)
+        now = int(time.time())
+        columns = ', '.join(f'{expression} AS {name}' for name, expression in aggregates.items())
+        condition = f'timestamp > {since}' + (f' AND {where}' if where else '')
+        branches = []
+        for day in self._window_days(since):
+            table = self.table(day)
+            start, end = day * DAY, min((day + 1) * DAY, now)
+            if end - max(since, start) >= DOMAIN_SCAN_SHARE * (end - start):
+                branches.append(f'SELECT domain_id, {columns} FROM {table} INDEXED BY idx_{table}_domain '
+                                f'WHERE {condition} GROUP BY domain_id')
+            else:
+                # +domain_id keeps SQLite on the time range of the stats index
+                branches.append(f'SELECT domain_id, {columns} FROM {table} '
+                                f'WHERE {condition} GROUP BY +domain_id')
+        if not branches:
+            return '(SELECT NULL AS domain_id, ' + ', '.join(f'NULL AS {name}' for name in aggregates) + ' WHERE 0)'
+        if len(branches) == 1:
+            return f'({branches[0]})'
+        totals = ', '.join(f'SUM({name}) AS {name}' for name in aggregates)
+        return (f'(SELECT domain_id, {totals} FROM ({" UNION ALL ".join(branches)}) '
+                f'GROUP BY domain_id)')
+
+    def tables(self):
+        """Partition table names, newest first"""
+        return [self.table(day) for day in reversed(self.days)]
+
+    def drop_before(self, conn, timestamp):
+        """Drop every partition that ends before the day of timestamp; returns the rows dropped"""
+        first = timestamp // DAY
+        days = self._partition_days(conn)
+        dropped = [day for day in days if day < first]
+        self.days = [day for day in self.days if day >= first]
+        if not dropped:
+            return 0
+        self.names.prune(conn, [self.table(day) for day in dropped],
+                         [self.table(day) for day in reversed(days) if day >= first])
+        deleted = 0
+        for day in dropped:
+            table = self.table(day)
+            deleted += conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            conn.execute(f'DROP TABLE {table}')
+        self._create_view(conn)
+        return deleted
+
+    def _window_days(self, since):
+        """Partition days holding timestamps after since, or the newest one"""
+        if not self.days:
+            with self.connections.reader() as conn:
+                self.load(conn)
+        days = self.days
+        today = int(time.time()) // DAY
+        return [day for day in days if since // DAY <= day <= today] or days[-1:]
+
+    def _partition_days(self, conn):
+        """Days with a partition table, oldest first"""
+        days = []
+        for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                    "AND name GLOB 'queries_[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]'"):
+            days.append(calendar.timegm(time.strptime(name[len(PREFIX):], '%Y%m%d')) // DAY)
+        return sorted(days)
+
+    def _create_view(self, conn):
+        """Point the queries view at the current partitions, with names in place of ids"""
+        conn.execute('DROP VIEW IF EXISTS queries')
+        tables = [self.table(day) for day in self._partition_days(conn)]
+        if tables:
+            conn.execute('CREATE VIEW queries AS ' + ' UNION ALL '.join(f'''
+                SELECT p.id, p.timestamp, d.name AS domain, t.name AS query_type,
+                       {CLIENT_IP_SQL} AS client_ip,
+                       p.blocked, p.cached, p.response_time, p.bytes_saved
+                FROM {table} p
+                JOIN query_domains d ON d.id = p.domain_id
+                JOIN query_types t ON t.id = p.query_type_id
+                JOIN query_clients c ON c.id = p.client_id
+            ''' for table in tables))
+
+    def _migrate(self, conn):
+        """Move the rows of an unpartitioned queries table into partitions"""
+        try:
+            conn.execute('ALTER TABLE queries ADD COLUMN bytes_saved INTEGER DEFAULT 0')
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+        days = [row[0] for row in conn.execute(f'SELECT DISTINCT timestamp / {DAY} FROM queries')]
+        print(f"Partitioning query log into {len(days)} days...")
+        conn.execute('ALTER TABLE queries RENAME TO queries_unpartitioned')
+        for day in days:
+            self.create_partition(conn, day, view=False)
+            self.names.import_rows(conn, 'queries_unpartitioned', self.table(day),
+                                   'timestamp >= ? AND timestamp < ?', (day * DAY, (day + 1) * DAY))
+        conn.execute('DROP TABLE queries_unpartitioned')
+
+    def _normalize(self, conn, day):
+        """Rewrite a partition that stores names as text with dictionary ids"""
+        table = self.table(day)
+        conn.execute(f'DROP INDEX IF EXISTS idx_{table}_stats')
+        conn.execute(f'DROP INDEX IF EXISTS idx_{table}_domain_time')
+        conn.execute(f'ALTER TABLE {table} RENAME TO {table}_text')
+        self.create_partition(conn, day, view=False)
+        self.names.import_rows(conn, f'{table}_text', table)
+        conn.execute(f'DROP TABLE {table}_text')
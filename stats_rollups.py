@@ -0,0 +1,214 @@
+"""
+Query Log Rollups
+Per-minute and per-hour aggregates of the query log, updated as rows are written
+"""
+
+import time
+
+MINUTE = 60
+HOUR = 3600
+
+class QueryRollups:
+    """Keeps stats_minute, stats_hour and stats_hour_domain in step with queries
+
+    The log writer hands every batch to apply() inside the transaction that
+    inserts it, so the rollups always agree with the raw rows. A window is
+    read as the whole hours inside it plus the minutes at its edges, so the
+    cost of a stats query depends on the length of the window, not on how
+    many queries were logged. Totals are exact to the minute; per-domain
+    counters are kept per hour and include the whole first hour.
+    """
+
+    BUCKET_COLUMNS = ('total', 'blocked', 'cached', 'bytes_saved', 'response_time')
+
+    def create_tables(self, conn):
+        """Create the rollup tables if they do not exist"""
+        for table in ('stats_minute', 'stats_hour'):
+            # response_time holds the sum, in milliseconds
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    bucket INTEGER PRIMARY KEY,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    cached INTEGER NOT NULL DEFAULT 0,
+                    bytes_saved INTEGER NOT NULL DEFAULT 0,
+                    response_time REAL NOT NULL DEFAULT 0
+                )
+            ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_hour_domain (
+                bucket INTEGER NOT NULL,
+                domain TEXT NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                cached INTEGER NOT NULL DEFAULT 0,
+                bytes_saved INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, domain)
+            ) WITHOUT ROWID
+        ''')
+
+    def rebuild(self, conn):
+        """Recompute every rollup from the queries table"""
+        conn.execute('DELETE FROM stats_minute')
+        conn.execute('DELETE FROM stats_hour')
+        conn.execute('DELETE FROM stats_hour_domain')
+        for table, size in (('stats_minute', MINUTE), ('stats_hour', HOUR)):
+            conn.execute(f'''
+                INSERT INTO {table} (bucket, total, blocked, cached, bytes_saved, response_time)
+                SELECT (timestamp / {size}) * {size}, COUNT(*), SUM(blocked), SUM(cached),
+                       COALESCE(SUM(bytes_saved), 0), COALESCE(SUM(response_time), 0)
+                FROM queries
+                GROUP BY 1
+            ''')
+        conn.execute(f'''
+            INSERT INTO stats_hour_domain (bucket, domain, total, blocked, cached, bytes_saved)
+            SELECT (timestamp / {HOUR}) * {HOUR}, domain, COUNT(*), SUM(blocked), SUM(cached),
+                   COALESCE(SUM(bytes_saved), 0)
+            FROM queries
+            GROUP BY 1, domain
+        ''')
+
+    def apply(self, conn, rows):
+        """Add a batch of query log rows to the rollups
+
+        Rows are (timestamp, domain, query_type, client_ip, blocked, cached,
+        response_time, bytes_saved) tuples, as queued for the queries table.
+        """
+        minutes = {}
+        domains = {}
+        for timestamp, domain, _, _, blocked, cached, response_time, bytes_saved in rows:
+            bytes_saved = bytes_saved or 0
+            minute = timestamp - timestamp % MINUTE
+            counts = minutes.get(minute)
+            if counts is None:
+                counts = minutes[minute] = [0, 0, 0, 0, 0.0]
+            counts[0] += 1
+            counts[1] += blocked
+            counts[2] += cached
+            counts[3] += bytes_saved
+            counts[4] += response_time or 0
+
+            key = (timestamp - timestamp % HOUR, domain)
+            counts = domains.get(key)
+            if counts is None:
+                counts = domains[key] = [0, 0, 0, 0]
+            counts[0] += 1
+            counts[1] += blocked
+            counts[2] += cached
+            counts[3] += bytes_saved
+
+        hours = {}
+        for minute, counts in minutes.items():
+            hour = minute - minute % HOUR
+            totals = hours.get(hour)
+            if totals is None:
+                hours[hour] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    totals[i] += count
+
+        for table, buckets in (('stats_minute', minutes), ('stats_hour', hours)):
+            conn.executemany(f'''
+                INSERT INTO {table} (bucket, total, blocked, cached, bytes_saved, response_time)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(bucket) DO UPDATE SET
+                    total = total + excluded.total,
+                    blocked = blocked + excluded.blocked,
+                    cached = cached + excluded.cached,
+                    bytes_saved = bytes_saved + excluded.bytes_saved,
+                    response_time = response_time + excluded.response_time
+            ''', [(bucket, *counts) for bucket, counts in buckets.items()])
+        conn.executemany('''
+            INSERT INTO stats_hour_domain (bucket, domain, total, blocked, cached, bytes_saved)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(bucket, domain) DO UPDATE SET
+                total = total + excluded.total,
+                blocked = blocked + excluded.blocked,
+                cached = cached + excluded.cached,
+                bytes_saved = bytes_saved + excluded.bytes_saved
+        ''', [(hour, domain, *counts) for (hour, domain), counts in domains.items()])
+
+    def delete_before(self, conn, timestamp):
+        """Drop buckets that end before timestamp"""
+        conn.execute('DELETE FROM stats_minute WHERE bucket < ?', (timestamp - timestamp % MINUTE,))
+        conn.execute('DELETE FROM stats_hour WHERE bucket < ?', (timestamp - timestamp % HOUR,))
+        conn.execute('DELETE FROM stats_hour_domain WHERE bucket < ?', (timestamp - timestamp % HOUR,))
+
+    def _window(self, since, now=None):
+        """SQL selecting (bucket, total, ...) rows that cover timestamps after since
+
+        Whole hours come from stats_hour and the partial hours at either end
+        from stats_minute.
+        """
+        now = int(time.time()) if now is None else now
+        first_minute = since - since % MINUTE
+        first_hour = -(-first_minute // HOUR) * HOUR
+        current_hour = now - now % HOUR
+        columns = ', '.join(self.BUCKET_COLUMNS)
+        if first_hour >= current_hour:
+            return (f'SELECT bucket, {columns} FROM stats_minute WHERE bucket >= ?',
+                    (first_minute,))
+        return (f'''
+            SELECT bucket, {columns} FROM stats_minute WHERE bucket >= ? AND bucket < ?
+            UNION ALL
+            SELECT bucket, {columns} FROM stats_hour WHERE bucket >= ? AND bucket < ?
+            UNION ALL
+            SELECT bucket, {columns} FROM stats_minute WHERE bucket >= ?
+        ''', (first_minute, first_hour, first_hour, current_hour, current_hour))
+
+    def totals(self, conn, since):
+        """(total, blocked, cached, bytes_saved, response_time_sum) after since"""
+        sql, params = self._window(since)
+        row = conn.execute(f'''
+            SELECT COALESCE(SUM(total), 0), COALESCE(SUM(blocked), 0), COALESCE(SUM(cached), 0),
+                   COALESCE(SUM(bytes_saved), 0), COALESCE(SUM(response_time), 0)
+            FROM ({sql})
+        ''', params).fetchone()
+        return tuple(row)
+
+    def hourly(self, conn, since):
+        """[(hour, total, blocked, cached, bytes_saved)] after since, oldest first"""
+        sql, params = self._window(since)
+        return conn.execute(f'''
+            SELECT (bucket / {HOUR}) * {HOUR} AS hour, SUM(total), SUM(blocked), SUM(cached),
+                   SUM(bytes_saved)
+            FROM ({sql})
+            GROUP BY hour
+            ORDER BY hour
+        ''', params).fetchall()
+
+    def unique_domains(self, conn, since):
+        """Number of distinct domains queried after since"""
+        return conn.execute('SELECT COUNT(DISTINCT domain) FROM stats_hour_domain WHERE bucket >= ?',
+                            (since - since % HOUR,)).fetchone()[0]
+
+    def top_domains(self, conn, since, limit=10, blocked_only=False):
+        """[(domain, count)] of the most queried (or most blocked) domains after since"""
+        column = 'blocked' if blocked_only else 'total'
+        return conn.execute(f'''
+            SELECT domain, SUM({column}) AS count
+            FROM stats_hour_domain
+            WHERE bucket >= ? AND {column} > 0
+            GROUP BY domain
+            ORDER BY count DESC
+            LIMIT ?
+        ''', (since - since % HOUR, limit)).fetchall()
+
+    def hour_domains(self, conn, since):
+        """[(hour, domain, total, blocked, cached, bytes_saved)] for the hours from since on"""
+        return conn.execute('''
+            SELECT bucket, domain, total, blocked, cached, bytes_saved
+            FROM stats_hour_domain
+            WHERE bucket >= ?
+        ''', (since - since % HOUR,)).fetchall()
+
+    def top_saving_domains(self, conn, since, limit=10):
+        """[(domain, blocked or cached queries, bytes_saved)] after since, most saved first"""
+        return conn.execute('''
+            SELECT domain, SUM(blocked + cached) AS count, SUM(bytes_saved) AS saved
+            FROM stats_hour_domain
+            WHERE bucket >= ? AND (blocked > 0 OR cached > 0)
+            GROUP BY domain
+            ORDER BY saved DESC, count DESC
+            LIMIT ?
+        ''', (since - since % HOUR, limit)).fetchall()
@@ -0,0 +1,267 @@
+"""
+Query Stats Sketches
+Streaming top-K and distinct-count summaries of recent queries, kept in memory per hour
+"""
+
+import math
+import threading
+import time
+from operator import itemgetter
+
+HOUR = 3600
+
+class SpaceSaving:
+    """Space-Saving heavy-hitter summary of weighted keys
+
+    Tracks at most 2 * capacity keys. When that fills up the smallest
+    half is dropped in one go, and floor records the largest count
+    dropped: a key seen again starts from floor, so every count is an
+    upper bound that is at most floor too high, and any key whose true
+    count exceeds floor is still tracked. While floor is 0 the counts
+    are exact. Summaries merge by adding counts.
+    """
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.counts = {}
+        self.floor = 0
+
+    def add(self, key, weight=1):
+        """Count weight more for key"""
+        counts = self.counts
+        count = counts.get(key)
+        if count is None:
+            counts[key] = self.floor + weight
+            if len(counts) >= 2 * self.capacity:
+                self._prune()
+        else:
+            counts[key] = count + weight
+
+    def estimate(self, key):
+        """Upper bound on the count of key"""
+        return self.counts.get(key, self.floor)
+
+    def top(self, n):
+        """[(key, count)] of the n largest counts"""
+        return sorted(self.counts.items(), key=itemgetter(1), reverse=True)[:n]
+
+    def copy(self):
+        """Independent copy of this summary"""
+        clone = SpaceSaving(self.capacity)
+        clone.counts = dict(self.counts)
+        clone.floor = self.floor
+        return clone
+
+    def merge(self, other):
+        """Add the counts of another summary into this one"""
+        counts, floor = self.counts, self.floor
+        other_counts, other_floor = other.counts, other.floor
+        merged = {key: count + other_counts.get(key, other_floor) for key, count in counts.items()}
+        for key, count in other_counts.items():
+            if key not in counts:
+                merged[key] = floor + count
+        self.counts = merged
+        self.floor = floor + other_floor
+        if len(merged) >= 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        """Keep the capacity largest counts"""
+        ranked = sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        self.floor = max(self.floor, ranked[self.capacity][1])
+        self.counts = dict(ranked[:self.capacity])
+
+class HyperLogLog:
+    """HyperLogLog distinct counter with 2**precision one-byte registers
+
+    Keys are hashed with hash(), which is only stable within a process;
+    that is all an in-memory sketch needs. The standard error is about
+    1.04 / sqrt(2**precision), 0.8% with the default 16 KB of registers,
+    and small counts are estimated by linear counting.
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._shift = 64 - precision
+        self._mask = (1 << self._shift) - 1
+
+    def add(self, key):
+        """Record key"""
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        index = h >> self._shift
+        rank = self._shift + 1 - (h & self._mask).bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def copy(self):
+        """Independent copy of this counter"""
+        clone = HyperLogLog(self.precision)
+        clone.registers = bytearray(self.registers)
+        return clone
+
+    def merge(self, other):
+        """Take the union with another counter of the same precision"""
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        """Estimated number of distinct keys"""
+        m = len(self.registers)
+        zeros = self.registers.count(0)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        registers = self.registers
+        estimate = alpha * m * m / sum(registers.count(r) * 2.0 ** -r for r in set(registers))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+class DomainSketch:
+    """Top domains and distinct domain count of one bucket (or merged window)"""
+
+    def __init__(self, capacity=512):
+        self.queries = SpaceSaving(capacity)
+        self.blocked = SpaceSaving(capacity)
+        # Blocked or cached queries, and the bytes they saved
+        self.saving = SpaceSaving(capacity)
+        self.saved = SpaceSaving(capacity)
+        self.domains = HyperLogLog()
+
+    def add(self, domain, blocked=0, cached=0, bytes_saved=0, count=1):
+        """Record count queries of domain"""
+        self.queries.add(domain, count)
+        if blocked:
+            self.blocked.add(domain, blocked)
+        if blocked or cached:
+            self.saving.add(domain, blocked + cached)
+            self.saved.add(domain, bytes_saved or 0)
+        self.domains.add(domain)
+
+    def copy(self):
+        """Independent copy of this sketch"""
+        clone = DomainSketch.__new__(DomainSketch)
+        clone.queries = self.queries.copy()
+        clone.blocked = self.blocked.copy()
+        clone.saving = self.saving.copy()
+        clone.saved = self.saved.copy()
+        clone.domains = self.domains.copy()
+        return clone
+
+    def merge(self, other):
+        """Add another sketch into this one"""
+        self.queries.merge(other.queries)
+        self.blocked.merge(other.blocked)
+        self.saving.merge(other.saving)
+        self.saved.merge(other.saved)
+        self.domains.merge(other.domains)
+
+    def top_domains(self, limit=10, blocked_only=False):
+        """[(domain, count)] of the most queried (or most blocked) domains"""
+        return (self.blocked if blocked_only else self.queries).top(limit)
+
+    def top_saving_domains(self, limit=10):
+        """[(domain, blocked or cached queries, bytes_saved)], most saved first"""
+        return [(domain, self.saving.estimate(domain), saved)
+                for domain, saved in self.saved.top(limit)]
+
+    def unique_domains(self):
+        """Estimated number of distinct domains"""
+        return self.domains.count()
+
+class QuerySketches:
+    """Per-hour DomainSketches of the last few hours, fed as queries are logged
+
+    Answers the top-K and distinct-domain parts of the stats for windows
+    that lie within the retained hours, by merging the hour sketches; a
+    window is taken to include all of its first hour, as with the
+    per-domain rollups. Only windows that start after the sketches were
+    seeded are covered, so window() returns None for anything older and
+    callers fall back to the database.
+
+    Queries are added from the DNS event loop, so window() holds the lock
+    only to copy the last two hours (the previous one may still receive
+    a late query) and to pick up the older ones, and merges outside it.
+    """
+
+    def __init__(self, hours=24, capacity=512):
+        self.hours = hours
+        self.capacity = capacity
+        self.buckets = {}
+        self.covered_since = None
+        # first hour -> (current hour, merged sketch of the settled hours from first on)
+        self._closed = {}
+        # Bumped by seed(), so merges of the old buckets are not cached
+        self._generation = 0
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, domain, blocked=0, cached=0, bytes_saved=0):
+        """Record one logged query"""
+        hour = timestamp - timestamp % HOUR
+        with self.lock:
+            sketch = self.buckets.get(hour)
+            if sketch is None:
+                sketch = self.buckets[hour] = DomainSketch(self.capacity)
+                self._expire(hour)
+            sketch.add(domain, blocked, cached, bytes_saved)
+
+    def seed(self, rows, since):
+        """Load (hour, domain, total, blocked, cached, bytes_saved) counts from the database
+
+        Marks every window starting at or after since as covered, so rows
+        must hold all queries logged since then.
+        """
+        with self.lock:
+            for hour, domain, total, blocked, cached, bytes_saved in rows:
+                sketch = self.buckets.get(hour)
+                if sketch is None:
+                    sketch = self.buckets[hour] = DomainSketch(self.capacity)
+                sketch.add(domain, blocked, cached, bytes_saved, count=total)
+            self.covered_since = since - since % HOUR
+            self._closed = {}
+            self._generation += 1
+            self._expire(int(time.time()))
+
+    def window(self, since):
+        """Merged sketch of the hours from since on, or None if they are not all kept"""
+        first = since - since % HOUR
+        now = int(time.time())
+        current = now - now % HOUR
+        # Hours before this one no longer change
+        settled = current - HOUR
+        with self.lock:
+            if self.covered_since is None or first < self.covered_since:
+                return None
+            if first < current - self.hours * HOUR:
+                return None
+            cached = self._closed.get(first)
+            if cached is not None and cached[0] == current:
+                older = None
+            else:
+                older = [sketch for hour, sketch in self.buckets.items() if first <= hour < settled]
+            recent = [sketch.copy() for hour, sketch in self.buckets.items()
+                      if hour >= first and hour >= settled]
+            generation = self._generation
+
+        # Merge the settled hours once per window start and hour, so
+        # repeated calls only add the recent hours to that
+        if older is None:
+            closed = cached[1]
+        else:
+            closed = DomainSketch(self.capacity)
+            for sketch in older:
+                closed.merge(sketch)
+            with self.lock:
+                if self._generation == generation:
+                    self._closed = {start: entry for start, entry in self._closed.items()
+                                    if entry[0] == current}
+                    self._closed[first] = (current, closed)
+
+        merged = closed.copy()
+        for sketch in recent:
+            merged.merge(sketch)
+        return merged
+
+    def _expire(self, now):
+        """Drop hours too old for any window of self.hours"""
+        oldest = now - now % HOUR - self.hours * HOUR
+        for hour in [hour for hour in self.buckets if hour < oldest]:
+            del self.buckets[hour]
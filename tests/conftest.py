@@ -0,0 +1,9 @@
+"""
+Test configuration
+Makes the application modules in the repository root importable
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,97 @@
+"""
+Async DNS Server Tests
+Cache misses beyond max_concurrent_queries are shed instead of queued
+"""
+
+import socket
+import struct
+import threading
+import time
+
+import pytest
+from dnslib import A, DNSRecord, RCODE, RR
+
+from async_dns_server import AsyncDNSServer
+
+class BlockingResolver:
+    """Misses every query locally and holds upstream lookups until released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def resolve_local_wire(self, data, question, client_ip, start_time=None):
+        return None
+
+    def resolve_upstream(self, request, client_ip, start_time=None):
+        with self.lock:
+            self.calls += 1
+        self.release.wait(10)
+        reply = request.reply()
+        reply.add_answer(RR(request.q.qname, rdata=A('192.0.2.1'), ttl=60))
+        return reply
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+@pytest.fixture
+def server():
+    resolver = BlockingResolver()
+    server = AsyncDNSServer(resolver, '127.0.0.1', 0, max_concurrent_queries=4,
+                            upstream_workers=2)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    wait_for(lambda: server.udp_transport is not None and server.tcp_server is not None)
+    yield server, resolver
+    resolver.release.set()
+    server.stop()
+    thread.join(5)
+
+def test_udp_misses_beyond_limit_are_dropped(server):
+    """Pending misses count against the limit even while waiting for a worker"""
+    server, resolver = server
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    try:
+        for i in range(20):
+            sock.sendto(DNSRecord.question(f"host{i}.example").pack(), ('127.0.0.1', server.port))
+        wait_for(lambda: server.stats['udp_queries'] == 20)
+        # Only two workers run; the other two accepted misses wait for them
+        assert server.inflight == 4
+        assert server.stats['dropped'] == 16
+        wait_for(lambda: resolver.calls == 2)
+
+        resolver.release.set()
+        replies = [DNSRecord.parse(sock.recvfrom(4096)[0]) for _ in range(4)]
+        assert sorted(str(reply.q.qname) for reply in replies) == [
+            f"host{i}.example." for i in range(4)]
+        wait_for(lambda: server.inflight == 0)
+    finally:
+        sock.close()
+
+def test_tcp_miss_beyond_limit_gets_servfail(server):
+    """A TCP miss over the limit is answered with SERVFAIL right away"""
+    server, resolver = server
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tcp = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+    try:
+        for i in range(4):
+            udp.sendto(DNSRecord.question(f"busy{i}.example").pack(), ('127.0.0.1', server.port))
+        wait_for(lambda: server.inflight == 4)
+
+        query = DNSRecord.question("over.example")
+        data = query.pack()
+        tcp.sendall(struct.pack('!H', len(data)) + data)
+        length = struct.unpack('!H', tcp.recv(2))[0]
+        reply = DNSRecord.parse(tcp.recv(length))
+        assert reply.header.id == query.header.id
+        assert reply.header.rcode == RCODE.SERVFAIL
+        assert server.stats['dropped'] == 1
+    finally:
+        udp.close()
+        tcp.close()
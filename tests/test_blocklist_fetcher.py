@@ -0,0 +1,140 @@
+"""
+Blocklist Fetcher Tests
+Conditional downloads against a local HTTP server, and the cached copies they fall back on
+"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from blocklist_fetcher import BlocklistFetcher, FetchResult
+from blocklist_manager import BlocklistManager
+from database import Database
+
+ETAG = '"v1"'
+LAST_MODIFIED = 'Wed, 14 Oct 2026 08:00:00 GMT'
+BODY = b"# test list\n0.0.0.0 ads.example.com\ntracker.example.net\n"
+
+class ListHandler(BaseHTTPRequestHandler):
+    """Serves BODY with validators, a 304 when they match, or a forced status"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.status != 200:
+            self.send_response(server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ListHandler)
+    server.requests = []
+    server.status = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/list.txt"
+
+@pytest.fixture
+def db(tmp_path, monkeypatch, url):
+    # Cached bodies go to blocklists/remote under the working directory
+    monkeypatch.chdir(tmp_path)
+    db = Database(str(tmp_path / 'dns_filter.db'), stats_sketch_hours=0)
+    db.initialize()
+    db.add_remote_blocklist(url)
+    yield db
+    db.close()
+
+@pytest.fixture
+def fetcher(db):
+    fetcher = BlocklistFetcher(db, timeout=5)
+    yield fetcher
+    fetcher.close()
+
+def test_download_stores_validators_and_body(fetcher, db, url, server):
+    """A 200 is parsed, cached on disk and its validators recorded"""
+    result = fetcher.fetch_all([url])[url]
+    assert result.status == FetchResult.UPDATED
+    assert result.domains == {'ads.example.com', 'tracker.example.net'}
+    assert db.get_remote_blocklist_validators()[url] == (ETAG, LAST_MODIFIED)
+    with open(fetcher.cache_path(url), 'rb') as f:
+        assert f.read() == BODY
+    assert os.path.dirname(fetcher.cache_path(url)) == os.path.join('blocklists', 'remote')
+    # Nothing to validate against yet, so the first request is unconditional
+    assert 'If-None-Match' not in server.requests[0]
+
+def test_not_modified_uses_cached_body(fetcher, db, url, server):
+    """Validators are sent back, and a 304 is served from the cached body after a restart"""
+    fetcher.fetch_all([url])
+    result = fetcher.fetch_all([url])[url]
+    assert result.status == FetchResult.NOT_MODIFIED
+    assert result.domains is None
+    assert server.requests[-1]['If-None-Match'] == ETAG
+    assert server.requests[-1]['If-Modified-Since'] == LAST_MODIFIED
+    assert db.get_remote_blocklist_validators()[url] == (ETAG, LAST_MODIFIED)
+
+    manager = BlocklistManager(db, index_file="")
+    manager.load_blocklists()
+    manager.close()
+    assert server.requests[-1]['If-None-Match'] == ETAG
+    assert manager.is_blocked('ads.example.com')
+    assert manager.is_blocked('tracker.example.net')
+
+def test_missing_copy_fetches_unconditionally(fetcher, url, server):
+    """Without a cached body a 304 would be useless, so no validators are sent"""
+    fetcher.fetch_all([url])
+    os.remove(fetcher.cache_path(url))
+    result = fetcher.fetch_all([url])[url]
+    assert result.status == FetchResult.UPDATED
+    assert 'If-None-Match' not in server.requests[-1]
+
+def test_server_error_falls_back_to_cached_body(fetcher, db, url, server):
+    """A 5xx fails the fetch but the last good copy keeps the list blocked"""
+    fetcher.fetch_all([url])
+    server.status = 503
+    result = fetcher.fetch_all([url])[url]
+    assert result.status == FetchResult.FAILED
+    assert result.error is not None
+
+    manager = BlocklistManager(db, index_file="")
+    manager.load_blocklists()
+    manager.close()
+    assert manager.is_blocked('ads.example.com')
+    # The failed fetch did not touch the stored validators
+    assert db.get_remote_blocklist_validators()[url] == (ETAG, LAST_MODIFIED)
+
+def test_network_error_falls_back_to_cached_body(fetcher, db, url, server):
+    """An unreachable server is a failed fetch, answered from the cached body"""
+    fetcher.fetch_all([url])
+    server.shutdown()
+    server.server_close()
+    result = fetcher.fetch(url)
+    assert result.status == FetchResult.FAILED
+    assert fetcher.parse_cached(url) == {'ads.example.com', 'tracker.example.net'}
+
+    manager = BlocklistManager(db, index_file="", fetch_timeout=2)
+    manager.load_blocklists()
+    manager.close()
+    assert manager.is_blocked('tracker.example.net')
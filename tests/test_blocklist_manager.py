@@ -0,0 +1,112 @@
+"""
+Blocklist Manager Tests
+Per-source deltas and manual overrides that survive reloads and restarts
+"""
+
+import os
+
+import pytest
+
+from blocklist_manager import BlocklistManager
+from database import Database
+from domain_index import MappedSuffixIndex
+
+@pytest.fixture(params=['', 'blocklist.idx'], ids=['in-memory', 'index-file'])
+def index_file(request):
+    return request.param
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # Local lists are read from blocklists/ under the working directory
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('blocklists')
+    db = Database(str(tmp_path / 'dns_filter.db'), stats_sketch_hours=0)
+    db.initialize()
+    yield db
+    db.close()
+
+@pytest.fixture
+def open_manager(db, index_file):
+    opened = []
+
+    def open_manager():
+        manager = BlocklistManager(db, index_file=index_file, compile_threshold=1)
+        manager.load_blocklists()
+        opened.append(manager)
+        return manager
+
+    yield open_manager
+    for manager in opened:
+        manager.close()
+
+def write_list(name, *domains):
+    with open(os.path.join('blocklists', name), 'w') as f:
+        f.write('# test list\n' + ''.join(f'{domain}\n' for domain in domains))
+
+def test_shared_domain_survives_one_source(open_manager):
+    """A domain stays blocked until every list that has it drops it"""
+    write_list('a.txt', 'shared.example.com', 'only-a.example.com')
+    write_list('b.txt', 'shared.example.com')
+    manager = open_manager()
+    assert manager.refcounts['shared.example.com'] == 2
+
+    write_list('a.txt', 'only-a.example.com', 'new-a.example.com')
+    manager.load_blocklists()
+    assert manager.is_blocked('shared.example.com')
+    assert manager.is_blocked('new-a.example.com')
+    assert manager.refcounts['shared.example.com'] == 1
+
+    os.remove(os.path.join('blocklists', 'b.txt'))
+    manager.load_blocklists()
+    assert not manager.is_blocked('shared.example.com')
+    assert manager.is_blocked('only-a.example.com')
+    assert 'shared.example.com' not in manager.refcounts
+
+def test_removed_list_domain_stays_removed(open_manager, db):
+    """Unblocking a listed domain is stored, and survives reloads and restarts"""
+    write_list('a.txt', 'ads.example.com', 'tracker.example.com')
+    manager = open_manager()
+    assert manager.remove_domain('ADS.example.com')
+    assert not manager.is_blocked('ads.example.com')
+    assert db.get_custom_domains() == {'ads.example.com': False}
+
+    write_list('a.txt', 'ads.example.com', 'tracker.example.com', 'more.example.com')
+    manager.load_blocklists()
+    assert not manager.is_blocked('ads.example.com')
+    manager.close()
+
+    restarted = open_manager()
+    # With an index file the restart is served from it, overrides applied on top
+    assert isinstance(restarted.index, MappedSuffixIndex) == bool(restarted.index_file)
+    assert not restarted.is_blocked('ads.example.com')
+    assert restarted.is_blocked('tracker.example.com')
+    assert restarted.is_blocked('more.example.com')
+
+def test_re_adding_undoes_removal(open_manager, db):
+    """Adding a domain back blocks it again, also after a restart"""
+    write_list('a.txt', 'ads.example.com')
+    manager = open_manager()
+    manager.remove_domain('ads.example.com')
+    assert manager.add_domain('ads.example.com')
+    assert manager.is_blocked('sub.ads.example.com')
+    assert db.get_custom_domains() == {'ads.example.com': True}
+    manager.close()
+
+    restarted = open_manager()
+    assert restarted.is_blocked('ads.example.com')
+    # Blocked by hand, so it stays blocked when the list drops it
+    write_list('a.txt', 'other.example.com')
+    restarted.load_blocklists()
+    assert restarted.is_blocked('ads.example.com')
+
+def test_custom_domain_is_forgotten_on_removal(open_manager, db):
+    """A domain only ever blocked by hand leaves no override behind once removed"""
+    write_list('a.txt', 'ads.example.com')
+    manager = open_manager()
+    assert manager.add_domain('mine.example.org')
+    assert manager.is_blocked('www.mine.example.org')
+    assert manager.remove_domain('mine.example.org')
+    assert not manager.is_blocked('mine.example.org')
+    assert db.get_custom_domains() == {}
+    assert not manager.remove_domain('mine.example.org')
+    assert not manager.add_domain('not a domain')
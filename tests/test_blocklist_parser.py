@@ -0,0 +1,87 @@
+"""
+Blocklist Parser Tests
+Hosts, AdBlock and plain-domain lines, comments, and chunk boundaries
+"""
+
+import pytest
+
+from blocklist_parser import BlocklistParser, is_valid_domain, parse_file, parse_text
+
+LIST = """\
+# Comment lines are skipped
+! AdBlock comments too
+0.0.0.0 hosts.example.com
+127.0.0.1   loopback.example.com
+0.0.0.0\ttab.example.com # inline comment after a hosts entry
+||adblock.example.com^
+||options.example.com^$third-party
+plain.example.com
+Mixed.Case.Example.COM
+  indented.example.com
+trailing.example.com \t
+plain-with-comment.example.com # not a plain line any more
+
+nodot
+-leading-hyphen.example.com
+trailing-hyphen-.example.com
+under_score.example.com
+#0.0.0.0 commented-out.example.com
+"""
+
+EXPECTED = {
+    'hosts.example.com',
+    'loopback.example.com',
+    'tab.example.com',
+    'adblock.example.com',
+    'plain.example.com',
+    'mixed.case.example.com',
+    'indented.example.com',
+    'trailing.example.com',
+}
+
+def test_formats_and_comments():
+    """Each format is recognised; comments, blank lines and malformed names are not"""
+    assert parse_text(LIST) == EXPECTED
+
+def test_crlf_line_endings():
+    assert parse_text(LIST.replace('\n', '\r\n')) == EXPECTED
+
+def test_last_line_without_newline():
+    assert parse_text("a.example.com\nb.example.com") == {'a.example.com', 'b.example.com'}
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64])
+def test_chunk_boundaries(chunk_size):
+    """Lines split across chunks parse the same as whole ones"""
+    parser = BlocklistParser()
+    for start in range(0, len(LIST), chunk_size):
+        parser.feed(LIST[start:start + chunk_size])
+    assert parser.close() == EXPECTED
+
+def test_parse_file(tmp_path):
+    path = tmp_path / 'list.txt'
+    path.write_text(LIST, encoding='utf-8')
+    assert parse_file(str(path), chunk_size=16) == EXPECTED
+
+def test_plain_label_length():
+    """Plain names may have labels of up to 63 characters, no more"""
+    longest = 'a' * 63 + '.example.com'
+    too_long = 'b' * 64 + '.example.com'
+    inner = 'c.' + 'd' * 64 + '.example.com'
+    assert parse_text('\n'.join([longest, too_long, inner]) + '\n') == {longest}
+    assert is_valid_domain(longest)
+    assert not is_valid_domain(too_long)
+    assert not is_valid_domain(inner)
+
+@pytest.mark.parametrize('domain, valid', [
+    ('example.com', True),
+    ('a-b.example.com', True),
+    ('xn--bcher-kva.example', True),
+    ('example', False),
+    ('-example.com', False),
+    ('example-.com', False),
+    ('exa mple.com', False),
+    ('', False),
+    ('a.' * 127 + 'com', False),
+])
+def test_is_valid_domain(domain, valid):
+    assert is_valid_domain(domain) == valid
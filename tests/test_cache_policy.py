@@ -0,0 +1,70 @@
+"""
+Cache Policy Tests
+Eviction and admission decisions of the LRU and W-TinyLFU policies
+"""
+
+from cache_policy import CountMinSketch, LRUPolicy, TinyLFUPolicy, get_policy
+
+def test_sketch_counts_and_ages():
+    """Counts grow with accesses, saturate, and are halved once the sample is full"""
+    sketch = CountMinSketch(100)
+    for _ in range(5):
+        sketch.increment('hot')
+    sketch.increment('warm')
+    assert sketch.frequency('hot') >= 5
+    assert sketch.frequency('warm') >= 1
+    assert sketch.frequency('hot') > sketch.frequency('cold')
+
+    for _ in range(100):
+        sketch.increment('hot')
+    assert sketch.frequency('hot') == CountMinSketch.MAX_COUNT
+
+    for i in range(sketch.sample_size):
+        sketch.increment(f'filler{i}')
+    assert sketch.frequency('hot') < CountMinSketch.MAX_COUNT
+
+def test_lru_evicts_least_recent():
+    policy = LRUPolicy(2)
+    policy.put('a', 1)
+    policy.put('b', 2)
+    policy.on_hit('a')
+    assert policy.put('c', 3) == [('b', 2)]
+    assert policy.get('a') == 1
+
+def test_tinylfu_resists_scans():
+    """A burst of one-off keys does not push out keys that are asked for often"""
+    policy = TinyLFUPolicy(100)
+    hot = [f'hot{i}' for i in range(50)]
+    for key in hot:
+        policy.on_miss(key)
+        policy.put(key, key)
+    # Move the last hot key out of the one-entry window
+    policy.put('filler', 'filler')
+    for _ in range(3):
+        for key in hot:
+            policy.on_hit(key)
+
+    for i in range(1000):
+        key = f'scan{i}'
+        policy.on_miss(key)
+        policy.put(key, key)
+
+    assert all(policy.get(key) == key for key in hot)
+    assert len(policy) == 100
+
+def test_tinylfu_hits_promote_to_protected():
+    """A hit in probation promotes the key; protected hits keep it there"""
+    policy = TinyLFUPolicy(100)
+    for i in range(10):
+        policy.put(f'k{i}', i)
+    assert 'k0' in policy.probation
+    policy.on_hit('k0')
+    assert 'k0' in policy.protected
+    policy.on_hit('k0')
+    assert 'k0' in policy.protected
+    assert policy.pop('k0') == 0
+    assert policy.get('k0') is None
+
+def test_get_policy():
+    assert get_policy('tinylfu') is TinyLFUPolicy
+    assert get_policy('unknown') is LRUPolicy
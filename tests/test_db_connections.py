@@ -0,0 +1,79 @@
+"""
+Connection Manager Tests
+Read connections come from a bounded pool shared by short-lived threads
+"""
+
+import os
+import threading
+
+import pytest
+
+from db_connections import ConnectionManager
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = ConnectionManager(str(tmp_path / 'test.db'), max_readers=3)
+    with manager.writer() as conn:
+        conn.execute('CREATE TABLE t (x INTEGER)')
+        conn.execute('INSERT INTO t VALUES (1)')
+    yield manager
+    manager.close()
+
+def read(manager):
+    with manager.reader() as conn:
+        return conn.execute('SELECT x FROM t').fetchone()[0]
+
+def test_threads_share_a_bounded_pool(manager):
+    """Many request threads never open more than max_readers connections"""
+    results = []
+    barrier = threading.Barrier(10)
+
+    def request():
+        barrier.wait()
+        for _ in range(20):
+            results.append(read(manager))
+
+    for _ in range(5):
+        threads = [threading.Thread(target=request) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        barrier.reset()
+    assert results == [1] * 1000
+    assert 1 <= len(manager._readers) <= 3
+
+def test_nested_reads_reuse_the_connection(manager):
+    """A thread holding a reader gets the same one back without touching the pool"""
+    with manager.reader() as outer:
+        with manager.reader() as inner:
+            assert inner is outer
+        # Still held by the outer block
+        assert manager._idle.qsize() == 0
+    assert manager._idle.qsize() == 1
+
+def test_readers_are_read_only(manager):
+    """Pooled readers cannot write"""
+    with manager.reader() as conn:
+        with pytest.raises(Exception):
+            conn.execute('INSERT INTO t VALUES (2)')
+
+def test_readers_see_committed_writes(manager):
+    """A reader returned to the pool sees rows committed after it was opened"""
+    assert read(manager) == 1
+    with manager.writer() as conn:
+        conn.execute('UPDATE t SET x = 2')
+    assert read(manager) == 2
+
+def test_close_closes_every_connection(manager):
+    """close() closes idle readers and readers still checked out"""
+    with manager.reader() as held:
+        read_in_thread = threading.Thread(target=read, args=(manager,))
+        read_in_thread.start()
+        read_in_thread.join()
+        manager.close()
+    with pytest.raises(Exception):
+        held.execute('SELECT 1')
+    assert manager._readers == []
+    # The manager reopens connections on the next use
+    assert read(manager) == 1
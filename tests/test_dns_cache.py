@@ -0,0 +1,386 @@
+"""
+DNS Cache Tests
+Coalescing, TTLs, expiry and snapshots of cached DNS responses
+"""
+
+import threading
+import time
+
+import pytest
+from dnslib import A, DNSRecord, QTYPE, RCODE, RR, SOA
+
+import dns_cache
+import dns_wire
+from dns_cache import DNSCache, SingleFlight
+
+def make_reply(name='example.com', ttl=300, rd=1):
+    query = DNSRecord.question(name)
+    query.header.rd = rd
+    reply = query.reply()
+    reply.add_answer(RR(name, rdata=A('192.0.2.1'), ttl=ttl))
+    reply.add_answer(RR(name, rdata=A('192.0.2.2'), ttl=ttl))
+    return reply
+
+def make_negative(rcode=RCODE.NXDOMAIN, soa_ttl=600, minimum=120):
+    """An NXDOMAIN or NODATA reply, with an SOA unless soa_ttl is None"""
+    reply = DNSRecord.question('missing.example.com').reply()
+    reply.header.rcode = rcode
+    if soa_ttl is not None:
+        soa = SOA('ns.example.com', 'admin.example.com', (1, 7200, 900, 86400, minimum))
+        reply.add_auth(RR('example.com', QTYPE.SOA, rdata=soa, ttl=soa_ttl))
+    return reply
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable time.time() for the cache"""
+    now = [time.time()]
+    monkeypatch.setattr(dns_cache.time, 'time', lambda: now[0])
+    return now
+
+@pytest.fixture
+def cache():
+    cache = DNSCache(max_size=100, max_ttl=3600, prefetch_min_hits=1000)
+    yield cache
+    cache.stop()
+
+def wait_for(condition, timeout=5.0):
+    """Poll until condition() is true"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def run_concurrently(flight, fn, count):
+    """Call flight.do('key', fn) from count threads; returns their outcomes"""
+    outcomes = []
+    lock = threading.Lock()
+
+    def call():
+        try:
+            outcome = flight.do('key', fn)
+        except Exception as e:
+            outcome = e
+        with lock:
+            outcomes.append(outcome)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+def test_single_flight_coalesces_concurrent_calls():
+    """Callers arriving while the first one runs share its result"""
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return 'answer'
+
+    threads, outcomes = run_concurrently(flight, fetch, 8)
+    wait_for(lambda: flight.get_stats()['coalesced'] == 7)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(outcomes) == [('answer', False)] + [('answer', True)] * 7
+    assert flight.get_stats() == {'leaders': 1, 'coalesced': 7, 'in_flight': 0}
+
+def test_single_flight_propagates_errors():
+    """Waiters see the leader's exception, and the key can be retried afterwards"""
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise TimeoutError("upstream timed out")
+
+    threads, outcomes = run_concurrently(flight, fail, 4)
+    wait_for(lambda: flight.get_stats()['coalesced'] == 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(outcomes) == 4
+    assert all(isinstance(outcome, TimeoutError) for outcome in outcomes)
+    # The failed flight is gone, so the next caller runs fn again
+    assert flight.do('key', lambda: 'retried') == ('retried', False)
+
+def test_single_flight_keys_are_independent():
+    """Different keys never wait on each other"""
+    flight = SingleFlight()
+    release = threading.Event()
+    threads, outcomes = run_concurrently(flight, lambda: release.wait(5) and 'slow', 1)
+    wait_for(lambda: flight.get_stats()['in_flight'] == 1)
+    assert flight.do('other', lambda: 'fast') == ('fast', False)
+    release.set()
+    threads[0].join()
+    assert outcomes == [('slow', False)]
+
+@pytest.mark.parametrize('ttl, expected', [(5, 30), (300, 300), (86400, 3600), (0, 30)])
+def test_ttl_is_clamped(ttl, expected):
+    """Answer TTLs are held to [min_ttl, max_ttl]"""
+    cache = DNSCache(min_ttl=30, max_ttl=3600)
+    cache.stop()
+    assert cache.response_ttl(make_reply(ttl=ttl)) == expected
+
+def test_zero_ttl_is_not_cached(cache):
+    """Without a min_ttl, a zero TTL answer is uncacheable"""
+    assert cache.response_ttl(make_reply(ttl=0)) is None
+    assert cache.set('example.com:A', make_reply(ttl=0)) is False
+    assert cache.get_stats()['uncacheable'] == 1
+    assert len(cache) == 0
+
+@pytest.mark.parametrize('rcode', [RCODE.NXDOMAIN, RCODE.NOERROR])
+def test_negative_ttl_from_soa(cache, rcode):
+    """NXDOMAIN and NODATA live for min(SOA TTL, SOA MINIMUM) (RFC 2308)"""
+    assert cache.response_ttl(make_negative(rcode, soa_ttl=600, minimum=120)) == 120
+    assert cache.response_ttl(make_negative(rcode, soa_ttl=60, minimum=120)) == 60
+    assert cache.set('missing.example.com:A', make_negative(rcode))
+    assert cache.get_stats()['negative'] == 1
+
+def test_negative_ttl_is_capped():
+    """negative_ttl caps what the SOA asks for"""
+    cache = DNSCache(negative_ttl=45)
+    cache.stop()
+    assert cache.response_ttl(make_negative(soa_ttl=3600, minimum=3600)) == 45
+
+def test_negative_without_soa_is_not_cached(cache):
+    """A negative answer without an SOA says nothing about how long it holds"""
+    assert cache.response_ttl(make_negative(soa_ttl=None)) is None
+    assert cache.set('missing.example.com:A', make_negative(soa_ttl=None)) is False
+
+@pytest.mark.parametrize('rcode', [RCODE.SERVFAIL, RCODE.REFUSED])
+def test_errors_are_not_cached(cache, rcode):
+    """Server failures are retried rather than cached"""
+    reply = make_reply()
+    reply.header.rcode = rcode
+    assert cache.response_ttl(reply) is None
+
+def test_stale_entry_is_served_and_refreshed_once(cache, clock):
+    """Past its TTL an entry is still answered, and one caller is asked to refresh it"""
+    cache.set('example.com:A', make_reply(ttl=60))
+    clock[0] += 61
+    assert cache.get('example.com:A') is None
+    response, refresh = cache.lookup('example.com:A')
+    assert response is not None and refresh
+    response, refresh = cache.lookup('example.com:A')
+    assert response is not None and not refresh
+    assert cache.get_stats()['stale_served'] == 2
+
+    # A failed refresh lets the next caller try again
+    cache.refresh_failed('example.com:A')
+    assert cache.lookup('example.com:A')[1]
+    assert cache.get_stats()['refresh_failures'] == 1
+
+    # A successful one replaces the entry with a fresh answer
+    cache.set('example.com:A', make_reply(ttl=60))
+    response, refresh = cache.lookup('example.com:A')
+    assert not refresh
+    assert [rr.ttl for rr in response.rr] == [60, 60]
+
+def test_stale_window_ends(cache, clock):
+    """Entries past stale_ttl are a miss and are dropped"""
+    cache.set('example.com:A', make_reply(ttl=60))
+    clock[0] += 60 + cache.stale_ttl
+    assert cache.lookup('example.com:A') == (None, False)
+    assert len(cache) == 0
+
+def test_serve_stale_disabled(clock):
+    """Without serve_stale, expiry is final"""
+    cache = DNSCache(serve_stale=False)
+    cache.stop()
+    cache.set('example.com:A', make_reply(ttl=60))
+    clock[0] += 61
+    assert cache.lookup('example.com:A') == (None, False)
+
+def test_prefetch_popular_entry(clock):
+    """An entry hit often enough is refreshed once most of its TTL has passed"""
+    cache = DNSCache(max_ttl=3600, prefetch_threshold=0.9, prefetch_min_hits=2)
+    cache.stop()
+    cache.set('popular.example.com:A', make_reply(ttl=100))
+    cache.set('rare.example.com:A', make_reply(ttl=100))
+    clock[0] += 10
+    assert not cache.lookup('popular.example.com:A')[1]
+    clock[0] += 80
+    # Second hit, with 90% of the TTL gone
+    assert cache.lookup('popular.example.com:A')[1]
+    assert not cache.lookup('popular.example.com:A')[1]
+    # One hit is not enough to be worth prefetching
+    assert not cache.lookup('rare.example.com:A')[1]
+    assert cache.get_stats()['prefetches'] == 1
+
+def test_ttl_offsets():
+    """Offsets point at the TTL of every answer record"""
+    data = make_reply(ttl=1234).pack()
+    offsets = dns_wire.ttl_offsets(data)
+    assert len(offsets) == 2
+    assert all(int.from_bytes(data[offset:offset + 4], 'big') == 1234 for offset in offsets)
+
+def test_patch_reply_id_and_age():
+    """patch_reply sets the ID and ages TTLs without going below zero"""
+    data = make_reply(ttl=100).pack()
+    offsets = dns_wire.ttl_offsets(data)
+    reply = DNSRecord.parse(dns_wire.patch_reply(data, 4242, offsets, age=30))
+    assert reply.header.id == 4242
+    assert [rr.ttl for rr in reply.rr] == [70, 70]
+    reply = DNSRecord.parse(dns_wire.patch_reply(data, 1, offsets, age=500))
+    assert [rr.ttl for rr in reply.rr] == [0, 0]
+    reply = DNSRecord.parse(dns_wire.patch_reply(data, 1, offsets, ttl=30))
+    assert [rr.ttl for rr in reply.rr] == [30, 30]
+    # The cached bytes are left untouched
+    assert DNSRecord.parse(data).rr[0].ttl == 100
+
+def test_hit_patches_id_and_ttl(cache, clock):
+    """A hit carries the client's ID and the TTL left on the entry"""
+    cache.set('example.com:A', make_reply(ttl=300))
+    clock[0] += 120
+    data, refresh = cache.lookup_wire('example.com:A', 777)
+    reply = DNSRecord.parse(data)
+    assert not refresh
+    assert reply.header.id == 777
+    assert [rr.ttl for rr in reply.rr] == [180, 180]
+    assert [str(rr.rdata) for rr in reply.rr] == ['192.0.2.1', '192.0.2.2']
+
+def test_stale_hit_uses_stale_ttl(cache, clock):
+    """An expired entry is served with the short stale TTL and asks for a refresh"""
+    cache.set('example.com:A', make_reply(ttl=60))
+    clock[0] += 61
+    data, refresh = cache.lookup_wire('example.com:A', 5)
+    assert refresh
+    assert [rr.ttl for rr in DNSRecord.parse(data).rr] == [DNSCache.STALE_ANSWER_TTL] * 2
+    assert cache.lookup_wire('example.com:A', 5, allow_stale=False) == (None, False)
+
+def test_hit_copies_question_case_and_rd(cache):
+    """The reply echoes the client's question spelling and RD bit, not the first client's"""
+    cache.set('example.com:A', make_reply('example.com', rd=1))
+    query = DNSRecord.question('ExAmPlE.CoM')
+    query.header.id = 31337
+    query.header.rd = 0
+    data, _ = cache.lookup_wire('example.com:A', query.header.id, query=query.pack())
+    reply = DNSRecord.parse(data)
+    assert reply.header.id == 31337
+    assert reply.header.rd == 0
+    assert str(reply.q.qname) == 'ExAmPlE.CoM.'
+    assert reply.q.qtype == QTYPE.A
+    assert len(reply.rr) == 2
+
+    parsed, _ = cache.lookup('example.com:A', 9, query=query.pack())
+    assert str(parsed.q.qname) == 'ExAmPlE.CoM.'
+
+def test_miss(cache):
+    """Unknown keys are a miss"""
+    assert cache.lookup_wire('missing.example:A', 1) == (None, False)
+
+@pytest.fixture
+def wheel_cache(clock):
+    """A single-shard cache whose expiry is driven by hand"""
+    cache = DNSCache(max_size=100, max_ttl=3600, stale_ttl=10, shards=1)
+    cache.stop()
+    return cache
+
+def test_wheel_expires_after_stale_window(wheel_cache, clock):
+    """Entries are dropped by the wheel within a second of stale_until"""
+    shard = wheel_cache.shards[0]
+    wheel_cache.set('short.example.com:A', make_reply(ttl=60))
+    wheel_cache.set('long.example.com:A', make_reply(ttl=600))
+    start = clock[0]
+
+    assert shard.expire(start + 60, 1000)
+    assert len(wheel_cache) == 2
+    assert shard.expire(start + 72, 1000)
+    assert len(wheel_cache) == 1
+    assert wheel_cache.lookup('long.example.com:A')[0] is not None
+    assert wheel_cache.get_stats()['expirations'] == 1
+
+def test_wheel_expires_in_batches(wheel_cache, clock):
+    """A shard that is behind catches up limit entries at a time"""
+    shard = wheel_cache.shards[0]
+    for i in range(5):
+        wheel_cache.set(f'host{i}.example.com:A', make_reply(ttl=60))
+    later = clock[0] + 100
+
+    assert not shard.expire(later, 2)
+    assert len(wheel_cache) == 3
+    assert not shard.expire(later, 2)
+    assert shard.expire(later, 2)
+    assert len(wheel_cache) == 0
+    assert shard.wheel == {}
+    assert wheel_cache.get_stats()['expirations'] == 5
+
+def test_wheel_follows_replaced_entries(wheel_cache, clock):
+    """Replacing or removing an entry takes it out of its old bucket"""
+    shard = wheel_cache.shards[0]
+    start = clock[0]
+    wheel_cache.set('example.com:A', make_reply(ttl=10))
+    wheel_cache.set('example.com:A', make_reply(ttl=600))
+    assert len(shard.wheel) == 1
+
+    assert shard.expire(start + 30, 1000)
+    assert wheel_cache.lookup('example.com:A')[0] is not None
+
+    wheel_cache.set('gone.example.com:A', make_reply(ttl=10))
+    clock[0] = start + 25
+    assert wheel_cache.lookup('gone.example.com:A') == (None, False)
+    assert sum(len(keys) for keys in shard.wheel.values()) == 1
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    return str(tmp_path / 'dns_cache.snap')
+
+def new_cache():
+    cache = DNSCache(max_size=100, max_ttl=3600, stale_ttl=60)
+    cache.stop()
+    return cache
+
+def test_snapshot_round_trip(snapshot_path, clock):
+    """Every live entry comes back from a snapshot with the same answer"""
+    cache = new_cache()
+    for i in range(20):
+        cache.set(f'host{i}.example.com:A', make_reply(f'host{i}.example.com', ttl=300))
+    cache.set('missing.example.com:A', make_negative())
+    assert cache.save_snapshot(snapshot_path) == 21
+
+    restored = new_cache()
+    assert restored.load_snapshot(snapshot_path) == 21
+    for i in range(20):
+        key = f'host{i}.example.com:A'
+        assert restored.lookup_wire(key, 7) == cache.lookup_wire(key, 7)
+    negative, _ = restored.lookup('missing.example.com:A')
+    assert negative.header.rcode == RCODE.NXDOMAIN
+
+def test_snapshot_keeps_ages(snapshot_path, clock):
+    """Restored entries keep ageing from when they were cached, not from the restart"""
+    cache = new_cache()
+    cache.set('short.example.com:A', make_reply(ttl=30))
+    cache.set('long.example.com:A', make_reply(ttl=300))
+    cache.save_snapshot(snapshot_path)
+
+    clock[0] += 100
+    restored = new_cache()
+    # short is past its stale window (30 + 60 seconds) and is not restored
+    assert restored.load_snapshot(snapshot_path) == 1
+    response = restored.get('long.example.com:A')
+    assert [rr.ttl for rr in response.rr] == [200, 200]
+    assert restored.get('short.example.com:A') is None
+
+def test_corrupt_snapshot_is_ignored(snapshot_path, clock):
+    """A foreign, truncated or tiny file loads nothing and does not raise"""
+    cache = new_cache()
+    for i in range(5):
+        cache.set(f'host{i}.example.com:A', make_reply(ttl=300))
+    cache.save_snapshot(snapshot_path)
+    with open(snapshot_path, 'rb') as f:
+        data = f.read()
+
+    for broken in (b'XXXX' + data[4:], data[:len(data) - 3], data[:DNSCache.SNAPSHOT_HEADER.size + 5], b'DN'):
+        with open(snapshot_path, 'wb') as f:
+            f.write(broken)
+        restored = new_cache()
+        assert restored.load_snapshot(snapshot_path) == 0
+        assert len(restored) == 0
+
+    assert new_cache().load_snapshot(snapshot_path + '.missing') == 0
@@ -0,0 +1,160 @@
+"""
+Domain Index Tests
+Suffix matching of blocked domains, in memory and from a mapped index file
+"""
+
+import random
+
+import pytest
+
+from domain_index import BloomFilter, MappedSuffixIndex, SuffixIndex, source_fingerprint, write_index
+
+DOMAINS = {
+    'ads.example.com',
+    'tracker.net',
+    'deep.sub.analytics.org',
+    'example.org',
+}
+
+# Exact names, subdomains, parents that only lead to blocked names,
+# look-alikes and unrelated names
+NAMES = [
+    'ads.example.com', 'x.ads.example.com', 'a.b.c.ads.example.com',
+    'example.com', 'com', 'www.example.com', 'badads.example.com',
+    'tracker.net', 'cdn.tracker.net', 'notracker.net', 'tracker.net.evil.com', 'net',
+    'deep.sub.analytics.org', 'x.deep.sub.analytics.org', 'sub.analytics.org',
+    'analytics.org', 'other.sub.analytics.org',
+    'example.org', 'www.example.org', 'org',
+    'unrelated.io', 'localhost',
+]
+
+FINGERPRINT = source_fingerprint([('list.txt', 100, 1)])
+
+def reference(name, domains):
+    """Blocked if the name or any parent of it is listed"""
+    return any(name == domain or name.endswith('.' + domain) for domain in domains)
+
+@pytest.mark.parametrize('name', NAMES)
+def test_suffix_index_matches_reference(name):
+    """Names and their subdomains are blocked; parents and look-alikes are not"""
+    assert SuffixIndex(set(DOMAINS)).contains(name) == reference(name, DOMAINS)
+
+def test_suffix_index_add_and_discard():
+    """Added domains block their subdomains until they are discarded"""
+    index = SuffixIndex(set(DOMAINS))
+    index.add('example.com')
+    assert index.contains('www.example.com')
+    assert 'example.com' in index
+    assert len(index) == len(DOMAINS) + 1
+
+    index.discard('example.com')
+    index.discard('tracker.net')
+    remaining = DOMAINS - {'tracker.net'}
+    for name in NAMES:
+        assert index.contains(name) == reference(name, remaining), name
+    # Discarding something that was never added is harmless
+    index.discard('never.example')
+    assert set(index) == remaining
+
+@pytest.fixture
+def index_path(tmp_path):
+    return str(tmp_path / 'blocklist.idx')
+
+def compile_index(path, domains):
+    write_index(SuffixIndex(set(domains)), path, FINGERPRINT)
+    return MappedSuffixIndex.open(path, FINGERPRINT)
+
+def test_mapped_index_matches_suffix_index(index_path):
+    """The mapped file answers every name like the in-memory index it was written from"""
+    index = SuffixIndex(set(DOMAINS))
+    mapped = compile_index(index_path, DOMAINS)
+    for name in NAMES:
+        assert mapped.contains(name) == index.contains(name), name
+    assert len(mapped) == len(DOMAINS)
+    assert set(mapped) == DOMAINS
+    assert 'tracker.net' in mapped
+    # Interior suffixes are in the file but are not blocked themselves
+    assert 'example.com' not in mapped
+
+def test_mapped_overlay_matches_suffix_index(index_path):
+    """Adds and discards after the file was written give the same answers as SuffixIndex"""
+    index = SuffixIndex(set(DOMAINS))
+    mapped = compile_index(index_path, DOMAINS)
+    changes = [
+        ('add', 'example.com'),             # interior-only in the file
+        ('add', 'new.example.io'),          # not in the file at all
+        ('discard', 'tracker.net'),         # blocked in the file
+        ('discard', 'deep.sub.analytics.org'),
+        ('add', 'deep.sub.analytics.org'),  # re-adding undoes the removal
+        ('discard', 'new.example.io'),      # only ever in the overlay
+        ('discard', 'sub.analytics.org'),   # interior, never blocked
+    ]
+    for action, domain in changes:
+        getattr(index, action)(domain)
+        getattr(mapped, action)(domain)
+        for name in NAMES + ['new.example.io', 'www.new.example.io']:
+            assert mapped.contains(name) == index.contains(name), (action, domain, name)
+        assert len(mapped) == len(index)
+        assert set(mapped) == set(index)
+
+def test_open_rejects_stale_or_broken_files(index_path):
+    """A file written for other sources, or not an index at all, is not used"""
+    assert MappedSuffixIndex.open(index_path, FINGERPRINT) is None
+    compile_index(index_path, DOMAINS)
+    assert MappedSuffixIndex.open(index_path, source_fingerprint([])) is None
+    assert MappedSuffixIndex.open(index_path) is not None
+
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    for broken in (b'', data[:20], b'XXXX' + data[4:], data[:len(data) // 2]):
+        with open(index_path, 'wb') as f:
+            f.write(broken)
+        assert MappedSuffixIndex.open(index_path, FINGERPRINT) is None
+
+def random_label(rng):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(rng.randint(1, 12)))
+
+def test_bloom_filter_has_no_false_negatives():
+    """Every added name is found, and few absent names are reported"""
+    rng = random.Random(19)
+    added = {random_label(rng).encode() + b'.example' for _ in range(10000)}
+    bloom = BloomFilter.for_count(len(added))
+    for key in added:
+        bloom.add(key)
+    assert all(bloom.might_contain(key) for key in added)
+
+    absent = [b'absent%d.example.org' % i for i in range(20000)]
+    false_positives = sum(bloom.might_contain(key) for key in absent)
+    assert false_positives / len(absent) < 0.05
+
+def test_bloom_masks_set_four_bits():
+    """Bit patterns are fixed across processes and each sets 4 bits"""
+    assert len(BloomFilter.MASKS) == 4096
+    assert all(bin(mask).count('1') == 4 for mask in BloomFilter.MASKS)
+    assert len(set(BloomFilter.MASKS)) > 4000
+
+def test_mapped_index_matches_suffix_index_at_scale(index_path):
+    """With thousands of domains, names rejected by the filter and names probed agree"""
+    rng = random.Random(18)
+    domains = set()
+    while len(domains) < 5000:
+        labels = [random_label(rng) for _ in range(rng.randint(1, 3))]
+        domains.add('.'.join(labels + [rng.choice(['com', 'net', 'org', 'io'])]))
+    index = SuffixIndex(set(domains))
+    mapped = compile_index(index_path, domains)
+
+    listed = sorted(domains)
+    names = []
+    for _ in range(20000):
+        domain = rng.choice(listed)
+        kind = rng.randrange(4)
+        if kind == 0:
+            names.append(domain)
+        elif kind == 1:
+            names.append(random_label(rng) + '.' + domain)
+        elif kind == 2:
+            names.append(domain.partition('.')[2])
+        else:
+            names.append(random_label(rng) + '.' + random_label(rng) + '.com')
+    for name in names:
+        assert mapped.contains(name) == index.contains(name), name
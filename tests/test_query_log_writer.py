@@ -0,0 +1,127 @@
+"""
+Query Log Writer Tests
+Bounded queue, batching by size or deadline, and flushing on stop
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from query_log_writer import QueryLogWriter
+
+class FakeConnections:
+    """Stands in for ConnectionManager; the writer only needs writer()"""
+
+    def __init__(self):
+        self.transactions = 0
+
+    @contextmanager
+    def writer(self):
+        self.transactions += 1
+        yield None
+
+class FakePartitions:
+    """Records the batches written, in order"""
+
+    def __init__(self):
+        self.batches = []
+        self.written = threading.Event()
+
+    def prepare(self, rows):
+        pass
+
+    def insert(self, conn, rows):
+        self.batches.append(list(rows))
+        self.written.set()
+
+def row(i):
+    return (1700000000 + i, f"d{i}.example.com", 'A', '10.0.0.1', 0, 0, 1.0, 0)
+
+def make_writer(**kwargs):
+    partitions = FakePartitions()
+    return QueryLogWriter(FakeConnections(), partitions, **kwargs), partitions
+
+def written_rows(partitions):
+    return [row for batch in partitions.batches for row in batch]
+
+def test_full_queue_drops_rows():
+    """Rows beyond queue_size are dropped and counted, never blocking the caller"""
+    writer, partitions = make_writer(queue_size=10)
+    accepted = [writer.enqueue(row(i)) for i in range(25)]
+    assert accepted == [True] * 10 + [False] * 15
+    stats = writer.get_stats()
+    assert stats['enqueued'] == 10
+    assert stats['dropped'] == 15
+    assert stats['queued'] == 10
+
+    # Without a running thread, flush() writes what was queued
+    writer.flush()
+    assert written_rows(partitions) == [row(i) for i in range(10)]
+    assert writer.get_stats()['written'] == 10
+
+def test_batches_are_capped_at_batch_size():
+    """A backlog is written in transactions of at most batch_size rows"""
+    writer, partitions = make_writer(batch_size=4, flush_interval=60)
+    for i in range(10):
+        writer.enqueue(row(i))
+    writer.start()
+    try:
+        deadline = time.monotonic() + 5
+        while len(written_rows(partitions)) < 8 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Two full batches go out at once; the rest waits for the deadline
+        assert [len(batch) for batch in partitions.batches[:2]] == [4, 4]
+    finally:
+        writer.stop()
+    assert written_rows(partitions) == [row(i) for i in range(10)]
+
+def test_partial_batch_written_after_deadline():
+    """A batch that never fills is written once flush_interval has passed"""
+    writer, partitions = make_writer(batch_size=500, flush_interval=0.2)
+    writer.start()
+    try:
+        started = time.monotonic()
+        writer.enqueue(row(1))
+        assert partitions.written.wait(5)
+        elapsed = time.monotonic() - started
+        assert 0.1 <= elapsed < 2
+        assert partitions.batches == [[row(1)]]
+    finally:
+        writer.stop()
+
+def test_stop_flushes_queued_rows():
+    """stop() drains the queue before the thread exits"""
+    writer, partitions = make_writer(batch_size=500, flush_interval=60)
+    writer.start()
+    for i in range(50):
+        writer.enqueue(row(i))
+    writer.stop()
+    assert not writer.running
+    assert written_rows(partitions) == [row(i) for i in range(50)]
+    assert writer.get_stats()['queued'] == 0
+
+def test_flush_waits_for_queued_rows():
+    """flush() returns once rows queued before it are written"""
+    writer, partitions = make_writer(batch_size=500, flush_interval=60)
+    writer.start()
+    try:
+        for i in range(5):
+            writer.enqueue(row(i))
+        writer.flush(timeout=5)
+        assert written_rows(partitions) == [row(i) for i in range(5)]
+    finally:
+        writer.stop()
+
+def test_write_errors_are_counted():
+    """A failing batch is counted and the writer keeps going"""
+    writer, partitions = make_writer()
+
+    def fail(conn, rows):
+        raise RuntimeError("disk full")
+
+    partitions.insert = fail
+    writer.enqueue(row(1))
+    writer.flush()
+    stats = writer.get_stats()
+    assert stats['errors'] == 1
+    assert stats['written'] == 0
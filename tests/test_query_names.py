@@ -0,0 +1,80 @@
+"""
+Query Log Dictionary Tests
+Packed client addresses and the id caches in front of the dictionary tables
+"""
+
+import sqlite3
+
+import pytest
+
+from query_names import QueryNames, pack_address, unpack_address
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    QueryNames().create_tables(conn)
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize('client_ip, stored', [
+    ('192.168.1.10', 0xC0A8010A),
+    ('0.0.0.0', 0),
+    ('2001:db8::1', bytes.fromhex('20010db8000000000000000000000001')),
+    ('not-an-address', 'not-an-address'),
+])
+def test_pack_address(client_ip, stored):
+    """IPv4 packs to an integer, IPv6 to 16 bytes, anything else is kept as text"""
+    assert pack_address(client_ip) == stored
+    assert unpack_address(stored) == client_ip
+
+def test_ids_are_stable(conn):
+    """A name keeps its id, whether it comes from the cache or the table"""
+    names = QueryNames()
+    first = names.domains.ids(conn, {'a.example.com', 'b.example.com'})
+    assert sorted(first.values()) == [1, 2]
+    assert names.domains.ids(conn, {'a.example.com', 'c.example.com'}) == {
+        'a.example.com': first['a.example.com'], 'c.example.com': 3}
+    # A fresh cache reads the same ids back from the table
+    assert QueryNames().domains.ids(conn, set(first)) == first
+
+def test_uncommitted_ids_are_not_cached(conn):
+    """Ids added in a rolled-back transaction are not handed out again"""
+    names = QueryNames()
+    conn.execute('BEGIN')
+    names.domains.ids(conn, {'rolled-back.example.com'})
+    conn.execute('ROLLBACK')
+    assert names.domains.cache.get('rolled-back.example.com') is None
+
+    conn.execute('BEGIN')
+    names.domains.ids(conn, {'other.example.com'})
+    ids = names.domains.ids(conn, {'rolled-back.example.com'})
+    conn.execute('COMMIT')
+    stored = conn.execute('SELECT id FROM query_domains WHERE name = ?',
+                          ('rolled-back.example.com',)).fetchone()
+    assert ids == {'rolled-back.example.com': stored[0]}
+
+def test_encode_rows(conn):
+    """Rows keep their numbers and get ids for their names"""
+    names = QueryNames()
+    rows = [(100, 'a.example.com', 'A', '10.0.0.1', 1, 0, 1.5, 0),
+            (101, 'a.example.com', 'AAAA', '2001:db8::1', 0, 1, 0.5, 512)]
+    encoded = names.encode(conn, rows)
+    assert encoded[0][1] == encoded[1][1]
+    assert encoded[0][2] != encoded[1][2]
+    assert [row[:1] + row[4:] for row in encoded] == [row[:1] + row[4:] for row in rows]
+    addresses = {row[0] for row in conn.execute('SELECT address FROM query_clients')}
+    assert addresses == {pack_address('10.0.0.1'), pack_address('2001:db8::1')}
+
+def test_prune_keeps_domains_still_in_use(conn):
+    """Only domains that no kept partition refers to are deleted"""
+    names = QueryNames()
+    ids = names.domains.ids(conn, {'old.example.com', 'both.example.com', 'new.example.com'})
+    for table, domains in (('queries_old', ('old.example.com', 'both.example.com')),
+                           ('queries_new', ('both.example.com', 'new.example.com'))):
+        conn.execute(f'CREATE TABLE {table} (domain_id INTEGER)')
+        conn.executemany(f'INSERT INTO {table} VALUES (?)', [(ids[domain],) for domain in domains])
+
+    names.prune(conn, ['queries_old'], ['queries_new'])
+    remaining = {row[0] for row in conn.execute('SELECT name FROM query_domains')}
+    assert remaining == {'both.example.com', 'new.example.com'}
+    assert len(names.domains.cache) == 0
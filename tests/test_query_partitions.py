@@ -0,0 +1,214 @@
+"""
+Query Log Partition Tests
+Migration of older query log layouts and retention of partitions and rollups
+"""
+
+import sqlite3
+import time
+
+import pytest
+
+from database import Database
+from query_partitions import DAY, QueryPartitions
+
+HOUR = 3600
+
+def make_rows(now):
+    """Query log rows spread over today, yesterday and 40 days ago"""
+    today = now - now % DAY
+    rows = []
+    for days_ago, count in ((0, 5), (1, 4), (40, 3)):
+        for i in range(count):
+            timestamp = today - days_ago * DAY + i * 600 + 7
+            if timestamp > now:
+                timestamp = now - i
+            rows.append((timestamp, f"site{i % 2}.example.com" if days_ago != 40 else f"old{i}.example.org",
+                         'AAAA' if i % 2 else 'A', '192.168.1.10' if i % 3 else '2001:db8::1',
+                         i % 2, 1 if i == 2 else 0, 1.5 * i, 1024 if i % 2 else 0))
+    return rows
+
+def read_queries(db):
+    """Every row of the queries view as logged, oldest first"""
+    with db.connections.reader() as conn:
+        return conn.execute('''
+            SELECT timestamp, domain, query_type, client_ip, blocked, cached, response_time, bytes_saved
+            FROM queries ORDER BY timestamp, domain
+        ''').fetchall()
+
+def expected_rows(rows):
+    """rows as the view returns them: IPv6 clients come back as hex"""
+    result = []
+    for row in rows:
+        client = row[3]
+        if ':' in client:
+            client = '20010db8000000000000000000000001'
+        result.append(row[:3] + (client,) + row[4:])
+    return sorted(result, key=lambda row: (row[0], row[1]))
+
+def partition_tables(conn):
+    return sorted(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'queries_%'"))
+
+@pytest.fixture
+def now():
+    return int(time.time())
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'dns_filter.db')
+
+@pytest.fixture
+def open_database(db_path):
+    opened = []
+
+    def open_database(**kwargs):
+        db = Database(db_path, stats_sketch_hours=0, **kwargs)
+        db.initialize()
+        opened.append(db)
+        return db
+
+    yield open_database
+    for db in opened:
+        db.close()
+
+def test_migrates_unpartitioned_table(db_path, open_database, now):
+    """The baseline queries table is moved into per-day partitions"""
+    rows = make_rows(now)
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE queries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER NOT NULL,
+            domain TEXT NOT NULL,
+            query_type TEXT NOT NULL,
+            client_ip TEXT NOT NULL,
+            blocked INTEGER DEFAULT 0,
+            cached INTEGER DEFAULT 0,
+            response_time REAL DEFAULT 0
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_timestamp ON queries(timestamp)')
+    conn.executemany('''
+        INSERT INTO queries (timestamp, domain, query_type, client_ip, blocked, cached, response_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [row[:7] for row in rows])
+    conn.commit()
+    conn.close()
+
+    db = open_database()
+
+    # bytes_saved did not exist in the oldest layout and defaults to 0
+    assert read_queries(db) == expected_rows([row[:7] + (0,) for row in rows])
+    with db.connections.reader() as conn:
+        days = sorted({row[0] // DAY for row in rows} | {now // DAY})
+        assert partition_tables(conn) == sorted(QueryPartitions.table(day) for day in days)
+        assert conn.execute("SELECT type FROM sqlite_master WHERE name = 'queries'").fetchone() == ('view',)
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'queries_unpartitioned'").fetchone() == (0,)
+        # The rollups are built from the migrated rows
+        assert conn.execute('SELECT SUM(total), SUM(blocked) FROM stats_hour').fetchone() == (
+            len(rows), sum(row[4] for row in rows))
+
+def test_migrates_text_partitions(db_path, open_database, now):
+    """Partitions that store names as text are rewritten with dictionary ids"""
+    rows = make_rows(now)
+    conn = sqlite3.connect(db_path)
+    tables = []
+    for day in sorted({row[0] // DAY for row in rows}):
+        table = QueryPartitions.table(day)
+        tables.append(table)
+        conn.execute(f'''
+            CREATE TABLE {table} (
+                id INTEGER PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                domain TEXT NOT NULL,
+                query_type TEXT NOT NULL,
+                client_ip TEXT NOT NULL,
+                blocked INTEGER DEFAULT 0,
+                cached INTEGER DEFAULT 0,
+                response_time REAL DEFAULT 0,
+                bytes_saved INTEGER DEFAULT 0
+            )
+        ''')
+        conn.execute(f'CREATE INDEX idx_{table}_stats ON {table}(timestamp, blocked, cached, domain, '
+                     f'bytes_saved, response_time)')
+        conn.execute(f'CREATE INDEX idx_{table}_domain_time ON {table}(domain, timestamp)')
+        conn.executemany(f'''
+            INSERT INTO {table} (timestamp, domain, query_type, client_ip, blocked, cached,
+                                 response_time, bytes_saved)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [row for row in rows if row[0] // DAY == day])
+    conn.execute('CREATE VIEW queries AS ' + ' UNION ALL '.join(f'SELECT * FROM {table}' for table in tables))
+    conn.commit()
+    conn.close()
+
+    db = open_database()
+
+    assert read_queries(db) == expected_rows(rows)
+    with db.connections.reader() as conn:
+        for table in partition_tables(conn):
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            assert 'domain' not in columns
+            assert 'domain_id' in columns
+        assert conn.execute('SELECT COUNT(*) FROM query_domains').fetchone()[0] == len({row[1] for row in rows})
+        assert conn.execute('SELECT COUNT(*) FROM query_clients').fetchone()[0] == 2
+
+def test_migration_is_not_repeated(db_path, open_database, now):
+    """Opening a migrated database again leaves its rows as they are"""
+    rows = make_rows(now)
+    db = open_database()
+    db.partitions.prepare(rows)
+    with db.connections.writer() as conn:
+        db.partitions.insert(conn, rows)
+        db.rollups.apply(conn, rows)
+    db.close()
+
+    db = open_database()
+    assert read_queries(db) == expected_rows(rows)
+
+def test_cleanup_drops_partitions_and_rollups(open_database, now):
+    """Retention drops whole days from the partitions, rollups and dictionaries together"""
+    rows = make_rows(now)
+    db = open_database()
+    db.partitions.prepare(rows)
+    with db.connections.writer() as conn:
+        db.partitions.insert(conn, rows)
+        db.rollups.apply(conn, rows)
+
+    assert db.cleanup_old_queries(days=30) == 3
+
+    kept = [row for row in rows if row[0] >= now - 30 * DAY]
+    assert read_queries(db) == expected_rows(kept)
+    with db.connections.reader() as conn:
+        cutoff = now - 30 * DAY
+        cutoff -= cutoff % DAY
+        assert all(day >= cutoff // DAY for day in db.partitions.days)
+        assert partition_tables(conn) == [QueryPartitions.table(day) for day in db.partitions.days]
+        for table in ('stats_minute', 'stats_hour', 'stats_hour_domain'):
+            assert conn.execute(f'SELECT COUNT(*) FROM {table} WHERE bucket < ?', (cutoff,)).fetchone() == (0,)
+        # Rollups still agree with the rows that are left
+        assert conn.execute('SELECT SUM(total) FROM stats_minute').fetchone() == (len(kept),)
+        assert conn.execute('SELECT SUM(total) FROM stats_hour').fetchone() == (len(kept),)
+        # Domains only the dropped days referred to are gone
+        names = {row[0] for row in conn.execute('SELECT name FROM query_domains')}
+        assert names == {row[1] for row in kept}
+
+    # Nothing is left to drop the second time
+    assert db.cleanup_old_queries(days=30) == 0
+    assert read_queries(db) == expected_rows(kept)
+
+def test_stats_after_cleanup(open_database, now):
+    """Stats read from the rollups and from the raw partitions agree after cleanup"""
+    rows = [row for row in make_rows(now) if row[0] > now - 20 * HOUR]
+    db = open_database()
+    db.partitions.prepare(rows)
+    with db.connections.writer() as conn:
+        db.partitions.insert(conn, rows)
+        db.rollups.apply(conn, rows)
+    db.cleanup_old_queries(days=30)
+
+    from_rollups = db.get_query_stats(hours=24)
+    rollups, db.rollups = db.rollups, None
+    from_raw = db.get_query_stats(hours=24)
+    db.rollups = rollups
+    assert from_rollups['total_queries'] == from_raw['total_queries'] == len(rows)
+    assert from_rollups['blocked_queries'] == from_raw['blocked_queries'] == sum(row[4] for row in rows)
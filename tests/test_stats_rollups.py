@@ -0,0 +1,90 @@
+"""
+Query Rollup Tests
+Windows of whole hours plus edge minutes must match the raw rows
+"""
+
+import random
+import sqlite3
+
+import pytest
+
+import stats_rollups
+from stats_rollups import HOUR, MINUTE, QueryRollups
+
+# A fixed "now" 25 minutes and 10 seconds into an hour
+NOW = 1700000000 - 1700000000 % HOUR + 25 * MINUTE + 10
+
+@pytest.fixture
+def rollups():
+    return QueryRollups()
+
+@pytest.fixture
+def conn(rollups):
+    conn = sqlite3.connect(':memory:')
+    rollups.create_tables(conn)
+    yield conn
+    conn.close()
+
+def window_total(conn, rollups, since):
+    sql, params = rollups._window(since, NOW)
+    return conn.execute(f'SELECT COALESCE(SUM(total), 0) FROM ({sql})', params).fetchone()[0]
+
+def test_window_within_current_hour(rollups):
+    """A window starting in the current hour reads only minutes"""
+    since = NOW - 5 * MINUTE - 30
+    sql, params = rollups._window(since, NOW)
+    assert 'stats_hour' not in sql
+    assert params == (since - since % MINUTE,)
+
+def test_window_from_hour_boundary(rollups):
+    """A window starting on an hour has no leading minutes"""
+    current_hour = NOW - NOW % HOUR
+    since = current_hour - 3 * HOUR
+    sql, params = rollups._window(since, NOW)
+    assert params == (since, since, since, current_hour, current_hour)
+
+def test_window_edges(rollups):
+    """Leading minutes run up to the next hour, hours up to the current one"""
+    current_hour = NOW - NOW % HOUR
+    since = current_hour - 2 * HOUR - 17 * MINUTE - 42
+    sql, params = rollups._window(since, NOW)
+    first_minute = since - since % MINUTE
+    assert params == (first_minute, current_hour - 2 * HOUR, current_hour - 2 * HOUR,
+                      current_hour, current_hour)
+
+def test_window_totals_match_rows(conn, rollups):
+    """Every window counts exactly the rows from the minute of since on"""
+    rng = random.Random(1)
+    timestamps = [NOW - rng.randrange(6 * HOUR) for _ in range(3000)]
+    # Rows right on and around minute and hour boundaries
+    current_hour = NOW - NOW % HOUR
+    for hour in range(6):
+        boundary = current_hour - hour * HOUR
+        timestamps.extend((boundary - 1, boundary, boundary + 1, boundary + MINUTE - 1))
+    timestamps = [timestamp for timestamp in timestamps if timestamp <= NOW]
+    rollups.apply(conn, [(timestamp, 'example.com', 'A', '10.0.0.1', 0, 0, 1.0, 0)
+                         for timestamp in timestamps])
+
+    candidates = [NOW, NOW - 1, current_hour, current_hour - 1, current_hour + 1,
+                  current_hour - HOUR, current_hour - HOUR + MINUTE, current_hour - 5 * HOUR - 1]
+    candidates.extend(NOW - rng.randrange(6 * HOUR) for _ in range(200))
+    for since in candidates:
+        first_minute = since - since % MINUTE
+        expected = sum(1 for timestamp in timestamps if timestamp >= first_minute)
+        assert window_total(conn, rollups, since) == expected, since
+
+def test_hourly_and_totals_agree(conn, rollups, monkeypatch):
+    """hourly() and totals() add up to the same window"""
+    monkeypatch.setattr(stats_rollups.time, 'time', lambda: NOW)
+    timestamps = [NOW - i * 97 for i in range(200)]
+    rollups.apply(conn, [(timestamp, f'd{timestamp % 7}.com', 'A', '10.0.0.1', timestamp % 2, 0, 2.0, 10)
+                         for timestamp in timestamps])
+    since = NOW - 3 * HOUR - 13 * MINUTE
+    totals = rollups.totals(conn, since)
+    hourly = rollups.hourly(conn, since)
+    assert [row[0] for row in hourly] == sorted({row[0] for row in hourly})
+    assert totals[:3] == tuple(sum(row[i] for row in hourly) for i in (1, 2, 3))
+    assert totals[3] == sum(row[4] for row in hourly)
+    kept = [timestamp for timestamp in timestamps if timestamp >= since - since % MINUTE]
+    assert totals[0] == len(kept)
+    assert totals[1] == sum(timestamp % 2 for timestamp in kept)
@@ -0,0 +1,114 @@
+"""
+Query Sketch Tests
+Error bounds of the Space-Saving and HyperLogLog summaries
+"""
+
+import random
+import time
+from collections import Counter
+
+import stats_sketch
+from stats_sketch import HOUR, HyperLogLog, QuerySketches, SpaceSaving
+
+def zipf_stream(rng, keys, length):
+    """length keys drawn with probability falling off as 1 / rank"""
+    weights = [1.0 / rank for rank in range(1, keys + 1)]
+    return rng.choices([f"d{rank}.example.com" for rank in range(keys)], weights, k=length)
+
+def check_bounds(summary, true_counts):
+    """Counts are upper bounds at most floor too high, and heavy keys are kept"""
+    for key, count in summary.counts.items():
+        assert true_counts[key] <= count <= true_counts[key] + summary.floor
+    for key, count in true_counts.items():
+        if count > summary.floor:
+            assert key in summary.counts
+        assert summary.estimate(key) >= count
+
+def test_space_saving_exact_while_small():
+    """Counts are exact while fewer than 2 * capacity keys are seen"""
+    summary = SpaceSaving(capacity=100)
+    stream = zipf_stream(random.Random(2), 150, 5000)
+    for key in stream:
+        summary.add(key)
+    assert summary.floor == 0
+    assert summary.counts == Counter(stream)
+
+def test_space_saving_error_bound():
+    """Every estimate overshoots by at most floor once keys are dropped"""
+    summary = SpaceSaving(capacity=50)
+    stream = zipf_stream(random.Random(3), 5000, 50000)
+    for key in stream:
+        summary.add(key)
+    true_counts = Counter(stream)
+    assert summary.floor > 0
+    # For a skewed stream the dropped counts stay well below N / capacity
+    assert summary.floor <= len(stream) / summary.capacity
+    check_bounds(summary, true_counts)
+    top = [key for key, _ in summary.top(5)]
+    assert top == [key for key, _ in true_counts.most_common(5)]
+
+def test_space_saving_weighted_merge():
+    """Merged summaries keep the bounds for the summed counts"""
+    rng = random.Random(4)
+    first, second = SpaceSaving(capacity=40), SpaceSaving(capacity=40)
+    true_counts = Counter()
+    for summary in (first, second):
+        for key in zipf_stream(rng, 3000, 20000):
+            weight = rng.randrange(1, 4)
+            summary.add(key, weight)
+            true_counts[key] += weight
+    first.merge(second)
+    check_bounds(first, true_counts)
+    assert len(first.counts) < 2 * first.capacity
+
+def test_hyperloglog_error_bound():
+    """Estimates stay within a few standard errors of the true count"""
+    for count in (1000, 20000, 150000):
+        sketch = HyperLogLog()
+        for i in range(count):
+            sketch.add(f"host{i}.example.net")
+        # 1.04 / sqrt(2 ** 14) is 0.8%; allow five standard errors
+        assert abs(sketch.count() - count) <= 0.04 * count, count
+
+def test_hyperloglog_small_counts():
+    """Small counts are close to exact through linear counting"""
+    sketch = HyperLogLog()
+    for i in range(200):
+        sketch.add(f"small{i}.example")
+        sketch.add(f"small{i}.example")
+    assert abs(sketch.count() - 200) <= 3
+    assert HyperLogLog().count() == 0
+
+def test_hyperloglog_merge_is_union():
+    """Merging counts the union of overlapping key sets once"""
+    first, second = HyperLogLog(), HyperLogLog()
+    for i in range(30000):
+        first.add(f"k{i}")
+    for i in range(20000, 50000):
+        second.add(f"k{i}")
+    first.merge(second)
+    assert abs(first.count() - 50000) <= 0.04 * 50000
+
+def test_window_merges_hours(monkeypatch):
+    """A window adds the settled hours and the current one without changing the buckets"""
+    # Half way through an hour, so the test never straddles an hour boundary
+    now = int(time.time())
+    current = now - now % HOUR
+    now = current + HOUR // 2
+    monkeypatch.setattr(stats_sketch.time, 'time', lambda: now)
+    sketches = QuerySketches(hours=4, capacity=64)
+    sketches.seed([(current - 2 * HOUR, 'a.com', 5, 1, 0, 0),
+                   (current - HOUR, 'a.com', 3, 0, 1, 50),
+                   (current - HOUR, 'b.com', 2, 0, 0, 0)], current - 3 * HOUR)
+    sketches.add(now, 'b.com', blocked=1)
+
+    window = sketches.window(current - 2 * HOUR)
+    assert dict(window.top_domains()) == {'a.com': 8, 'b.com': 3}
+    assert dict(window.top_domains(blocked_only=True)) == {'a.com': 1, 'b.com': 1}
+    assert window.unique_domains() == 2
+    # A later call sees new queries, and the merged window is not shared
+    sketches.add(now, 'c.com')
+    assert dict(sketches.window(current - 2 * HOUR).top_domains()) == {'a.com': 8, 'b.com': 3, 'c.com': 1}
+    assert dict(sketches.window(current).top_domains()) == {'b.com': 1, 'c.com': 1}
+    assert sketches.buckets[current - HOUR].queries.counts == {'a.com': 3, 'b.com': 2}
+    assert sketches.window(current - 4 * HOUR) is None
@@ -0,0 +1,198 @@
+"""
+Upstream Client Tests
+Server parsing, ID multiplexing, answer matching and the TCP retry on truncation
+"""
+
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from dnslib import A, DNSRecord, RR
+
+from upstream_client import UpstreamClient
+
+def has_ipv6():
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.bind(('::1', 0))
+        return True
+    except OSError:
+        return False
+
+class FakeUpstream:
+    """UDP (and TCP) DNS server on an ephemeral port answering every A query
+
+    Each answer carries the query's name and an address derived from it.
+    truncate makes UDP answers empty with TC set; the full answer is then
+    only available over TCP. before_answer(sock, data, addr) runs ahead of
+    every UDP answer, to inject stray packets.
+    """
+
+    def __init__(self, host='127.0.0.1', truncate=False, before_answer=None):
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self.udp = socket.socket(family, socket.SOCK_DGRAM)
+        self.udp.bind((host, 0))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(family, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((host, self.port))
+        self.tcp.listen()
+        self.host = host
+        self.truncate = truncate
+        self.before_answer = before_answer
+        self.tcp_queries = 0
+        self.running = True
+        for target in (self._serve_udp, self._serve_tcp):
+            threading.Thread(target=target, daemon=True).start()
+
+    @property
+    def address(self):
+        return f"[{self.host}]:{self.port}" if ':' in self.host else f"{self.host}:{self.port}"
+
+    @staticmethod
+    def answer(data):
+        request = DNSRecord.parse(data)
+        reply = request.reply()
+        number = sum(request.q.qname.label[0]) % 250 + 1
+        reply.add_answer(RR(request.q.qname, rdata=A(f"192.0.2.{number}"), ttl=60))
+        return reply
+
+    def _serve_udp(self):
+        while self.running:
+            try:
+                data, addr = self.udp.recvfrom(4096)
+                if self.before_answer:
+                    self.before_answer(self.udp, data, addr)
+                reply = self.answer(data)
+                if self.truncate:
+                    reply.rr = []
+                    reply.header.tc = 1
+                self.udp.sendto(reply.pack(), addr)
+            except OSError:
+                return
+
+    def _serve_tcp(self):
+        while self.running:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            with conn:
+                length = struct.unpack('!H', conn.recv(2))[0]
+                data = conn.recv(length)
+                self.tcp_queries += 1
+                packed = self.answer(data).pack()
+                conn.sendall(struct.pack('!H', len(packed)) + packed)
+
+    def close(self):
+        self.running = False
+        self.udp.close()
+        self.tcp.close()
+
+@pytest.fixture
+def make_client():
+    clients, upstreams = [], []
+
+    def make_client(**upstream_options):
+        upstream = FakeUpstream(**upstream_options)
+        client = UpstreamClient([upstream.address], pool_size=2, timeout=0.5, deadline=1.5)
+        upstreams.append(upstream)
+        clients.append(client)
+        return client, upstream
+
+    yield make_client
+    for client in clients:
+        client.stop()
+    for upstream in upstreams:
+        upstream.close()
+
+def expected_address(name):
+    return f"192.0.2.{sum(name.split('.')[0].encode()) % 250 + 1}"
+
+@pytest.mark.parametrize('entry, expected', [
+    ('8.8.8.8', ('8.8.8.8', 53)),
+    ('1.1.1.1:5353', ('1.1.1.1', 5353)),
+    ('2606:4700:4700::1111', ('2606:4700:4700::1111', 53)),
+    ('[2606:4700:4700::1111]:853', ('2606:4700:4700::1111', 853)),
+    ('[::1]', ('::1', 53)),
+])
+def test_parse_server(entry, expected):
+    """IPv4, IPv6 and bracketed IPv6 entries with and without a port"""
+    assert UpstreamClient.parse_server(entry) == expected
+
+@pytest.mark.parametrize('entry', ['1.2.3.4:dns', '[::1]53', '[::1]:x'])
+def test_parse_server_rejects_bad_entries(entry):
+    with pytest.raises(ValueError):
+        UpstreamClient.parse_server(entry)
+
+def test_concurrent_queries_share_sockets(make_client):
+    """Queries in flight at once get distinct IDs and each gets its own answer"""
+    client, upstream = make_client()
+    names = [f"host{i}.example" for i in range(40)]
+    requests = [DNSRecord.question(name) for name in names]
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        responses = list(pool.map(client.query, requests))
+
+    for name, request, response in zip(names, requests, responses):
+        assert response is not None
+        # The caller's ID is restored on the way out
+        assert response.header.id == request.header.id
+        assert str(response.q.qname) == name + '.'
+        assert str(response.rr[0].rdata) == expected_address(name)
+    assert len(client.sockets[socket.AF_INET]) == 2
+    assert client.get_stats()['answered'] == 40
+
+def test_answers_must_match_address_and_question(make_client):
+    """Stray packets with the right ID but wrong source or question are ignored"""
+    stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stranger.bind(('127.0.0.1', 0))
+
+    def inject(sock, data, addr):
+        request = DNSRecord.parse(data)
+        # Right ID and question, wrong source address
+        spoofed = request.reply()
+        spoofed.add_answer(RR(request.q.qname, rdata=A('203.0.113.66'), ttl=60))
+        stranger.sendto(spoofed.pack(), addr)
+        # Right ID and source, wrong question
+        other = DNSRecord.question('other.example')
+        other.header.id = request.header.id
+        wrong = other.reply()
+        wrong.add_answer(RR('other.example', rdata=A('203.0.113.77'), ttl=60))
+        sock.sendto(wrong.pack(), addr)
+
+    client, upstream = make_client(before_answer=inject)
+    try:
+        response = client.query(DNSRecord.question('real.example'))
+    finally:
+        stranger.close()
+    assert str(response.rr[0].rdata) == expected_address('real.example')
+    assert client.get_stats()['mismatched'] == 2
+
+def test_truncated_answer_is_retried_over_tcp(make_client):
+    """A UDP answer with TC set is fetched again over TCP"""
+    client, upstream = make_client(truncate=True)
+    request = DNSRecord.question('big.example')
+    response = client.query(request)
+    assert upstream.tcp_queries == 1
+    assert response.header.tc == 0
+    assert response.header.id == request.header.id
+    assert str(response.rr[0].rdata) == expected_address('big.example')
+    assert client.get_stats()['tcp_retries'] == 1
+
+@pytest.mark.skipif(not has_ipv6(), reason="no IPv6 loopback")
+def test_ipv6_upstream(make_client):
+    """An IPv6 upstream gets its own socket pool and its answers are matched"""
+    client, upstream = make_client(host='::1')
+    response = client.query(DNSRecord.question('six.example'))
+    assert str(response.rr[0].rdata) == expected_address('six.example')
+    assert set(client.sockets) == {socket.AF_INET6}
+
+def test_no_answer_times_out(make_client):
+    """A silent upstream yields None once the deadline passes"""
+    client, upstream = make_client()
+    upstream.close()
+    client.timeout, client.deadline = 0.2, 0.4
+    assert client.query(DNSRecord.question('silent.example')) is None
+    assert client.get_stats()['timeouts'] == 1
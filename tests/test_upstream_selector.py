@@ -0,0 +1,137 @@
+"""
+Upstream Selector Tests
+EWMA ranking, the circuit breaker's backoff and probes, and exploration
+"""
+
+import pytest
+
+import upstream_selector
+from upstream_selector import UpstreamSelector
+
+A, B, C = ('192.0.2.1', 53), ('192.0.2.2', 53), ('192.0.2.3', 53)
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controllable time.monotonic() for the selector"""
+    now = [1000.0]
+    monkeypatch.setattr(upstream_selector.time, 'monotonic', lambda: now[0])
+    return now
+
+def trip(selector, server):
+    for _ in range(UpstreamSelector.FAILURE_THRESHOLD):
+        selector.record_failure(server)
+
+def test_untried_servers_first_then_fastest(clock):
+    """Servers without a measurement are tried first, then ranked by latency"""
+    selector = UpstreamSelector([A, B, C])
+    selector.record_success(A, 0.050)
+    selector.record_success(B, 0.010)
+    first, fallbacks = selector.plan()
+    assert first == [C]
+    assert fallbacks == [B, A]
+
+    selector.record_success(C, 0.030)
+    assert selector.plan() == ([B], [C, A])
+
+def test_ewma_smooths_latency(clock):
+    """One slow answer moves the estimate by EWMA_ALPHA of the difference"""
+    selector = UpstreamSelector([A, B])
+    selector.record_success(A, 0.010)
+    selector.record_success(B, 0.020)
+    selector.record_success(A, 0.050)
+    assert selector.health[A].rtt == pytest.approx(0.010 + UpstreamSelector.EWMA_ALPHA * 0.040)
+    # 22 ms is still slower than B's 20 ms
+    assert selector.plan()[0] == [B]
+
+def test_race_and_ordered_strategies(clock):
+    """race asks the fastest race_count at once; ordered keeps configured order"""
+    race = UpstreamSelector([A, B, C], strategy='race', race_count=2)
+    ordered = UpstreamSelector([A, B, C], strategy='ordered')
+    for selector in (race, ordered):
+        selector.record_success(A, 0.030)
+        selector.record_success(B, 0.020)
+        selector.record_success(C, 0.010)
+    assert race.plan() == ([C, B], [A])
+    assert ordered.plan() == ([A], [B, C])
+    assert UpstreamSelector([A], strategy='bogus').strategy == 'fastest'
+
+def test_breaker_opens_after_threshold(clock):
+    """FAILURE_THRESHOLD consecutive failures take a server out of rotation"""
+    selector = UpstreamSelector([A, B])
+    selector.record_success(A, 0.010)
+    selector.record_success(B, 0.050)
+    for _ in range(UpstreamSelector.FAILURE_THRESHOLD - 1):
+        selector.record_failure(A)
+    assert selector.plan()[0] == [A]
+
+    selector.record_failure(A)
+    assert selector.plan() == ([B], [])
+    stats = {entry['server']: entry for entry in selector.get_stats()}
+    assert stats['192.0.2.1:53']['state'] == 'open'
+    assert stats['192.0.2.1:53']['retry_in'] == UpstreamSelector.BASE_BACKOFF
+
+def test_success_resets_consecutive_failures(clock):
+    """Failures only trip the breaker when they come in a row"""
+    selector = UpstreamSelector([A])
+    for _ in range(5):
+        selector.record_failure(A)
+        selector.record_failure(A)
+        selector.record_success(A, 0.010)
+    assert selector.health[A].backoff == 0
+    assert selector.plan() == ([A], [])
+
+def test_half_open_probe_and_recovery(clock):
+    """After the backoff one probe is sent; success closes the circuit"""
+    selector = UpstreamSelector([A, B])
+    selector.record_success(A, 0.010)
+    selector.record_success(B, 0.050)
+    trip(selector, A)
+
+    clock[0] += UpstreamSelector.BASE_BACKOFF
+    # The probe goes out alongside the normal choice, only once
+    assert selector.plan() == ([B, A], [])
+    assert selector.plan() == ([B], [])
+    assert selector.get_stats()[0]['state'] == 'open'
+
+    selector.record_success(A, 0.012)
+    assert selector.plan() == ([A], [B])
+    assert selector.get_stats()[0]['state'] == 'healthy'
+
+def test_failed_probes_double_backoff_up_to_max(clock):
+    """Each failed probe doubles the backoff, capped at MAX_BACKOFF"""
+    selector = UpstreamSelector([A, B])
+    trip(selector, A)
+    backoffs = []
+    for _ in range(10):
+        clock[0] += selector.health[A].backoff
+        assert A in selector.plan()[0]
+        selector.record_failure(A)
+        backoffs.append(selector.health[A].backoff)
+    assert backoffs[:6] == [10.0, 20.0, 40.0, 80.0, 160.0, 300.0]
+    assert set(backoffs[6:]) == {UpstreamSelector.MAX_BACKOFF}
+    assert A not in selector.plan()[0]
+
+def test_all_open_falls_back_to_soonest(clock):
+    """With every circuit open, the server recovering soonest is still asked"""
+    selector = UpstreamSelector([A, B])
+    trip(selector, A)
+    clock[0] += 1
+    trip(selector, B)
+    assert selector.plan() == ([A], [B])
+
+def test_exploration_every_nth_query(clock):
+    """Every EXPLORE_EVERY-th plan also asks the least recently used healthy server"""
+    selector = UpstreamSelector([A, B, C])
+    selector.record_success(A, 0.010)
+    selector.record_success(B, 0.020)
+    selector.record_success(C, 0.030)
+    explored = []
+    for i in range(1, 2 * UpstreamSelector.EXPLORE_EVERY + 1):
+        clock[0] += 1
+        first, fallbacks = selector.plan()
+        if len(first) > 1:
+            explored.append((i, first))
+            assert first[1] not in fallbacks
+    assert [i for i, _ in explored] == [UpstreamSelector.EXPLORE_EVERY, 2 * UpstreamSelector.EXPLORE_EVERY]
+    # The first exploration picks one never used; the next picks the other
+    assert {explored[0][1][1], explored[1][1][1]} == {B, C}
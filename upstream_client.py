@@ -0,0 +1,304 @@
+"""
+Upstream DNS Client
+Pooled, multiplexed UDP forwarding to upstream DNS servers
+"""
+
+import secrets
+import socket
+import struct
+import threading
+import time
+from dnslib import DNSRecord
+import dns_wire
+from upstream_selector import UpstreamSelector
+
+# Answers that mean "try another server" rather than a real result
+RCODE_SERVFAIL = 2
+RCODE_REFUSED = 5
+
+class _PendingQuery:
+    """An in-flight upstream query waiting for its answer"""
+
+    __slots__ = ('question', 'sent', 'failed', 'event', 'data', 'server', 'rtt', 'error_data')
+
+    def __init__(self, question):
+        self.question = question
+        self.sent = {}              # server -> monotonic send time
+        self.failed = set()         # servers that answered SERVFAIL/REFUSED
+        self.event = threading.Event()
+        self.data = None
+        self.server = None
+        self.rtt = None
+        self.error_data = None
+
+class UpstreamClient:
+    """Forwards queries over a small pool of long-lived UDP sockets
+
+    Every outgoing query gets a transaction ID that is unique among the
+    queries in flight, so many queries share each socket. Answers are
+    matched back by ID, source server and question. Which servers are
+    asked, and in what order, is decided by an UpstreamSelector.
+
+    Servers are kept as (numeric address, port) tuples; IPv4 and IPv6
+    servers each get their own socket pool.
+    """
+
+    def __init__(self, upstreams, pool_size=4, timeout=2.0, deadline=5.0,
+                 strategy='fastest', race_count=2):
+        self.servers = [self.parse_server(s) for s in upstreams]
+        self.pool_size = max(1, pool_size)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.selector = UpstreamSelector(self.servers, strategy=strategy, race_count=race_count)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        # Address family -> pooled sockets
+        self.sockets = {}
+        self.receiver_threads = []
+        self._next_socket = 0
+        self.running = False
+        self.stats = {
+            'sent': 0,
+            'answered': 0,
+            'timeouts': 0,
+            'failures': 0,
+            'mismatched': 0,
+            'tcp_retries': 0
+        }
+
+    @staticmethod
+    def parse_server(server):
+        """Turn "host", "host:port", an IPv6 address or "[address]:port" into an address tuple
+
+        Names are resolved once, here, so answers can be matched by the
+        address they come from. Raises ValueError for an unusable entry.
+        """
+        server = str(server).strip()
+        if server.startswith('['):
+            host, _, rest = server[1:].partition(']')
+            if rest and not rest.startswith(':'):
+                raise ValueError(f"Invalid upstream DNS server: {server}")
+            port = rest[1:]
+        elif server.count(':') > 1:
+            # Bare IPv6 address, no port
+            host, port = server, ''
+        else:
+            host, _, port = server.partition(':')
+        try:
+            port = int(port) if port else 53
+            info = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+        except (ValueError, socket.gaierror) as e:
+            raise ValueError(f"Invalid upstream DNS server {server}: {e}") from None
+        return info[0][4][:2]
+
+    @staticmethod
+    def family(server):
+        """Address family of a server tuple"""
+        return socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+
+    def start(self):
+        """Open a socket pool per address family and start one receiver thread per socket"""
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            for family in {self.family(server) for server in self.servers}:
+                pool = self.sockets[family] = []
+                for _ in range(self.pool_size):
+                    sock = socket.socket(family, socket.SOCK_DGRAM)
+                    sock.bind(('::' if family == socket.AF_INET6 else '0.0.0.0', 0))
+                    sock.settimeout(1.0)
+                    pool.append(sock)
+                    thread = threading.Thread(target=self._receive_loop, args=(sock,), daemon=True)
+                    thread.start()
+                    self.receiver_threads.append(thread)
+
+    def stop(self):
+        """Close the socket pools and wake any waiting callers"""
+        with self.lock:
+            self.running = False
+            sockets = [sock for pool in self.sockets.values() for sock in pool]
+            self.sockets = {}
+            pending, self.pending = self.pending, {}
+        for sock in sockets:
+            try:
+                sock.close()
+            except Exception:
+                pass
+        for query in pending.values():
+            query.event.set()
+        self.receiver_threads = []
+
+    def get_stats(self):
+        """Get forwarding statistics"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self.pending)
+        stats['strategy'] = self.selector.strategy
+        stats['upstreams'] = self.selector.get_stats()
+        return stats
+
+    def query(self, request):
+        """Forward a dnslib request; returns the parsed response or None
+
+        The selector's first wave is queried at once and the first good
+        answer wins. If none arrives within `timeout` seconds, fallback
+        servers are added one at a time until the overall `deadline` runs
+        out. A late answer from a server that was already tried still
+        counts.
+        """
+        if not self.running:
+            self.start()
+
+        q = request.q
+        question = (str(q.qname).rstrip('.').lower(), q.qtype, q.qclass)
+        query = _PendingQuery(question)
+        txid = self._register(query)
+        packet = dns_wire.set_id(request.pack(), txid)
+
+        first_wave, fallbacks = self.selector.plan()
+        waves = [first_wave] + [[server] for server in fallbacks]
+        deadline = time.monotonic() + self.deadline
+        try:
+            for wave in waves:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sent = [server for server in wave if self._send(query, packet, server)]
+                if not sent:
+                    continue
+                if query.event.wait(min(self.timeout, remaining)):
+                    if query.data is not None:
+                        break
+                    # Every server asked so far answered with an error
+                    query.event.clear()
+            else:
+                # Out of servers to add; give late answers the rest of the deadline
+                remaining = deadline - time.monotonic()
+                if query.data is None and remaining > 0 and len(query.failed) < len(query.sent):
+                    query.event.wait(remaining)
+        finally:
+            with self.lock:
+                self.pending.pop(txid, None)
+
+        self._record_outcome(query)
+
+        data = query.data if query.data is not None else query.error_data
+        if data is None:
+            with self.lock:
+                self.stats['timeouts'] += 1
+            return None
+
+        if dns_wire.is_truncated(data):
+            data = self._query_tcp(packet, query.server, deadline) or data
+
+        response = DNSRecord.parse(data)
+        response.header.id = request.header.id
+        return response
+
+    def _record_outcome(self, query):
+        """Feed latency and failures from one query back to the selector"""
+        now = time.monotonic()
+        if query.data is not None:
+            self.selector.record_success(query.server, query.rtt)
+        for server, sent_at in query.sent.items():
+            if server == query.server and query.data is not None:
+                continue
+            # Losing a race is not a failure; running out of time is
+            if server in query.failed or now - sent_at >= self.timeout:
+                self.selector.record_failure(server)
+
+    def _register(self, query):
+        """Allocate a transaction ID that is not in flight"""
+        with self.lock:
+            while True:
+                txid = secrets.randbits(16)
+                if txid not in self.pending:
+                    self.pending[txid] = query
+                    return txid
+
+    def _send(self, query, packet, server):
+        """Send a packet to one server on the next pooled socket of its family"""
+        with self.lock:
+            pool = self.sockets.get(self.family(server))
+            if not pool:
+                return False
+            sock = pool[self._next_socket % len(pool)]
+            self._next_socket += 1
+            query.sent[server] = time.monotonic()
+            self.stats['sent'] += 1
+        self.selector.record_sent(server)
+        try:
+            sock.sendto(packet, server)
+            return True
+        except OSError as e:
+            print(f"Error forwarding to {server[0]}: {e}")
+            with self.lock:
+                self.stats['failures'] += 1
+            return False
+
+    def _receive_loop(self, sock):
+        """Match answers arriving on one socket to pending queries"""
+        while self.running:
+            try:
+                data, addr = sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            if len(data) < dns_wire.HEADER_SIZE:
+                continue
+            # IPv6 sources carry flow info and scope id as well
+            addr = addr[:2]
+            txid = dns_wire.get_id(data)
+            question = dns_wire.parse_question(data)
+
+            rcode = data[3] & 0x0F
+            with self.lock:
+                query = self.pending.get(txid)
+                if query is None or addr not in query.sent or question != query.question:
+                    self.stats['mismatched'] += 1
+                    continue
+                if query.data is not None:
+                    continue
+                if rcode in (RCODE_SERVFAIL, RCODE_REFUSED):
+                    # Keep waiting for a better answer from other servers
+                    query.failed.add(addr)
+                    if query.error_data is None:
+                        query.error_data = data
+                        query.server = addr
+                    if len(query.failed) < len(query.sent):
+                        continue
+                else:
+                    query.data = data
+                    query.server = addr
+                    query.rtt = time.monotonic() - query.sent[addr]
+                    self.stats['answered'] += 1
+            query.event.set()
+
+    def _query_tcp(self, packet, server, deadline):
+        """Repeat a truncated query over TCP"""
+        with self.lock:
+            self.stats['tcp_retries'] += 1
+        remaining = max(deadline - time.monotonic(), 0.5)
+        try:
+            with socket.create_connection(server, timeout=remaining) as sock:
+                sock.sendall(struct.pack('!H', len(packet)) + packet)
+                length = struct.unpack('!H', self._recv_exact(sock, 2))[0]
+                return self._recv_exact(sock, length)
+        except Exception as e:
+            print(f"Error retrying {server[0]} over TCP: {e}")
+            return None
+
+    @staticmethod
+    def _recv_exact(sock, size):
+        """Read exactly size bytes from a stream socket"""
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by upstream")
+            data += chunk
+        return data
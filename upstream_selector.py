@@ -0,0 +1,163 @@
+"""
+Upstream Selector
+Tracks upstream DNS server health and decides where each query goes
+"""
+
+import threading
+import time
+
+class UpstreamHealth:
+    """Latency and failure bookkeeping for one upstream server"""
+
+    __slots__ = ('server', 'rtt', 'queries', 'answers', 'failures',
+                 'consecutive_failures', 'open_until', 'backoff', 'last_used')
+
+    def __init__(self, server):
+        self.server = server
+        self.rtt = None                 # EWMA of round-trip time in seconds
+        self.queries = 0
+        self.answers = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0           # circuit open (skipped) until this time
+        self.backoff = 0.0
+        self.last_used = 0.0
+
+    def to_dict(self, now):
+        """Serialize for the dashboard API"""
+        if self.open_until > now:
+            state = 'open'
+        elif self.backoff:
+            state = 'probing'
+        else:
+            state = 'healthy'
+        return {
+            'server': f"{self.server[0]}:{self.server[1]}",
+            'state': state,
+            'rtt_ms': round(self.rtt * 1000, 2) if self.rtt is not None else None,
+            'queries': self.queries,
+            'answers': self.answers,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'retry_in': round(max(self.open_until - now, 0), 1)
+        }
+
+class UpstreamSelector:
+    """Ranks upstream servers by EWMA latency with a circuit breaker
+
+    A server is skipped after FAILURE_THRESHOLD consecutive failures. Once
+    its backoff expires it is sent a single probe alongside the normal
+    choice; a failed probe doubles the backoff up to MAX_BACKOFF.
+    """
+
+    EWMA_ALPHA = 0.3
+    FAILURE_THRESHOLD = 3
+    BASE_BACKOFF = 5.0
+    MAX_BACKOFF = 300.0
+    # Every Nth query also goes to the least recently used healthy server
+    # so that latency estimates for idle servers stay current
+    EXPLORE_EVERY = 100
+
+    STRATEGIES = ('fastest', 'race', 'ordered')
+
+    def __init__(self, servers, strategy='fastest', race_count=2):
+        self.servers = list(servers)
+        self.strategy = strategy if strategy in self.STRATEGIES else 'fastest'
+        self.race_count = max(1, race_count)
+        self.health = {server: UpstreamHealth(server) for server in self.servers}
+        self.lock = threading.Lock()
+        self._counter = 0
+
+    def plan(self):
+        """Return (first_wave, fallbacks) for one query
+
+        Every server in first_wave is queried at once; fallbacks are tried
+        one at a time if the first wave does not answer in time.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._counter += 1
+            healthy = []
+            probes = []
+            for server in self.servers:
+                health = self.health[server]
+                if health.open_until <= now:
+                    if health.backoff:
+                        probes.append(health)
+                    else:
+                        healthy.append(health)
+
+            if self.strategy != 'ordered':
+                # Untried servers sort first so every server gets measured
+                healthy.sort(key=lambda h: -1.0 if h.rtt is None else h.rtt)
+
+            if not healthy and not probes:
+                # Everything is tripped; fall back to the soonest recovering
+                ranked = sorted(self.health.values(), key=lambda h: h.open_until)
+                return [ranked[0].server], [h.server for h in ranked[1:]]
+
+            width = self.race_count if self.strategy == 'race' else 1
+            first = healthy[:width]
+            rest = healthy[width:]
+
+            # Half-open: one probe per tripped server, then back off again
+            # until the probe result comes in
+            for health in probes:
+                first.append(health)
+                health.open_until = now + health.backoff
+
+            if rest and self._counter % self.EXPLORE_EVERY == 0:
+                stalest = min(rest, key=lambda h: h.last_used)
+                rest.remove(stalest)
+                first.append(stalest)
+
+            for health in first:
+                health.last_used = now
+
+            return [h.server for h in first], [h.server for h in rest]
+
+    def record_sent(self, server):
+        """Count a query sent to a server"""
+        with self.lock:
+            health = self.health.get(server)
+            if health is not None:
+                health.queries += 1
+
+    def record_success(self, server, rtt):
+        """Fold a measured round trip into the server's EWMA and close its circuit"""
+        with self.lock:
+            health = self.health.get(server)
+            if health is None:
+                return
+            health.answers += 1
+            health.consecutive_failures = 0
+            health.backoff = 0.0
+            health.open_until = 0.0
+            if health.rtt is None:
+                health.rtt = rtt
+            else:
+                health.rtt += self.EWMA_ALPHA * (rtt - health.rtt)
+
+    def record_failure(self, server):
+        """Count a timeout or error answer, tripping the circuit when needed"""
+        with self.lock:
+            health = self.health.get(server)
+            if health is None:
+                return
+            health.failures += 1
+            health.consecutive_failures += 1
+
+            if health.backoff:
+                # A failed probe: stay open for twice as long
+                health.backoff = min(health.backoff * 2, self.MAX_BACKOFF)
+            elif health.consecutive_failures >= self.FAILURE_THRESHOLD:
+                health.backoff = self.BASE_BACKOFF
+            else:
+                return
+            health.open_until = time.monotonic() + health.backoff
+
+    def get_stats(self):
+        """Per-upstream statistics in configured order"""
+        now = time.monotonic()
+        with self.lock:
+            return [self.health[server].to_dict(now) for server in self.servers]
@@ -10,10 +10,11 @@ import time
 class WebDashboard:
     """Flask web dashboard for DNS filter application"""
     
-    def __init__(self, config, database, blocklist_manager):
+    def __init__(self, config, database, blocklist_manager, dns_server=None):
         self.config = config
         self.database = database
         self.blocklist_manager = blocklist_manager
+        self.dns_server = dns_server
         
         # Initialize Flask app
         self.app = Flask(__name__)
@@ -58,6 +59,20 @@ class WebDashboard:
             stats = self.database.get_hourly_stats(hours)
             return jsonify(stats)
         
+        @self.app.route('/api/upstreams')
+        def api_upstreams():
+            """API endpoint for upstream DNS server health"""
+            if not self.dns_server:
+                return jsonify({'error': 'DNS server not available'}), 503
+            return jsonify(self.dns_server.resolver.upstream_client.get_stats())
+        
+        @self.app.route('/api/cache-stats')
+        def api_cache_stats():
+            """API endpoint for DNS cache statistics"""
+            if not self.dns_server:
+                return jsonify({'error': 'DNS server not available'}), 503
+            return jsonify(self.dns_server.resolver.cache.get_stats())
+        
         @self.app.route('/logs')
         def logs():
             """Query logs page"""